@@ -5,3 +5,6 @@ DEBUG = False
 INSTALLED_APPS += [  # noqa
     "tests",
 ]
+
+# TestCase never commits its transaction, imports run inside it
+GEOCAD_IMPORT_ON_COMMIT = False
@@ -0,0 +1,405 @@
+import csv
+import json
+import multiprocessing
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from io import StringIO
+from pathlib import Path
+
+import django
+import ezdxf
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile, File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from tests.synthetic import SCALES, make_dxf, make_insertion_rows
+
+from django_geocad.models import Drawing, Entity, EntityData, Layer
+from django_geocad.views import DrawingDetailView, layer_entities
+
+
+class Command(BaseCommand):
+    help = """
+        Benchmarks extraction and rendering of synthetic DXF drawings at
+        several scales against the configured database. Times drawing save
+        (extraction), bulk insertions, CSV export, DXF download preparation,
+        detail view rendering and deletion, and writes JSON results that can
+        be compared across commits. An existing DXF file can be benchmarked
+        instead of synthetic drawings, and peak memory of the save step can
+        be measured in a forked process. Stored entity geometry and detail
+        view size (page and entities of all layers) are reported, to compare
+        deduplicated insertions and block instancing in the map. Deletion
+        of drawings with many entities can be benchmarked alone. Startup
+        (Django setup and import of the app) is timed in a new process,
+        with import times of heavy dependencies imported meanwhile.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scale",
+            action="append",
+            choices=list(SCALES),
+            help="Drawing scale, can be repeated (default: tiny and small)",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=3,
+            help="Number of runs for each scale",
+        )
+        parser.add_argument("--seed", type=int, default=0, help="Random seed")
+        parser.add_argument("--output", help="JSON file for results (default stdout)")
+        parser.add_argument(
+            "--dxf",
+            help="Benchmark this DXF file (must be georeferenced) instead",
+        )
+        parser.add_argument(
+            "--write-dxf",
+            help="Write the synthetic DXF of the first scale to this path and exit",
+        )
+        parser.add_argument(
+            "--streaming",
+            action="store_true",
+            help="Enable GEOCAD_STREAMING_IMPORT",
+        )
+        parser.add_argument(
+            "--deduplicate",
+            action="store_true",
+            help="Enable GEOCAD_DEDUPLICATE_INSERTIONS",
+        )
+        parser.add_argument(
+            "--instancing",
+            action="store_true",
+            help="Enable GEOCAD_CLIENT_INSTANCING",
+        )
+        parser.add_argument(
+            "--delete-entities",
+            type=int,
+            help="Only benchmark deletion of a drawing with this many entities",
+        )
+        parser.add_argument(
+            "--delete-signals",
+            action="store_true",
+            help="Enable GEOCAD_DELETE_SIGNALS",
+        )
+        parser.add_argument(
+            "--no-startup",
+            action="store_true",
+            help="Do not benchmark startup",
+        )
+        parser.add_argument(
+            "--peak-rss",
+            action="store_true",
+            help="Save in a forked process and report its peak RSS (POSIX only)",
+        )
+
+    def handle(self, *args, **options):
+        if options["repeat"] < 1:
+            raise CommandError("Repeat must be a positive integer.")
+        if options["peak_rss"] and (
+            "fork" not in multiprocessing.get_all_start_methods()
+            or (connection.vendor == "sqlite" and connection.is_in_memory_db())
+        ):
+            raise CommandError("Peak RSS needs fork and a persistent database.")
+        scales = options["scale"] or ["tiny", "small"]
+        if options["write_dxf"]:
+            with open(options["write_dxf"], "w") as f:
+                f.write(make_dxf(seed=options["seed"], **SCALES[scales[0]]))
+            return
+        results = {"environment": get_environment(), "scales": {}}
+        results["environment"]["streaming"] = options["streaming"]
+        results["environment"]["deduplicate"] = options["deduplicate"]
+        results["environment"]["instancing"] = options["instancing"]
+        results["environment"]["delete_signals"] = options["delete_signals"]
+        if not options["no_startup"]:
+            self.stderr.write("Benchmarking startup...")
+            runs = [run_startup() for i in range(options["repeat"])]
+            results["startup"] = summarize_startup(runs)
+        with override_settings(
+            GEOCAD_STREAMING_IMPORT=options["streaming"],
+            GEOCAD_DEDUPLICATE_INSERTIONS=options["deduplicate"],
+            GEOCAD_CLIENT_INSTANCING=options["instancing"],
+            GEOCAD_DELETE_SIGNALS=options["delete_signals"],
+        ):
+            if options["delete_entities"]:
+                count = options["delete_entities"]
+                self.stderr.write(f"Benchmarking deletion of {count} entities...")
+                runs = [run_deletion(count) for i in range(options["repeat"])]
+                results["deletion"] = {"entities": count, "steps": summarize(runs)}
+                scales = []
+            elif options["dxf"]:
+                scales = [Path(options["dxf"]).name]
+            for scale in scales:
+                self.stderr.write(f"Benchmarking {scale} drawing...")
+                if options["dxf"]:
+                    counts = None
+                    content = Path(options["dxf"])
+                    size = content.stat().st_size
+                else:
+                    counts = SCALES[scale]
+                    content = make_dxf(seed=options["seed"], **counts)
+                    size = len(content)
+                runs = [
+                    run_scenario(content, counts, options["seed"], options["peak_rss"])
+                    for i in range(options["repeat"])
+                ]
+                results["scales"][scale] = {
+                    "counts": counts,
+                    "dxf_size": size,
+                    # sizes do not change across runs
+                    "sizes": runs[0][1],
+                    "steps": summarize([steps for steps, sizes in runs]),
+                }
+        output = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
+
+
+def get_environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "ezdxf": ezdxf.__version__,
+        "database": connection.vendor,
+    }
+
+
+# modules deferred to the code paths using them, see run_startup
+HEAVY_MODULES = ["ezdxf", "pyproj", "shapely", "PIL", "nh3", "easy_thumbnails"]
+
+STARTUP = """
+import json, time
+start = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+import django_geocad.admin, django_geocad.urls
+end = time.perf_counter()
+print(json.dumps({"setup": setup - start, "app": end - setup, "time": end - start}))
+"""
+
+
+def run_startup():
+    """
+    Sets up Django and imports admin and views of the app in a new process
+    with `python -X importtime`. Returns times in seconds, with cumulative
+    import time of heavy modules imported meanwhile (models imported by
+    Django with importlib are not reported by importtime).
+    """
+
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", STARTUP],
+        capture_output=True,
+        text=True,
+        cwd=settings.BASE_DIR,
+        check=True,
+    )
+    result = json.loads(process.stdout.splitlines()[-1])
+    result["modules"] = {}
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_time, cumulative, name = line[len("import time:") :].split("|")
+        if name.strip() in HEAVY_MODULES:
+            result["modules"][name.strip()] = int(cumulative) / 1e6
+    return result
+
+
+def summarize_startup(runs):
+    summary = {}
+    for name in ["time", "setup", "app"]:
+        times = [run[name] for run in runs]
+        summary[name] = {"min": min(times), "median": statistics.median(times)}
+    # heavy modules should only be imported by code using them
+    summary["heavy modules"] = {
+        name: statistics.median(run["modules"].get(name, 0) for run in runs)
+        for name in HEAVY_MODULES
+        if name in runs[0]["modules"]
+    }
+    return summary
+
+
+def run_scenario(content, counts, seed, peak_rss=False):
+    """
+    Runs all steps on a new drawing, returns time and queries by step and
+    sizes in bytes of stored geometry and rendered detail view. Content is
+    DXF text or path of a DXF file, bulk insertions need counts of a
+    synthetic drawing.
+    """
+
+    steps = {}
+    sizes = {}
+
+    def step(name, func):
+        return measure(steps, name, func)
+
+    drawing = Drawing(title="Benchmark")
+    if isinstance(content, Path):
+        with open(content, "rb") as f:
+            drawing.dxf.save("benchmark.dxf", File(f), save=False)
+    else:
+        drawing.dxf.save("benchmark.dxf", ContentFile(content), save=False)
+    try:
+        if peak_rss:
+            steps["save"] = save_in_child(drawing)
+            drawing = Drawing.objects.get(id=steps["save"].pop("drawing"))
+        else:
+            step("save", drawing.save)
+        if counts:
+            rows = make_insertion_rows(counts["insertions"], counts["blocks"], seed)
+            step("bulk insertions", lambda: drawing.bulk_create_insertions(rows))
+        sizes.update(geometry_sizes(drawing))
+        step("write csv", lambda: drawing.write_csv(csv.writer(StringIO())))
+        responses = step("detail view", lambda: render_detail_view(drawing))
+        sizes["detail view"] = sum(len(r.content) for r in responses)
+        step("download", drawing.prepare_dxf_to_download)
+        step("delete", drawing.delete)
+    finally:
+        drawing.dxf.delete(save=False)
+    return steps, sizes
+
+
+def run_deletion(count):
+    """
+    Bulk creates a drawing with count entities on ten layers (one entity out
+    of ten with data), then times deletion of the drawing.
+    """
+
+    steps = {}
+    drawing = Drawing.objects.bulk_create([Drawing(title="Benchmark")])[0]
+    try:
+        measure(steps, "create", lambda: create_entities(drawing, count))
+        measure(steps, "delete", drawing.delete)
+    finally:
+        Drawing.objects.filter(id=drawing.id).delete()
+    return steps
+
+
+def create_entities(drawing, count, batch_size=5000):
+    layers = Layer.objects.bulk_create(
+        [Layer(drawing=drawing, name=f"Layer {i}") for i in range(10)]
+    )
+    for start in range(0, count, batch_size):
+        entities = Entity.objects.bulk_create(
+            [
+                Entity(
+                    layer=layers[i % 10],
+                    geom={
+                        "type": "GeometryCollection",
+                        "geometries": [
+                            {
+                                "type": "LineString",
+                                "coordinates": [[i * 1e-6, 0], [i * 1e-6, 1e-6]],
+                            }
+                        ],
+                    },
+                )
+                for i in range(start, min(start + batch_size, count))
+            ]
+        )
+        EntityData.objects.bulk_create(
+            [EntityData(entity=ent, key="Key", value="Value") for ent in entities[::10]]
+        )
+
+
+def measure(steps, name, func):
+    """Runs func recording time and number of queries in steps"""
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        result = func()
+        steps[name] = {
+            "time": time.perf_counter() - start,
+            "queries": len(queries),
+        }
+    return result
+
+
+def save_in_child(drawing):
+    """Saves drawing in a forked process, returns time and peak RSS"""
+    # POSIX only
+    import resource
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    def target():
+        start = time.perf_counter()
+        drawing.save()
+        sender.send(
+            {
+                "time": time.perf_counter() - start,
+                "queries": getattr(drawing.import_reports.first(), "queries", None),
+                # kilobytes on Linux
+                "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                "drawing": drawing.id,
+            }
+        )
+        connections.close_all()
+
+    # forked process must not share the parent connections
+    connections.close_all()
+    process = multiprocessing.get_context("fork").Process(target=target)
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def geometry_sizes(drawing):
+    """Bytes of entity geometry stored as JSON, all and insertions only"""
+    sizes = {"geometry": 0, "insertion geometry": 0}
+    entities = Entity.objects.filter(layer__drawing=drawing).values_list(
+        "block_id", "geom"
+    )
+    for block_id, geom in entities.iterator():
+        size = len(json.dumps(geom)) if geom else 0
+        sizes["geometry"] += size
+        if block_id:
+            sizes["insertion geometry"] += size
+    return sizes
+
+
+def render_detail_view(drawing):
+    """Renders the detail page and the entities of all its layers"""
+    request = RequestFactory().get("/")
+    # unsaved superuser, permission checks do not hit the database
+    request.user = User(is_active=True, is_superuser=True)
+    response = DrawingDetailView.as_view()(request, pk=drawing.id)
+    responses = [response.render()]
+    for layer in response.context_data["layers"]:
+        responses.append(async_to_sync(layer_entities)(request, pk=layer["id"]))
+    return responses
+
+
+def summarize(runs):
+    summary = {}
+    for name in runs[0]:
+        times = [run[name]["time"] for run in runs]
+        summary[name] = {
+            "min": min(times),
+            "median": statistics.median(times),
+            "queries": runs[0][name]["queries"],
+        }
+        if "peak_rss" in runs[0][name]:
+            summary[name]["peak_rss"] = max(run[name]["peak_rss"] for run in runs)
+    return summary
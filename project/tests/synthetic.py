@@ -0,0 +1,203 @@
+"""
+Synthetic DXF drawings for benchmarks. Drawings are generated with ezdxf
+from a seeded random generator, so the same arguments always give the
+same file, and are georeferenced so that they are fully extracted.
+"""
+
+import random
+from io import StringIO
+from math import cos, pi, sin, sqrt
+
+import ezdxf
+from pyproj import Transformer
+
+from django_geocad.models import Drawing
+
+# number of entities of each kind by scale
+SCALES = {
+    "tiny": {
+        "polylines": 20,
+        "rooms": 5,
+        "blocks": 2,
+        "insertions": 5,
+        "splines": 5,
+        "hatches": 5,
+    },
+    "small": {
+        "polylines": 500,
+        "rooms": 50,
+        "blocks": 5,
+        "insertions": 50,
+        "splines": 50,
+        "hatches": 50,
+    },
+    "medium": {
+        "polylines": 5000,
+        "rooms": 500,
+        "blocks": 10,
+        "insertions": 200,
+        "splines": 500,
+        "hatches": 500,
+    },
+    "large": {
+        "polylines": 50000,
+        "rooms": 2000,
+        "blocks": 20,
+        "insertions": 1000,
+        "splines": 2000,
+        "hatches": 2000,
+    },
+}
+
+# same reference system and point of yesgeo.dxf
+EPSG = 32633
+REFERENCE_POINT = (291187.7155651262, 4640994.318375054)
+
+
+def make_dxf(
+    polylines=0,
+    rooms=0,
+    blocks=0,
+    insertions=0,
+    splines=0,
+    hatches=0,
+    seed=0,
+):
+    """
+    Returns DXF content (str) with `polylines` random polylines spread on
+    ten layers, `rooms` closed rectangles labelled with TEXT / MTEXT,
+    `blocks` block definitions with an attribute, each inserted
+    `insertions` times, `splines` splines and `hatches` hatches.
+    """
+
+    # fixed timestamps and GUIDs, so that output is reproducible
+    fixed = ezdxf.options.write_fixed_meta_data_for_testing
+    ezdxf.options.write_fixed_meta_data_for_testing = True
+    try:
+        doc = build_doc(polylines, rooms, blocks, insertions, splines, hatches, seed)
+        stream = StringIO()
+        doc.write(stream)
+    finally:
+        ezdxf.options.write_fixed_meta_data_for_testing = fixed
+    return stream.getvalue()
+
+
+def build_doc(polylines, rooms, blocks, insertions, splines, hatches, seed):
+    rng = random.Random(seed)
+    doc = ezdxf.new()
+    msp = doc.modelspace()
+    set_geodata(msp)
+    total = polylines + rooms + blocks * insertions + splines + hatches
+    # about 100 square meters per entity
+    side = max(10 * sqrt(total), 10)
+
+    def point():
+        return (rng.uniform(0, side), rng.uniform(0, side))
+
+    for i in range(10):
+        doc.layers.add(f"poly_{i}", color=i + 1)
+    for i in range(polylines):
+        x, y = point()
+        vertices = [
+            (x + rng.uniform(-5, 5), y + rng.uniform(-5, 5))
+            for j in range(rng.randint(2, 20))
+        ]
+        msp.add_lwpolyline(
+            vertices,
+            close=rng.random() < 0.3,
+            dxfattribs={"layer": f"poly_{i % 10}"},
+        )
+    doc.layers.add("rooms", color=3)
+    for i in range(rooms):
+        x, y = point()
+        w, h = rng.uniform(2, 8), rng.uniform(2, 8)
+        msp.add_lwpolyline(
+            [(x, y), (x + w, y), (x + w, y + h), (x, y + h)],
+            close=True,
+            dxfattribs={"layer": "rooms"},
+        )
+        center = (x + w / 2, y + h / 2)
+        if i % 2:
+            msp.add_mtext(f"Room {i}", dxfattribs={"layer": "rooms"}).set_location(
+                center
+            )
+        else:
+            msp.add_text(f"Room {i}", dxfattribs={"layer": "rooms", "insert": center})
+    doc.layers.add("insertions", color=5)
+    for i in range(blocks):
+        block = doc.blocks.new(name=f"block_{i}")
+        block.add_circle((0, 0), radius=0.5)
+        block.add_line((-0.5, 0), (0.5, 0))
+        block.add_lwpolyline([(-0.5, -0.5), (0.5, -0.5), (0.5, 0.5)])
+        block.add_attdef("CODE", (0, -1), dxfattribs={"text": f"code {i}"})
+        for j in range(insertions):
+            ref = msp.add_blockref(
+                f"block_{i}",
+                point(),
+                dxfattribs={
+                    "layer": "insertions",
+                    "rotation": rng.uniform(0, 360),
+                    "xscale": rng.uniform(0.5, 2),
+                    "yscale": rng.uniform(0.5, 2),
+                },
+            )
+            ref.add_auto_attribs({"CODE": f"{i}-{j}"})
+    doc.layers.add("splines", color=6)
+    for i in range(splines):
+        x, y = point()
+        msp.add_spline(
+            [(x + k, y + rng.uniform(-2, 2)) for k in range(rng.randint(3, 8))],
+            dxfattribs={"layer": "splines"},
+        )
+    doc.layers.add("hatches", color=7)
+    for i in range(hatches):
+        x, y = point()
+        r = rng.uniform(1, 4)
+        sides = rng.randint(3, 8)
+        hatch = msp.add_hatch(color=2, dxfattribs={"layer": "hatches"})
+        hatch.paths.add_polyline_path(
+            [
+                (x + r * cos(2 * pi * k / sides), y + r * sin(2 * pi * k / sides))
+                for k in range(sides)
+            ],
+            is_closed=True,
+        )
+    return doc
+
+
+def set_geodata(msp):
+    geodata = msp.new_geodata()
+    geodata.coordinate_system_definition = Drawing(epsg=EPSG).get_epsg_xml()
+    geodata.dxf.design_point = (0, 0, 0)
+    geodata.dxf.reference_point = (*REFERENCE_POINT, 0)
+    geodata.dxf.north_direction = (0, 1)
+    return geodata
+
+
+def make_insertion_rows(count, blocks, seed=0, side=100):
+    """
+    Returns rows for `Drawing.bulk_create_insertions` placing `count`
+    instances of blocks `block_0` ... near the reference point.
+    """
+
+    rng = random.Random(seed)
+    utm2world = Transformer.from_crs(EPSG, 4326, always_xy=True)
+    rows = []
+    for i in range(count):
+        long, lat = utm2world.transform(
+            REFERENCE_POINT[0] + rng.uniform(0, side),
+            REFERENCE_POINT[1] + rng.uniform(0, side),
+        )
+        rows.append(
+            {
+                "lat": lat,
+                "long": long,
+                "block": f"block_{i % blocks}",
+                "layer": "imported",
+                "rotation": rng.uniform(0, 360),
+                "xscale": 1,
+                "yscale": 1,
+                "attributes": {"CODE": f"imported {i}"},
+            }
+        )
+    return rows
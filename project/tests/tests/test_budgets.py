@@ -0,0 +1,183 @@
+import os
+import re
+import time
+from collections import Counter
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from tests.synthetic import make_dxf, make_insertion_rows
+
+from django_geocad import urls
+from django_geocad.models import Drawing, EntityData
+from django_geocad.spatial_index import clear_indexes
+
+# fixture drawings, the large one has five times the entities of the small
+SIZES = {
+    "small": {
+        "polylines": 10,
+        "rooms": 2,
+        "blocks": 2,
+        "insertions": 2,
+        "splines": 2,
+        "hatches": 2,
+    },
+    "large": {
+        "polylines": 50,
+        "rooms": 10,
+        "blocks": 2,
+        "insertions": 10,
+        "splines": 10,
+        "hatches": 10,
+    },
+}
+
+# default latency budget of a request, seconds: generous, as wall time is
+# unreliable on shared CI runners, strict if the GEOCAD_CHECK_LATENCY
+# environment variable is set
+LATENCY_BUDGET = 2.0 if os.environ.get("GEOCAD_CHECK_LATENCY") else 10.0
+
+# how each URL of django_geocad.urls is requested: method, which object of
+# the fixture is passed as pk, optional data / headers / budget
+VIEWS = {
+    "drawing_list": {"method": "get", "pk": None},
+    "drawing_detail": {"method": "get", "pk": "drawing"},
+    "insertion_create": {"method": "get", "pk": "drawing"},
+    "drawing_identify": {
+        "method": "get",
+        "pk": "drawing",
+        "data": {"lat": 42, "long": 12},
+    },
+    "insertion_bulk_create": {"method": "get", "pk": "drawing"},
+    "insertion_change": {"method": "get", "pk": "insertion"},
+    "insertion_delete": {"method": "get", "pk": "insertion"},
+    "data_list": {"method": "get", "pk": "insertion"},
+    "data_create": {
+        "method": "post",
+        "pk": "insertion",
+        "data": {"key": "Foo", "value": "Bar"},
+        "headers": {"Hx-Request": "true"},
+    },
+    "data_delete": {
+        "method": "post",
+        "pk": "entity_data",
+        "headers": {"Hx-Request": "true"},
+    },
+    "entity_popup": {"method": "get", "pk": "insertion"},
+    "layer_entities": {"method": "get", "pk": "layer"},
+    "drawing_csv": {"method": "get", "pk": "drawing"},
+    "drawing_csv_file": {"method": "get", "pk": "drawing"},
+    "drawing_download": {"method": "get", "pk": "drawing"},
+}
+
+
+def normalize(sql):
+    """Replaces literals, so that repeated queries share a pattern"""
+    sql = re.sub(r"'[^']*'", "?", sql)
+    sql = re.sub(r"\b\d+(\.\d+)?\b", "?", sql)
+    sql = re.sub(r"(WHEN \(.+?\) THEN \? )+", "WHEN ... ", sql)
+    return re.sub(r"\(\?(, \?)*\)", "(...)", sql)
+
+
+def query_patterns(queries):
+    return Counter(normalize(q["sql"]) for q in queries)
+
+
+@override_settings(MEDIA_ROOT=Path(settings.MEDIA_ROOT).joinpath("tests"))
+class GeoCADBudgetTest(TestCase):
+    """
+    Requests each URL against a small and a large drawing: the number of
+    queries must not depend on drawing size, and each request must stay
+    within its latency budget.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.fixtures = {}
+        for size, counts in SIZES.items():
+            drawing = Drawing(title=f"Budget {size}")
+            drawing.dxf.save(f"{size}.dxf", ContentFile(make_dxf(**counts)), save=False)
+            drawing.save()
+            rows = make_insertion_rows(counts["insertions"], counts["blocks"])
+            insertions = drawing.bulk_create_insertions(rows)
+            cls.fixtures[size] = {
+                "drawing": drawing,
+                "insertion": insertions[0],
+                "layer": insertions[0].layer,
+                "entity_data": EntityData.objects.filter(entity=insertions[0]).first(),
+            }
+        User.objects.create_superuser("boss", "test@example.com", "p4s5w0r6")
+
+    @classmethod
+    def tearDownClass(cls):
+        """Checks existing files, then removes them"""
+        try:
+            path = Path(settings.MEDIA_ROOT).joinpath("uploads/django_geocad/dxf/")
+            files = [e for e in path.iterdir() if e.is_file()]
+            for file in files:
+                Path(file).unlink()
+        except FileNotFoundError:
+            pass
+        super().tearDownClass()
+
+    def request(self, name, size):
+        view = VIEWS[name]
+        kwargs = {}
+        if view["pk"]:
+            kwargs["pk"] = self.fixtures[size][view["pk"]].id
+        url = reverse(f"django_geocad:{name}", kwargs=kwargs)
+        # cached responses and indexes would hide queries
+        cache.clear()
+        clear_indexes()
+        # each request leaves the database untouched
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = getattr(self.client, view["method"])(
+                    url, view.get("data", {}), headers=view.get("headers", {})
+                )
+                # streamed content is produced while it is read
+                if response.streaming:
+                    b"".join(response)
+                elapsed = time.perf_counter() - start
+            transaction.set_rollback(True)
+        self.assertLess(response.status_code, 400, f"{name}: {url}")
+        return queries.captured_queries, elapsed
+
+    def test_all_urls_have_budget(self):
+        names = {p.name for p in urls.urlpatterns}
+        self.assertEqual(names, set(VIEWS))
+
+    def test_query_count_and_latency(self):
+        self.client.login(username="boss", password="p4s5w0r6")
+        for name, view in VIEWS.items():
+            with self.subTest(name):
+                # first request warms up caches
+                self.request(name, "small")
+                small, small_time = self.request(name, "small")
+                large, large_time = self.request(name, "large")
+                self.assertLess(
+                    max(small_time, large_time),
+                    view.get("budget", LATENCY_BUDGET),
+                    f"{name} over latency budget",
+                )
+                if len(small) == len(large):
+                    continue
+                small_patterns = query_patterns(small)
+                large_patterns = query_patterns(large)
+                diff = [
+                    f"{large_patterns[p]:>5} x {p}"
+                    for p in large_patterns
+                    if large_patterns[p] != small_patterns[p]
+                ]
+                self.fail(
+                    f"{name}: {len(small)} queries on small drawing, "
+                    f"{len(large)} on large drawing, patterns that grow:\n"
+                    + "\n".join(diff)
+                )
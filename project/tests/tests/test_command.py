@@ -1,11 +1,19 @@
+import json
 from io import StringIO
 from pathlib import Path
+from unittest import mock
 
+import ezdxf
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.core.management import call_command
+from django.core.management import CommandError, call_command
 from django.test import TestCase, override_settings
+from tests.synthetic import SCALES, make_dxf
 
+from django_geocad.management.commands.populate_block_field import (
+    Checkpoint,
+    _populate_drawing,
+)
 from django_geocad.models import Drawing, Entity, Layer
 
 
@@ -37,6 +45,7 @@ class GeoCADCommandTest(TestCase):
                 ],
             },
             data={"Foo": "Bar"},
+            processed=False,
         )
         Entity.objects.create(
             layer=layer,
@@ -53,6 +62,7 @@ class GeoCADCommandTest(TestCase):
             },
             insertion={"type": "Point", "coordinates": [12.523826, 41.90339]},
             data={"Block": block.name, "X scale": 2, "attributes": {"Faz": "Baz"}},
+            processed=False,
         )
 
     @classmethod
@@ -65,6 +75,7 @@ class GeoCADCommandTest(TestCase):
                 Path(file).unlink()
         except FileNotFoundError:
             pass
+        super().tearDownClass()
 
     def call_command(self, *args, **kwargs):
         out = StringIO()
@@ -81,10 +92,205 @@ class GeoCADCommandTest(TestCase):
         self.call_command()
         block = Layer.objects.get(name="Bloke")
         for ent in Entity.objects.all():
-            self.assertTrue("processed" in ent.data)
+            self.assertTrue(ent.processed)
             if "Block" in ent.data and ent.data["Block"] == "Bloke":
                 self.assertEqual(ent.block, block)
                 self.assertEqual(ent.xscale, 2)
                 for e in ent.related_data.all():
                     self.assertEqual(e.key, "Faz")
                     self.assertEqual(e.value, "Baz")
+
+    def test_command_chunked(self):
+        out = self.call_command(chunk_size=1)
+        self.assertIn("Processed 2 entities.", out)
+        block = Layer.objects.get(name="Bloke")
+        ent = Entity.objects.get(block=block)
+        self.assertEqual(ent.xscale, 2)
+        self.assertEqual(ent.related_data.get().key, "Faz")
+        ent = Entity.objects.get(block=None)
+        self.assertEqual(ent.related_data.get().value, "Bar")
+        # second run finds nothing to process
+        out = self.call_command()
+        self.assertEqual(Entity.objects.get(block=block).related_data.count(), 1)
+
+    def test_command_resume_from_checkpoint(self):
+        checkpoint = Path(settings.MEDIA_ROOT).joinpath("checkpoint.json")
+        checkpoint.parent.mkdir(parents=True, exist_ok=True)
+        draw = Drawing.objects.get(title="Not referenced")
+        first = Entity.objects.filter(layer__drawing=draw).order_by("id").first()
+        with open(checkpoint, "w") as f:
+            json.dump({"done": [], "running": {str(draw.id): first.id}}, f)
+        out = self.call_command(checkpoint=str(checkpoint))
+        self.assertIn("Processed 1 entities.", out)
+        self.assertFalse(checkpoint.exists())
+        first.refresh_from_db()
+        self.assertFalse(first.processed)
+        # drawings marked as done are skipped
+        with open(checkpoint, "w") as f:
+            json.dump({"done": [draw.id], "running": {}}, f)
+        out = self.call_command(checkpoint=str(checkpoint))
+        self.assertIn("Resuming, 1 drawings done.", out)
+        self.assertIn("Processed 0 entities.", out)
+
+    def test_command_worker_checkpoint(self):
+        checkpoint = Checkpoint(Path(settings.MEDIA_ROOT).joinpath("checkpoint.json"))
+        checkpoint.path.parent.mkdir(parents=True, exist_ok=True)
+        draw = Drawing.objects.get(title="Not referenced")
+        first = Entity.objects.filter(layer__drawing=draw).order_by("id").first()
+        part = checkpoint.part(draw.id)
+        # workers resume from the last batch stored for their drawing
+        with open(part, "w") as f:
+            json.dump({"done": [], "running": {str(draw.id): first.id}}, f)
+        with mock.patch("django.db.connections.close_all"):
+            processed = _populate_drawing(draw.id, 1, 0, part)
+        self.assertEqual(processed, 1)
+        first.refresh_from_db()
+        self.assertFalse(first.processed)
+        with open(part) as f:
+            last = Entity.objects.filter(layer__drawing=draw).order_by("id").last()
+            self.assertEqual(json.load(f)["running"], {str(draw.id): last.id})
+        checkpoint.complete(draw.id)
+        self.assertFalse(part.exists())
+        checkpoint.clear()
+
+    def test_command_wrong_options(self):
+        with self.assertRaises(CommandError):
+            self.call_command(chunk_size=0)
+
+
+@override_settings(MEDIA_ROOT=Path(settings.MEDIA_ROOT).joinpath("tests"))
+class GeoCADImportInsertionsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        dxf_path = Path(settings.BASE_DIR).joinpath("tests/static/tests/yesgeo.dxf")
+        with open(dxf_path, "rb") as f:
+            content = f.read()
+        draw = Drawing()
+        draw.title = "Referenced"
+        draw.dxf = SimpleUploadedFile("yesgeo.dxf", content, "image/x-dxf")
+        draw.save()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Checks existing files, then removes them"""
+        try:
+            path = Path(settings.MEDIA_ROOT).joinpath("uploads/django_geocad/dxf/")
+            list = [e for e in path.iterdir() if e.is_file()]
+            for file in list:
+                Path(file).unlink()
+        except FileNotFoundError:
+            pass
+        super().tearDownClass()
+
+    def test_command(self):
+        draw = Drawing.objects.get(title="Referenced")
+        path = Path(settings.MEDIA_ROOT).joinpath("survey.csv")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            f.write("lat,long,block,layer,Name\n42,12,block,0,Bench\n")
+        out = StringIO()
+        call_command("import_insertions", draw.id, str(path), stdout=out)
+        self.assertIn("Created 1 insertions.", out.getvalue())
+        ent = Entity.objects.filter(block__name="block").last()
+        self.assertTrue(ent.related_data.filter(key="Name", value="Bench").exists())
+        with self.assertRaises(CommandError):
+            call_command("import_insertions", 999, str(path), stdout=out)
+        with self.assertRaises(CommandError):
+            call_command("import_insertions", draw.id, "missing.csv", stdout=out)
+
+
+@override_settings(MEDIA_ROOT=Path(settings.MEDIA_ROOT).joinpath("tests"))
+class GeoCADBenchmarkTest(TestCase):
+    def test_synthetic_dxf(self):
+        content = make_dxf(polylines=10, rooms=2, blocks=2, insertions=3, splines=1)
+        self.assertEqual(content, make_dxf(10, 2, 2, 3, 1))
+        doc = ezdxf.read(StringIO(content))
+        msp = doc.modelspace()
+        self.assertEqual(len(msp.query("LWPOLYLINE")), 12)
+        self.assertEqual(len(msp.query("TEXT MTEXT")), 2)
+        self.assertEqual(len(msp.query("INSERT")), 6)
+        self.assertEqual(len(msp.query("SPLINE")), 1)
+        self.assertEqual(msp.get_geodata().get_crs(), (32633, True))
+
+    def test_command(self):
+        out = StringIO()
+        call_command(
+            "geocad_benchmark", scale=["tiny"], repeat=1, stdout=out, stderr=StringIO()
+        )
+        results = json.loads(out.getvalue())
+        self.assertEqual(results["environment"]["database"], "sqlite")
+        steps = results["scales"]["tiny"]["steps"]
+        self.assertEqual(
+            list(steps),
+            [
+                "save",
+                "bulk insertions",
+                "write csv",
+                "detail view",
+                "download",
+                "delete",
+            ],
+        )
+        self.assertGreater(steps["save"]["queries"], 0)
+        self.assertFalse(Drawing.objects.filter(title="Benchmark").exists())
+        # DXF and geo libraries are imported when needed
+        startup = results["startup"]
+        self.assertGreater(startup["time"]["min"], startup["app"]["min"])
+        for name in ["ezdxf", "pyproj", "shapely", "nh3"]:
+            self.assertNotIn(name, startup["heavy modules"])
+        with self.assertRaises(CommandError):
+            call_command("geocad_benchmark", repeat=0)
+        # in memory test database can't be shared with forked process
+        with self.assertRaises(CommandError):
+            call_command("geocad_benchmark", peak_rss=True)
+
+    def test_command_deduplicate(self):
+        sizes = {}
+        for deduplicate in (False, True):
+            out = StringIO()
+            call_command(
+                "geocad_benchmark",
+                scale=["tiny"],
+                repeat=1,
+                deduplicate=deduplicate,
+                no_startup=True,
+                stdout=out,
+                stderr=StringIO(),
+            )
+            results = json.loads(out.getvalue())
+            self.assertEqual(results["environment"]["deduplicate"], deduplicate)
+            sizes[deduplicate] = results["scales"]["tiny"]["sizes"]
+        self.assertGreater(sizes[False]["insertion geometry"], 0)
+        self.assertEqual(sizes[True]["insertion geometry"], 0)
+        self.assertLess(sizes[True]["geometry"], sizes[False]["geometry"])
+        # geometry is expanded when the page is rendered
+        self.assertAlmostEqual(
+            sizes[True]["detail view"], sizes[False]["detail view"], delta=1000
+        )
+
+    def test_command_delete_entities(self):
+        out = StringIO()
+        call_command(
+            "geocad_benchmark",
+            delete_entities=100,
+            repeat=1,
+            no_startup=True,
+            stdout=out,
+            stderr=StringIO(),
+        )
+        results = json.loads(out.getvalue())
+        self.assertEqual(results["scales"], {})
+        steps = results["deletion"]["steps"]
+        self.assertEqual(list(steps), ["create", "delete"])
+        # entity data, entities, layers, import reports and drawing
+        self.assertLess(steps["delete"]["queries"], 15)
+        self.assertFalse(Drawing.objects.filter(title="Benchmark").exists())
+        self.assertFalse(Entity.objects.filter(layer__drawing__title="Benchmark"))
+
+    def test_command_write_dxf(self):
+        path = Path(settings.MEDIA_ROOT).joinpath("tiny.dxf")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        call_command("geocad_benchmark", scale=["tiny"], write_dxf=str(path))
+        with open(path) as f:
+            self.assertEqual(f.read(), make_dxf(**SCALES["tiny"]))
+        path.unlink()
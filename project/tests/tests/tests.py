@@ -1,17 +1,60 @@
+import json
+from datetime import timedelta
+from io import StringIO
+from math import cos, radians, sin
 from pathlib import Path
-from unittest import skip
+from unittest import mock, skip
 
 import ezdxf
+import numpy as np
+import shapely
 from django.conf import settings
 from django.contrib.auth.models import Group, User
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase, override_settings
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.http import HttpResponse
+from django.test import (
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
 from django.urls import reverse
+from django.utils import timezone
 from pyproj import Transformer
-
-from django_geocad.models import Drawing, Entity, EntityData, Layer, cad2hex
+from shapely.geometry import GeometryCollection, shape
+
+from django_geocad.fields import geometry_bounds
+from django_geocad.importers import read_insertions
+from django_geocad.models import (
+    Drawing,
+    DrawingVersion,
+    Entity,
+    EntityData,
+    EntityQuerySet,
+    ImportLock,
+    ImportReport,
+    Layer,
+    cad2hex,
+    chunk_geometries,
+    drawing_version,
+    entities_created,
+)
+from django_geocad.reimport import ImportDiff
+from django_geocad.routers import STICKY_COOKIE, ReplicaRouter, read_from_replica
+from django_geocad.spatial_index import get_index
+from django_geocad.streaming import read_skeleton, save_with_entities
 from django_geocad.views import EntityCreateForm
 
+METRICS = []
+
+
+def metrics_callback(drawing, data):
+    METRICS.append((drawing, data))
+
 
 @override_settings(MEDIA_ROOT=Path(settings.MEDIA_ROOT).joinpath("tests"))
 class GeoCADModelTest(TestCase):
@@ -69,6 +112,7 @@ class GeoCADModelTest(TestCase):
                 Path(file).unlink()
         except FileNotFoundError:
             pass
+        super().tearDownClass()
 
     def test_geocad_manager_group_exists(self):
         self.assertTrue(Group.objects.filter(name="GeoCAD Manager").exists())
@@ -127,17 +171,286 @@ class GeoCADModelTest(TestCase):
         draw.save()
         self.assertEqual(draw.epsg, 32633)
 
+    def test_differential_import_removed_keys(self):
+        draw = Drawing.objects.get(title="Referenced")
+        room = Entity.objects.get(layer__drawing=draw, handle="3A7")
+        self.assertTrue(room.related_data.filter(key="Surface", imported=True))
+        EntityData.objects.create(entity=room, key="Owner", value="Me")
+        doc = ezdxf.readfile(draw.dxf.path)
+        # open polylines have no surface
+        doc.entitydb["3A7"].close(False)
+        stream = StringIO()
+        doc.write(stream)
+        draw.dxf = SimpleUploadedFile(
+            "yesgeo.dxf", stream.getvalue().encode(), "image/x-dxf"
+        )
+        draw.save()
+        changed = Entity.objects.get(layer__drawing=draw, handle="3A7")
+        self.assertEqual(changed.id, room.id)
+        keys = set(changed.related_data.values_list("key", flat=True))
+        self.assertNotIn("Surface", keys)
+        self.assertIn("Perimeter", keys)
+        # data added in the app is kept
+        self.assertIn("Owner", keys)
+
+    def test_differential_import(self):
+        draw = Drawing.objects.get(title="Referenced")
+        entities = Entity.objects.filter(layer__drawing=draw)
+        room = entities.get(handle="3A7")
+        EntityData.objects.create(entity=room, key="Owner", value="Me")
+        insertion = entities.get(handle="366")
+        removed = entities.get(handle="3B9")
+        added = Entity.objects.create(
+            layer=room.layer,
+            block=insertion.block,
+            insertion={"type": "Point", "coordinates": [12.5, 41.9]},
+            added=True,
+        )
+        stale = Layer.objects.create(drawing=draw, name="stale")
+        stale_block = Layer.objects.create(drawing=draw, name="stale", is_block=True)
+        manual = Layer.objects.create(drawing=draw, name="manual")
+        Entity.objects.create(
+            layer=manual,
+            block=insertion.block,
+            insertion={"type": "Point", "coordinates": [12.5, 41.9]},
+            added=True,
+        )
+        doc = ezdxf.readfile(draw.dxf.path)
+        doc.layers.get("0").color = 3
+        msp = doc.modelspace()
+        polyline = doc.entitydb["3A7"]
+        polyline.set_points([(x + 1, y, *rest) for x, y, *rest in polyline])
+        msp.delete_entity(doc.entitydb["3B9"])
+        msp.add_line((0, 0), (10, 10), dxfattribs={"layer": "0"})
+        stream = StringIO()
+        doc.write(stream)
+        draw.dxf = SimpleUploadedFile(
+            "yesgeo.dxf", stream.getvalue().encode(), "image/x-dxf"
+        )
+        draw.save()
+        # unchanged, changed and manually added entities keep ids and data
+        self.assertEqual(entities.get(handle="366").id, insertion.id)
+        changed = entities.get(handle="3A7")
+        self.assertEqual(changed.id, room.id)
+        self.assertNotEqual(changed.geom, room.geom)
+        self.assertNotEqual(changed.west, room.west)
+        self.assertTrue(changed.related_data.filter(key="Owner").exists())
+        self.assertTrue(changed.related_data.filter(key="Surface").exists())
+        self.assertTrue(entities.filter(id=added.id, added=True).exists())
+        self.assertFalse(entities.filter(id=removed.id).exists())
+        # new line on layer 0, old chunk on rgb layer kept
+        self.assertEqual(entities.filter(layer__name="0", handle="").count(), 1)
+        self.assertEqual(entities.filter(layer__name="rgb").count(), 1)
+        # layers of the file get new colors, missing ones are deleted
+        layer = Layer.objects.get(drawing=draw, name="0", is_block=False)
+        self.assertEqual(layer.color_field, "#00FF00")
+        self.assertFalse(Layer.objects.filter(id__in=[stale.id, stale_block.id]))
+        self.assertTrue(Layer.objects.filter(id=manual.id).exists())
+        report = draw.import_reports.first()
+        self.assertIn("apply diff", [stage["name"] for stage in report.stages])
+
+    @override_settings(GEOCAD_DIFFERENTIAL_IMPORT=False)
+    def test_full_import(self):
+        draw = Drawing.objects.get(title="Referenced")
+        ids = set(Entity.objects.filter(layer__drawing=draw).values_list("id"))
+        with open(draw.dxf.path, "rb") as f:
+            content = f.read()
+        draw.dxf = SimpleUploadedFile("yesgeo.dxf", content, "image/x-dxf")
+        draw.save()
+        new_ids = set(Entity.objects.filter(layer__drawing=draw).values_list("id"))
+        self.assertTrue(new_ids)
+        self.assertFalse(ids & new_ids)
+
+    def test_import_lock(self):
+        draw = Drawing.objects.get(title="Referenced")
+        other = Drawing.objects.get(title="Referenced")
+        self.assertTrue(draw.acquire_import_lock())
+        self.assertFalse(other.acquire_import_lock())
+        # queued imports are merged and extracted once on release
+        self.assertTrue(other.queue_import("file"))
+        self.assertTrue(other.queue_import("fields"))
+        with mock.patch.object(Drawing, "extract_dxf") as extract:
+            draw.release_import_lock()
+        # new geodata from fields extracts everything again
+        extract.assert_called_once_with(refresh=True, diff=False)
+        lock = ImportLock.objects.get(drawing=draw)
+        self.assertIsNone(lock.started)
+        self.assertEqual(lock.queued, "")
+        # nothing to queue if no import is running
+        self.assertFalse(other.queue_import("file"))
+        # stale locks are taken over
+        ImportLock.objects.filter(drawing=draw).update(
+            started=timezone.now() - timedelta(hours=2)
+        )
+        self.assertTrue(other.acquire_import_lock())
+        other.release_import_lock()
+
+    @override_settings(GEOCAD_DIFFERENTIAL_IMPORT=False)
+    def test_import_queued_while_locked(self):
+        draw = Drawing.objects.get(title="Referenced")
+        other = Drawing.objects.get(title="Referenced")
+        ids = set(Entity.objects.filter(layer__drawing=draw).values_list("id"))
+        other.acquire_import_lock()
+        draw.designx = 10
+        with mock.patch.object(Drawing, "extract_dxf") as extract:
+            draw.save()
+        extract.assert_not_called()
+        draw.refresh_from_db()
+        self.assertEqual(draw.designx, 10)
+        self.assertEqual(ImportLock.objects.get(drawing=draw).queued, "fields")
+        self.assertEqual(
+            set(Entity.objects.filter(layer__drawing=draw).values_list("id")), ids
+        )
+        # the running import extracts the queued one
+        other.release_import_lock()
+        new_ids = set(Entity.objects.filter(layer__drawing=draw).values_list("id"))
+        self.assertTrue(new_ids)
+        self.assertFalse(ids & new_ids)
+        self.assertIsNone(ImportLock.objects.get(drawing=draw).started)
+
+    def test_import_waits_for_download(self):
+        draw = Drawing.objects.get(title="Referenced")
+        other = Drawing.objects.get(title="Referenced")
+        self.assertTrue(other.acquire_import_lock(kind="download"))
+        # imports are not queued behind downloads
+        self.assertFalse(draw.queue_import("fields"))
+
+        def download_done(seconds):
+            other.release_import_lock(run_queued=False)
+
+        sleep = mock.patch("django_geocad.models.time.sleep", side_effect=download_done)
+        with sleep as sleep, mock.patch.object(Drawing, "extract_dxf") as extract:
+            draw.import_dxf(refresh=True, diff=True)
+        sleep.assert_called_once()
+        extract.assert_called_once_with(None, refresh=True, diff=True)
+        lock = ImportLock.objects.get(drawing=draw)
+        self.assertIsNone(lock.started)
+        self.assertEqual(lock.kind, "import")
+        # the wait is bounded
+        other.acquire_import_lock(kind="download")
+        with override_settings(GEOCAD_IMPORT_LOCK_WAIT=0):
+            with self.assertRaises(TimeoutError):
+                draw.import_dxf(refresh=True, diff=True)
+
+    def test_import_lock_released_on_error(self):
+        draw = Drawing.objects.get(title="Referenced")
+        draw.designx = 10
+        with mock.patch.object(Drawing, "extract_dxf", side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                draw.save()
+        self.assertIsNone(ImportLock.objects.get(drawing=draw).started)
+
+    @override_settings(GEOCAD_IMPORT_LOCK_WAIT=0)
+    def test_prepare_dxf_to_download_locked(self):
+        draw = Drawing.objects.get(title="Referenced")
+        ent = Entity.objects.create(
+            layer=Layer.objects.get(drawing=draw, name="0"),
+            block=Layer.objects.filter(drawing=draw, is_block=True).last(),
+            insertion={"type": "Point", "coordinates": [12.48, 42.00]},
+            added=True,
+        )
+        Drawing.objects.get(id=draw.id).acquire_import_lock()
+        self.assertIsNone(draw.prepare_dxf_to_download())
+        ent.refresh_from_db()
+        self.assertEqual(ent.handle, "")
+        # partial files are not served
+        url = reverse("django_geocad:drawing_download", kwargs={"pk": draw.id})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "30")
+        # downloads leave queued imports to the running import
+        ImportLock.objects.filter(drawing=draw).update(started=None, queued="file")
+        with mock.patch.object(Drawing, "extract_dxf") as extract:
+            self.assertIsNotNone(draw.prepare_dxf_to_download())
+        extract.assert_not_called()
+        lock = ImportLock.objects.get(drawing=draw)
+        self.assertIsNone(lock.started)
+        self.assertEqual(lock.kind, "download")
+
     def test_drawing_change_design_point(self):
         draw = Drawing.objects.get(title="Referenced")
         draw.designx = 1
         draw.save()
         self.assertEqual(draw.epsg, 32633)
 
+    def test_drawing_set_geom_keeps_dxf(self):
+        draw = Drawing.objects.get(title="Unreferenced")
+        with open(draw.dxf.path, "rb") as f:
+            content = f.read()
+        draw.geom = {"type": "Point", "coordinates": [12.48, 42.00]}
+        draw.save()
+        self.assertTrue(draw.related_layers.exists())
+        self.assertFalse(draw.dxf_georeferenced)
+        with open(draw.dxf.path, "rb") as f:
+            self.assertEqual(f.read(), content)
+        # geodata is added to a file derived for download
+        path = draw.prepare_dxf_to_download()
+        self.assertEqual(path, draw.download_path())
+        with open(draw.dxf.path, "rb") as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(Drawing.objects.get(id=draw.id).dxf_georeferenced)
+        geodata = ezdxf.readfile(path).modelspace().get_geodata()
+        self.assertEqual(geodata.get_crs(), (int(draw.epsg), True))
+        m, epsg = geodata.get_crs_transformation(no_checks=True)
+        for a, b in zip(m, draw.prepare_crs_matrix()):
+            self.assertAlmostEqual(a, b)
+
+    def test_prepare_crs_matrix(self):
+        draw = Drawing.objects.get(title="Referenced")
+        draw.designx = 3
+        draw.designy = -2
+        draw.rotation = 30
+        world2utm, utm2world, utm_wcs, rot = draw.prepare_transformers()
+        geodata = ezdxf.new().modelspace().new_geodata()
+        geodata = draw.fake_geodata(geodata, utm_wcs, rot)
+        m, epsg = geodata.get_crs_transformation(no_checks=True)
+        for a, b in zip(m, draw.prepare_crs_matrix()):
+            self.assertAlmostEqual(a, b)
+
     def test_delete_all_layers(self):
         draw = Drawing.objects.get(title="Referenced")
         self.assertTrue(draw.related_layers.all().exists())
+        ent = Entity.objects.filter(layer__drawing=draw).first()
+        EntityData.objects.create(entity=ent, key="Foo", value="Bar")
+        other = Entity.objects.filter(layer__drawing__title="Unreferenced").count()
+        data = EntityData.objects.filter(entity__layer__drawing=draw).count()
+        receiver = mock.Mock()
+        post_delete.connect(receiver, sender=Entity)
+        self.addCleanup(post_delete.disconnect, receiver, sender=Entity)
+        with self.assertNumQueries(5):
+            deleted, counts = draw.delete_all_layers()
+        self.assertFalse(draw.related_layers.all().exists())
+        self.assertFalse(EntityData.objects.filter(entity_id=ent.id).exists())
+        self.assertEqual(counts["django_geocad.EntityData"], data)
+        self.assertEqual(deleted, sum(counts.values()))
+        receiver.assert_not_called()
+        self.assertEqual(
+            Entity.objects.filter(layer__drawing__title="Unreferenced").count(), other
+        )
+
+    @override_settings(GEOCAD_DELETE_SIGNALS=True)
+    def test_delete_all_layers_signals(self):
+        draw = Drawing.objects.get(title="Referenced")
+        count = Entity.objects.filter(layer__drawing=draw).count()
+        receiver = mock.Mock()
+        post_delete.connect(receiver, sender=Entity)
+        self.addCleanup(post_delete.disconnect, receiver, sender=Entity)
         draw.delete_all_layers()
         self.assertFalse(draw.related_layers.all().exists())
+        self.assertEqual(receiver.call_count, count)
+
+    def test_drawing_delete(self):
+        draw = Drawing.objects.get(title="Referenced")
+        child = Drawing.objects.get(title="Unreferenced")
+        child.parent = draw
+        super(Drawing, child).save()
+        layers = draw.related_layers.count()
+        deleted, counts = draw.delete()
+        self.assertEqual(counts["django_geocad.Drawing"], 1)
+        self.assertEqual(counts["django_geocad.Layer"], layers)
+        self.assertFalse(Entity.objects.filter(layer__drawing__title="Referenced"))
+        child.refresh_from_db()
+        self.assertIsNone(child.parent)
 
     def test_get_geodata_from_parent(self):
         draw = Drawing.objects.get(title="Unreferenced")
@@ -224,9 +537,10 @@ class GeoCADModelTest(TestCase):
         world2utm, utm2world, utm_wcs, rot = draw.prepare_transformers()
         layer_table = draw.prepare_layer_table(doc)
         ent = Entity.objects.last()
-        self.assertTrue("processed" in ent.data)
+        self.assertTrue(ent.processed)
         e_type = "LWPOLYLINE"
-        draw.extract_entities(msp, e_type, m, utm2world, layer_table)
+        texts = draw.collect_texts(msp.query("TEXT MTEXT"))
+        draw.extract_entities(msp.query(e_type), m, utm2world, layer_table, texts)
         ent = Entity.objects.last()
         ent_data = ent.related_data.all()
         for ed in ent_data:
@@ -244,11 +558,62 @@ class GeoCADModelTest(TestCase):
         ent = Entity.objects.last()
         self.assertEqual(ent.layer.name, "Layer")
         e_type = "LINE"
-        draw.extract_entities(msp, e_type, m, utm2world, layer_table)
+        texts = draw.collect_texts(msp.query("TEXT MTEXT"))
+        draw.extract_entities(msp.query(e_type), m, utm2world, layer_table, texts)
         draw.create_layer_entities(layer_table)
         ent = Entity.objects.last()
         self.assertEqual(ent.layer.name, "rgb")
 
+    def test_chunk_geometries(self):
+        # 10 x 10 grid of 4 vertex lines
+        geometries = [
+            {
+                "type": "LineString",
+                "coordinates": [[x, y], [x + 0.5, y], [x + 0.5, y + 0.5], [x, y]],
+            }
+            for x in range(10)
+            for y in range(10)
+        ]
+        self.assertEqual(chunk_geometries(geometries, 0), [geometries])
+        self.assertEqual(chunk_geometries(geometries, 400), [geometries])
+        chunks = chunk_geometries(geometries, 50)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) * 4 <= 50 for chunk in chunks))
+        self.assertCountEqual(
+            [json.dumps(g) for chunk in chunks for g in chunk],
+            [json.dumps(g) for g in geometries],
+        )
+        # extents of chunks do not overlap
+        boxes = [
+            shapely.box(*GeometryCollection([shape(g) for g in chunk]).bounds)
+            for chunk in chunks
+        ]
+        for i, a in enumerate(boxes):
+            for b in boxes[i + 1 :]:
+                self.assertFalse(a.overlaps(b))
+        # geometries with the same center are not split
+        self.assertEqual(len(chunk_geometries(geometries[:1] * 20, 10)), 1)
+
+    @override_settings(GEOCAD_CHUNK_VERTICES=1)
+    def test_create_layer_entities_chunked(self):
+        draw = Drawing.objects.get(title="Referenced")
+        doc = ezdxf.readfile(draw.dxf.path)
+        m, epsg = doc.modelspace().get_geodata().get_crs_transformation(no_checks=True)
+        world2utm, utm2world, utm_wcs, rot = draw.prepare_transformers()
+        layer_table = draw.prepare_layer_table(doc)
+        texts = draw.collect_texts(doc.modelspace().query("TEXT MTEXT"))
+        draw.extract_entities(
+            doc.modelspace().query("LINE"), m, utm2world, layer_table, texts
+        )
+        geometries = [g for data in layer_table.values() for g in data["geometries"]]
+        count = Entity.objects.count()
+        draw.create_layer_entities(layer_table)
+        created = Entity.objects.order_by("id")[count:]
+        self.assertEqual(len(created), len(geometries))
+        for ent in created:
+            self.assertEqual(len(ent.geom["geometries"]), 1)
+            self.assertIsNotNone(ent.west)
+
     def test_save_blocks(self):
         # TODO make this test more meaningful
         draw = Drawing.objects.get(title="Referenced")
@@ -273,7 +638,7 @@ class GeoCADModelTest(TestCase):
         block_table = draw.save_blocks(doc, m, utm2world)
         ins_before = Entity.objects.exclude(block=None).count()
         ins = msp.query("INSERT")[0]
-        draw.extract_insertions(ins, msp, m, utm2world, layer_table, block_table)
+        draw.extract_insertions(ins, m, utm2world, layer_table, block_table)
         ins_after = Entity.objects.exclude(block=None).count()
         self.assertTrue(ins_after - ins_before, 1)
 
@@ -286,10 +651,7 @@ class GeoCADModelTest(TestCase):
             layer=layer,
             block=block,
             insertion={"type": "Point", "coordinates": [12.48, 42.00]},
-            data={
-                "processed": "true",
-                "added": "true",
-            },
+            added=True,
         )
         self.assertIn("geometries", ent.geom)
         ent_data = ent.related_data.all()
@@ -297,12 +659,183 @@ class GeoCADModelTest(TestCase):
         for ed in ent_data:
             self.assertEqual(ed.key, "TAG")
             self.assertEqual(ed.value, "Tag")
+        # insertions not added in the app get geometry, not default data
         ent2 = Entity.objects.create(
             layer=layer,
             block=block,
             insertion={"type": "Point", "coordinates": [12.48, 42.00]},
         )
-        self.assertIsNone(ent2.geom)
+        self.assertEqual(ent2.geom, ent.geom)
+        self.assertFalse(ent2.related_data.exists())
+
+    def test_block_default_attributes(self):
+        draw = Drawing.objects.get(title="Referenced")
+        block = Layer.objects.get(drawing=draw, name="block", is_block=True)
+        # ATTDEF default is overridden by first insertion
+        self.assertEqual(block.attributes, {"TAG": "Tag"})
+        layer = Layer.objects.get(drawing=draw, name="0")
+        block = Layer.objects.select_related("drawing").get(id=block.id)
+        # insert entity, drawing version and default data, no lookups of other
+        # insertions
+        with self.assertNumQueries(3):
+            ent = Entity.objects.create(
+                layer=layer,
+                block=block,
+                insertion={"type": "Point", "coordinates": [12.48, 42.00]},
+                added=True,
+            )
+        self.assertEqual(ent.related_data.get().value, "Tag")
+        # changing an insertion does not copy data again
+        ent.related_data.all().delete()
+        ent.save()
+        self.assertFalse(ent.related_data.exists())
+
+    def test_bulk_create_insertions(self):
+        draw = Drawing.objects.get(title="Referenced")
+        layer = Layer.objects.get(drawing=draw, name="0")
+        block = Layer.objects.filter(drawing=draw, is_block=True).last()
+        single = Entity.objects.create(
+            layer=layer,
+            block=block,
+            insertion={"type": "Point", "coordinates": [12.48, 42.00]},
+            rotation=30,
+            xscale=2,
+            yscale=0.5,
+            added=True,
+        )
+        entities = draw.bulk_create_insertions(
+            [
+                {
+                    "lat": 42.00,
+                    "long": 12.48,
+                    "block": "block",
+                    "layer": "0",
+                    "rotation": 30,
+                    "xscale": 2,
+                    "yscale": 0.5,
+                    "attributes": {"Foo": "Bar"},
+                },
+                {
+                    "lat": 42.01,
+                    "long": 12.49,
+                    "block": "block",
+                    "layer": "Furniture",
+                    "rotation": 0,
+                    "xscale": 1,
+                    "yscale": 1,
+                },
+            ]
+        )
+        self.assertEqual(len(entities), 2)
+        # same geometry as a single insertion
+        ent = Entity.objects.get(id=entities[0].id)
+        expected = single.geom["geometries"][0]["coordinates"][0]
+        for a, b in zip(ent.geom["geometries"][0]["coordinates"][0], expected):
+            self.assertAlmostEqual(a[0], b[0], places=5)
+            self.assertAlmostEqual(a[1], b[1], places=5)
+        # attributes are merged with defaults
+        data = {ed.key: ed.value for ed in ent.related_data.all()}
+        self.assertEqual(data, {"TAG": "Tag", "Foo": "Bar"})
+        # missing layer is created
+        self.assertEqual(entities[1].layer.name, "Furniture")
+        self.assertEqual(entities[1].layer.drawing, draw)
+        with self.assertRaises(ValueError):
+            draw.bulk_create_insertions(
+                [
+                    {
+                        "lat": 42.00,
+                        "long": 12.48,
+                        "block": "nonexistent",
+                        "layer": "0",
+                        "rotation": 0,
+                        "xscale": 1,
+                        "yscale": 1,
+                    }
+                ]
+            )
+
+    def test_read_insertions(self):
+        rows = read_insertions(
+            b"lat,long,block,layer,rotation,scale,Name\n42,12,block,0,45,2,Bench\n",
+            "survey.csv",
+        )
+        self.assertEqual(rows[0]["lat"], 42)
+        self.assertEqual(rows[0]["rotation"], 45)
+        self.assertEqual(rows[0]["xscale"], 2)
+        self.assertEqual(rows[0]["yscale"], 2)
+        self.assertEqual(rows[0]["attributes"], {"Name": "Bench"})
+        rows = read_insertions(
+            """{"type": "FeatureCollection", "features": [{"type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [12, 42]},
+            "properties": {"block": "block", "layer": "0",
+            "attributes": {"Name": "Bench"}}}]}""",
+            "survey.geojson",
+        )
+        self.assertEqual(rows[0]["long"], 12)
+        self.assertEqual(rows[0]["xscale"], 1)
+        self.assertEqual(rows[0]["attributes"], {"Name": "Bench"})
+        with self.assertRaises(ValueError):
+            read_insertions(b"lat,long,block,layer\n142,12,block,0\n", "a.csv")
+        with self.assertRaises(ValueError):
+            read_insertions(b"lat,long,block,layer\n42,12,,0\n", "a.csv")
+        with self.assertRaises(ValueError):
+            read_insertions(b"", "a.txt")
+        # malformed GeoJSON structures
+        point = '{"type": "Point", "coordinates": [12, 42]}'
+        for content in (
+            "[]",
+            '{"features": {}}',
+            '{"features": [1]}',
+            '{"type": "Feature", "properties": {}}',
+            '{"type": "Feature", "geometry": {"type": "Point"}}',
+            '{"type": "Feature", "geometry": %s, "properties": []}' % point,
+            '{"type": "Feature", "geometry": %s, "properties": {"block": "b",'
+            ' "layer": "0", "attributes": ["Name"]}}' % point,
+        ):
+            with self.subTest(content=content), self.assertRaises(ValueError):
+                read_insertions(content, "survey.geojson")
+
+    def test_import_report(self):
+        draw = Drawing.objects.get(title="Referenced")
+        report = draw.import_reports.get()
+        names = [s["name"] for s in report.stages]
+        self.assertEqual(names[0], "read file")
+        self.assertIn("geodata", names)
+        self.assertIn("layer table", names)
+        self.assertIn("entities LWPOLYLINE", names)
+        self.assertIn("insertions", names)
+        self.assertEqual(report.entities, sum(s["entities"] for s in report.stages))
+        # vertices and memory are profiled if enabled
+        self.assertIsNone(report.vertices)
+        self.assertGreater(report.queries, 0)
+        self.assertIsNone(report.peak_memory)
+        # changing title does not import
+        draw.title = "Referenced"
+        draw.save()
+        self.assertEqual(draw.import_reports.count(), 1)
+        # unreferenced drawing is read but not extracted
+        draw = Drawing.objects.get(title="Unreferenced")
+        report = draw.import_reports.first()
+        self.assertNotIn("layer table", [s["name"] for s in report.stages])
+
+    @override_settings(
+        GEOCAD_PROFILE_MEMORY=True,
+        GEOCAD_PROFILE_VERTICES=True,
+        GEOCAD_IMPORT_REPORTS=False,
+        GEOCAD_METRICS_CALLBACK="tests.tests.tests.metrics_callback",
+    )
+    def test_import_report_callback(self):
+        draw = Drawing.objects.get(title="Referenced")
+        before = ImportReport.objects.count()
+        draw.designx = 1
+        with self.assertLogs("django_geocad.import", level="INFO"):
+            draw.save()
+        self.assertEqual(ImportReport.objects.count(), before)
+        drawing, data = METRICS[-1]
+        self.assertEqual(drawing, draw)
+        self.assertEqual(data["stages"][0]["name"], "delete layers")
+        self.assertGreater(data["peak_memory"], 0)
+        self.assertGreater(data["vertices"], data["entities"])
 
     def test_drawing_popup(self):
         draw = Drawing.objects.get(title="Unreferenced")
@@ -337,6 +870,24 @@ class GeoCADModelTest(TestCase):
         self.assertEqual(ent.popupContent["layer"], "Layer - alert('hello')")
         self.assertIn("<li>Layer: alert('hello')</li>", ent.popupContent["content"])
 
+    def test_entity_popup_sanitized_at_write(self):
+        layer = Layer.objects.get(name="Layer")
+        ent = Entity.objects.get(layer=layer)
+        EntityData.objects.bulk_create(
+            [EntityData(entity=ent, key="<b>Key</b>", value=3.5)]
+        )
+        ed = EntityData.objects.get(entity=ent, key="<b>Key</b>")
+        self.assertEqual(ed.key_clean, "<b>Key</b>")
+        self.assertEqual(ed.value_clean, "3.5")
+        ed.value = "<img src=x onerror=alert(1)>"
+        ed.save()
+        self.assertEqual(ed.value_clean, '<img src="x">')
+        # rendering does not sanitize again
+        ent = Entity.objects.select_related("layer", "block").get(id=ent.id)
+        with mock.patch("nh3.clean", side_effect=AssertionError):
+            content = ent.popupContent["content"]
+        self.assertIn('<li><b>Key</b> = <img src="x"></li>', content)
+
     def test_entity_popup_data(self):
         layer = Layer.objects.get(name="Layer")
         ent = Entity.objects.get(layer=layer)
@@ -434,6 +985,20 @@ class GeoCADModelTest(TestCase):
         )
         self.assertEqual(response.status_code, 200)
 
+    async def test_async_downloads(self):
+        draw = await Drawing.objects.aget(title="Referenced")
+        response = await self.async_client.get(
+            reverse("django_geocad:drawing_download", kwargs={"pk": draw.id})
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"SECTION", b"".join([c async for c in response]))
+        response = await self.async_client.get(
+            reverse("django_geocad:drawing_csv", kwargs={"pk": draw.id})
+        )
+        self.assertEqual(response.status_code, 200)
+        content = b"".join([c async for c in response]).decode()
+        self.assertTrue(content.startswith("ID,Layer"))
+
     def test_drawing_list_view_template(self):
         response = self.client.get(
             reverse(
@@ -463,23 +1028,267 @@ class GeoCADModelTest(TestCase):
                 "django_geocad:drawing_list",
             )
         )
-        self.assertEqual(len(response.context["unreferenced"]), 2)
+        self.assertEqual(len(response.context["unreferenced"]), 1)
+
+    def test_drawing_detail_view_layers_in_context(self):
+        draw = Drawing.objects.get(title="Referenced")
+        response = self.client.get(
+            reverse("django_geocad:drawing_detail", kwargs={"pk": draw.id})
+        )
+        self.assertTrue("layers" in response.context)
+        self.assertFalse("lines" in response.context)
 
-    def test_drawing_detail_view_lines_in_context(self):
+    def test_drawing_detail_view_layers_length(self):
         draw = Drawing.objects.get(title="Referenced")
         response = self.client.get(
             reverse("django_geocad:drawing_detail", kwargs={"pk": draw.id})
         )
-        self.assertTrue("lines" in response.context)
-        self.assertTrue("layer_list" in response.context)
+        layers = response.context["layers"]
+        self.assertEqual(len(layers), 4)
+        self.assertEqual(sum(layer["count"] for layer in layers), 6)
+
+    def test_layer_summary(self):
+        draw = Drawing.objects.get(title="Referenced")
+        layer = draw.related_layers.filter(is_block=False).first()
+        layer.visible = False
+        layer.save()
+        summary = {s["id"]: s for s in draw.get_layer_summary()}
+        self.assertFalse(summary[layer.id]["visible"])
+        for layer in draw.related_layers.filter(is_block=False):
+            entities = Entity.objects.filter(layer=layer)
+            self.assertEqual(summary[layer.id]["count"], entities.count())
+            if not entities:
+                self.assertIsNone(summary[layer.id]["bounds"])
+                continue
+            (south, west), (north, east) = summary[layer.id]["bounds"]
+            self.assertEqual(west, min(e.west for e in entities))
+            self.assertEqual(south, min(e.south for e in entities))
+            self.assertEqual(east, max(e.east for e in entities))
+            self.assertEqual(north, max(e.north for e in entities))
+        # bounds of entities are stored when they are saved
+        ent = Entity.objects.filter(layer__drawing=draw, block__isnull=False).first()
+        self.assertEqual(
+            (ent.west, ent.south, ent.east, ent.north),
+            shape(ent.geom).bounds,
+        )
+
+    def test_drawing_detail_view_renderer(self):
+        draw = Drawing.objects.get(title="Referenced")
+        url = reverse("django_geocad:drawing_detail", kwargs={"pk": draw.id})
+        response = self.client.get(url)
+        self.assertContains(
+            response, '<script id="renderer_data" type="application/json">"svg"'
+        )
+        with self.settings(GEOCAD_RENDERER="canvas"):
+            response = self.client.get(url)
+        self.assertContains(
+            response, '<script id="renderer_data" type="application/json">"canvas"'
+        )
 
-    def test_drawing_detail_view_lines_length(self):
+    def test_layer_entities_view(self):
         draw = Drawing.objects.get(title="Referenced")
         response = self.client.get(
             reverse("django_geocad:drawing_detail", kwargs={"pk": draw.id})
         )
-        self.assertEqual(len(response.context["lines"]), 6)
-        self.assertEqual(len(response.context["layer_list"]), 4)
+        # entity popups are not embedded
+        self.assertNotContains(response, "ID = ")
+        total = 0
+        for summary in response.context["layers"]:
+            data = self.client.get(summary["url"]).json()
+            features = data["features"]
+            self.assertEqual(len(features["features"]), summary["count"])
+            total += summary["count"]
+            self.assertIsNone(data["instances"])
+            if not features["features"]:
+                continue
+            self.assertEqual(len(features["layers"]), 1)
+            self.assertEqual(features["layers"][0]["group"], summary["group"])
+            feature = features["features"][0]
+            self.assertEqual(set(feature["properties"]), {"layer"})
+        self.assertEqual(total, 6)
+        block = draw.related_layers.filter(is_block=True).first()
+        url = reverse("django_geocad:layer_entities", kwargs={"pk": block.id})
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_layer_entities_view_bbox(self):
+        draw = Drawing.objects.get(title="Referenced")
+        summary = [s for s in draw.get_layer_summary() if s["count"]][0]
+        url = reverse("django_geocad:layer_entities", kwargs={"pk": summary["id"]})
+        (south, west), (north, east) = summary["bounds"]
+        response = self.client.get(url, {"bbox": f"{west},{south},{east},{north}"})
+        features = response.json()["features"]["features"]
+        self.assertEqual(len(features), summary["count"])
+        response = self.client.get(url, {"bbox": "0,0,1,1"})
+        self.assertEqual(response.json()["features"]["features"], [])
+        response = self.client.get(url, {"bbox": "0,0,1"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_entity_bounds_computed_once(self):
+        layer = Layer.objects.get(name="Layer")
+        ent = Entity(layer=layer, insertion={"type": "Point", "coordinates": [1, 2]})
+        with mock.patch(
+            "django_geocad.fields.geometry_bounds", wraps=geometry_bounds
+        ) as bounds:
+            ent.save()
+            self.assertEqual(bounds.call_count, 1)
+            self.assertEqual((ent.west, ent.north), (1, 2))
+            ent.geom = {"type": "LineString", "coordinates": [[3, 4], [5, 6]]}
+            ent.save()
+            self.assertEqual(bounds.call_count, 2)
+            self.assertEqual((ent.west, ent.south, ent.east, ent.north), (3, 4, 5, 6))
+
+    def test_entity_spatial_filters(self):
+        draw = Drawing.objects.get(title="Referenced")
+        entities = Entity.objects.filter(layer__drawing=draw)
+        ent = entities.filter(block__isnull=True).exclude(geom=None).first()
+        self.assertIn(ent, entities.in_bbox(ent.west, ent.south, ent.east, ent.north))
+        self.assertNotIn(ent, entities.in_bbox(0, 0, 1, 1))
+        point = shape(ent.geom).representative_point()
+        found = entities.intersects(point.buffer(1e-7).__geo_interface__)
+        self.assertIn(ent, found)
+        self.assertNotIn(
+            ent, entities.intersects({"type": "Point", "coordinates": [0, 0]})
+        )
+        # more than 111 meters north of the entity, less from the point
+        north = {"type": "Point", "coordinates": [point.x, ent.north + 0.001]}
+        self.assertNotIn(ent, entities.dwithin(north, 111))
+        distance = (ent.north + 0.001 - point.y) * 111320
+        self.assertIn(ent, entities.dwithin(north, distance + 1))
+        # with the spatial app, entities not mirrored are found all the same
+        backend = mock.patch("django_geocad.models.spatial_backend", return_value=True)
+        # nothing mirrored
+        mirror = mock.patch("django_geocad.models.mirror_filter", return_value=Q(pk=0))
+        unmirrored = mock.patch.object(EntityQuerySet, "unmirrored", lambda qs: qs)
+        with backend, mirror, unmirrored:
+            box = entities.in_bbox(ent.west, ent.south, ent.east, ent.north)
+            self.assertIn(ent, box)
+            self.assertIn(ent, entities.intersects(point.__geo_interface__))
+            self.assertIn(ent, entities.dwithin(north, distance + 1))
+            self.assertNotIn(ent, entities.dwithin(north, 111))
+        # entities created in bulk are announced, spatial app mirrors them
+        receiver = mock.Mock()
+        entities_created.connect(receiver, sender=Entity)
+        try:
+            created = draw.bulk_create_insertions(
+                [
+                    {
+                        "lat": 42.00,
+                        "long": 12.48,
+                        "block": "block",
+                        "layer": "0",
+                        "rotation": 0,
+                        "xscale": 1,
+                        "yscale": 1,
+                    }
+                ]
+            )
+        finally:
+            entities_created.disconnect(receiver, sender=Entity)
+        self.assertEqual(receiver.call_args.kwargs["entities"], created)
+
+    def test_spatial_index(self):
+        draw = Drawing.objects.get(title="Referenced")
+        index = get_index(draw)
+        self.assertIs(get_index(draw), index)
+        ent = (
+            Entity.objects.filter(layer__drawing=draw, block__isnull=True)
+            .exclude(geom=None)
+            .first()
+        )
+        vertex = shapely.get_coordinates(shape(ent.geom))[0]
+        long, lat = vertex
+        self.assertIn(ent.id, index.point_in(long, lat))
+        self.assertIn(ent.id, index.bbox(ent.west, ent.south, ent.east, ent.north))
+        self.assertEqual(index.bbox(0, 0, 1, 1), [])
+        # about 5 meters east of the vertex
+        long += 5 / (111320 * cos(radians(lat)))
+        self.assertNotIn(ent.id, index.within_distance(long, lat, 4))
+        self.assertIn(ent.id, index.within_distance(long, lat, 6))
+        self.assertLessEqual(index.nearest(long, lat)[1], 5 + 1e-6)
+        self.assertIsNone(index.nearest(0, 0, max_distance=10))
+        # nearest vertex, of this or another entity
+        snapped = index.snap(long, lat, 6)
+        offset = (snapped[0] - long) * 111320 * cos(radians(lat))
+        self.assertLessEqual(abs(offset), 5 + 1e-6)
+        self.assertAlmostEqual(snapped[1], lat, delta=5 / 111320)
+        # changed entities build a new index
+        ent.save()
+        self.assertIsNot(get_index(draw), index)
+
+    @override_settings(GEOCAD_INDEX_CACHE_SIZE=1)
+    def test_spatial_index_eviction(self):
+        draw = Drawing.objects.get(title="Referenced")
+        # no entities
+        other = Drawing(id=draw.id + 1000, geom=draw.geom)
+        index = get_index(draw)
+        get_index(other)
+        self.assertIsNot(get_index(draw), index)
+
+    def test_drawing_identify_view(self):
+        draw = Drawing.objects.get(title="Referenced")
+        ent = (
+            Entity.objects.filter(layer__drawing=draw, block__isnull=True)
+            .exclude(geom=None)
+            .first()
+        )
+        long, lat = shapely.get_coordinates(shape(ent.geom))[0]
+        url = reverse("django_geocad:drawing_identify", kwargs={"pk": draw.id})
+        data = self.client.get(url, {"lat": lat, "long": long}).json()
+        self.assertIn(ent.id, data["entities"])
+        self.assertAlmostEqual(data["snap"][0], long)
+        data = self.client.get(url, {"lat": 0, "long": 0}).json()
+        self.assertEqual(data, {"entities": [], "snap": None})
+        self.assertEqual(self.client.get(url, {"lat": "x"}).status_code, 400)
+        for value in ("nan", "inf"):
+            params = {"lat": lat, "long": long, "distance": value}
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+        # distance is capped
+        within = "django_geocad.spatial_index.DrawingIndex.within_distance"
+        with mock.patch(within, return_value=[]) as within:
+            self.client.get(url, {"lat": lat, "long": long, "distance": 1e9})
+        self.assertEqual(within.call_args.args[2], 100)
+
+    def test_entity_touch_drawing(self):
+        draw = Drawing.objects.get(title="Referenced")
+        ent = Entity.objects.filter(layer__drawing=draw).first()
+        ent = Entity.objects.get(id=ent.id)
+        # drawing of the layer, without loading it, and the new version
+        with self.assertNumQueries(2):
+            ent.touch_drawing()
+        (other,) = Drawing.objects.bulk_create([Drawing(title="Touched")])
+        self.assertEqual(drawing_version(other.id), "")
+        layer = Layer.objects.create(drawing=other, name="touched")
+        version = drawing_version(other.id)
+        Entity.objects.create(layer=layer)
+        # stored in the database, seen by all processes
+        self.assertNotEqual(drawing_version(other.id), version)
+        self.assertEqual(
+            DrawingVersion.objects.get(drawing=other).version,
+            drawing_version(other.id),
+        )
+        other.delete()
+        self.assertEqual(drawing_version(other.id), "")
+
+    def test_entity_popup_view(self):
+        cache.clear()
+        draw = Drawing.objects.get(title="Referenced")
+        ent = Entity.objects.filter(layer__drawing=draw, block__isnull=False).first()
+        url = reverse("django_geocad:entity_popup", kwargs={"pk": ent.id})
+        response = self.client.get(url)
+        self.assertContains(response, f"ID = {ent.id}")
+        self.assertContains(response, ent.block.name)
+        # cached until data change
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertContains(response, f"ID = {ent.id}")
+        EntityData.objects.create(entity=ent, key="Foo", value="Bar")
+        self.assertContains(self.client.get(url), "Foo = Bar")
+        layer = ent.layer
+        layer.name = "Renamed"
+        layer.save()
+        self.assertContains(self.client.get(url), "Renamed")
+        ent.delete()
+        self.assertEqual(self.client.get(url).status_code, 404)
 
     @skip("problems with admin views")
     def test_drawing_add_parent_in_admin(self):
@@ -614,6 +1423,9 @@ class GeoCADModelTest(TestCase):
         notref = Drawing.objects.get(title="Unreferenced")
         response = self.client.get(f"/admin/django_geocad/drawing/{notref.id}/change/")
         self.assertEqual(response.status_code, 200)
+        yesref = Drawing.objects.get(title="Referenced")
+        response = self.client.get(f"/admin/django_geocad/drawing/{yesref.id}/change/")
+        self.assertContains(response, "entities LWPOLYLINE")
 
     def test_add_block_insertion_view(self):
         # test unlogged user
@@ -669,6 +1481,57 @@ class GeoCADModelTest(TestCase):
             target_status_code=200,
         )
 
+    def test_bulk_insertion_create_view(self):
+        draw = Drawing.objects.get(title="Referenced")
+        url = reverse("django_geocad:insertion_bulk_create", kwargs={"pk": draw.id})
+        # test unlogged user
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 302)
+        self.client.login(username="boss", password="p4s5w0r6")
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, "django_geocad/entity_bulk_create.html")
+        before = Entity.objects.count()
+        response = self.client.post(
+            url,
+            {
+                "file": SimpleUploadedFile(
+                    "survey.csv",
+                    b"lat,long,block,layer\n42,12,block,0\n42.1,12.1,block,0\n",
+                    "text/csv",
+                )
+            },
+        )
+        self.assertRedirects(
+            response,
+            reverse("django_geocad:drawing_detail", kwargs={"pk": draw.id}),
+        )
+        self.assertEqual(Entity.objects.count() - before, 2)
+        # wrong block shows errors
+        response = self.client.post(
+            url,
+            {
+                "file": SimpleUploadedFile(
+                    "survey.csv", b"lat,long,block,layer\n42,12,foo,0\n", "text/csv"
+                )
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["form"].errors)
+        # so does malformed GeoJSON
+        response = self.client.post(
+            url,
+            {"file": SimpleUploadedFile("survey.geojson", b"[]", "application/json")},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["form"].errors)
+        # drawing without blocks
+        draw = Drawing.objects.get(title="Unreferenced")
+        response = self.client.get(
+            reverse("django_geocad:insertion_bulk_create", kwargs={"pk": draw.id})
+        )
+        self.assertEqual(response.status_code, 404)
+
     def test_change_block_insertion_view(self):
         # test unlogged user
         ent = Entity.objects.exclude(block=None).last()
@@ -720,6 +1583,93 @@ class GeoCADModelTest(TestCase):
             target_status_code=200,
         )
 
+    @override_settings(GEOCAD_REPLICA_DATABASE="replica")
+    def test_replica_router(self):
+        router = ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Drawing))
+        request = RequestFactory().get("/")
+
+        @read_from_replica
+        def view(request):
+            return HttpResponse(
+                f"{router.db_for_read(Entity)} {router.db_for_read(User)}"
+            )
+
+        self.assertEqual(view(request).content, b"replica None")
+        # client which just wrote reads from the primary
+        request.COOKIES[STICKY_COOKIE] = "1"
+        self.assertEqual(view(request).content, b"None None")
+        # instances read from the replica are saved to the primary
+        draw = Drawing.objects.get(title="Referenced")
+        draw._state.db = "replica"
+        self.assertEqual(router.db_for_write(Drawing, instance=draw), "default")
+        self.assertTrue(router.allow_relation(draw, Layer.objects.first()))
+        # models of other apps are left to other routers
+        user = User.objects.first()
+        user._state.db = "replica"
+        self.assertIsNone(router.db_for_write(User, instance=user))
+        self.assertIsNone(router.allow_relation(user, Group.objects.first()))
+        # unsaved instances have no database
+        self.assertIsNone(router.db_for_write(Drawing, instance=Drawing()))
+        self.assertIsNone(router.allow_relation(Drawing(), Layer()))
+
+    def test_replica_router_unset(self):
+        router = ReplicaRouter()
+        draw = Drawing.objects.get(title="Referenced")
+        self.assertIsNone(router.db_for_write(Drawing, instance=draw))
+        self.assertIsNone(router.db_for_write(Drawing, instance=Drawing()))
+        self.assertIsNone(router.allow_relation(Drawing(), Layer()))
+        self.assertIsNone(router.allow_relation(draw, Layer.objects.first()))
+
+    @override_settings(
+        GEOCAD_REPLICA_DATABASE="default",
+        DATABASE_ROUTERS=["django_geocad.routers.ReplicaRouter"],
+    )
+    def test_replica_sticky_primary(self):
+        ent = Entity.objects.exclude(block=None).last()
+        draw = ent.layer.drawing
+        response = self.client.get(
+            reverse("django_geocad:drawing_detail", kwargs={"pk": draw.id})
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+        self.client.login(username="boss", password="p4s5w0r6")
+        response = self.client.post(
+            reverse("django_geocad:insertion_change", kwargs={"pk": ent.id}),
+            {
+                "layer": ent.layer.id,
+                "block": ent.block.id,
+                "rotation": 0,
+                "xscale": 1,
+                "yscale": 1,
+                "lat": 42,
+                "long": 12,
+            },
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.cookies[STICKY_COOKIE]["max-age"], 10)
+        # drawings saved in the admin
+        self.client.cookies.pop(STICKY_COOKIE)
+        response = self.client.post(
+            f"/admin/django_geocad/drawing/{draw.id}/change/",
+            {
+                "title": draw.title,
+                "parent": "",
+                "dxf": "",
+                "image": "",
+                "geom": json.dumps(draw.geom),
+                "designx": draw.designx,
+                "designy": draw.designy,
+                "rotation": draw.rotation,
+                "related_layers-TOTAL_FORMS": 0,
+                "related_layers-INITIAL_FORMS": 0,
+                "import_reports-TOTAL_FORMS": 0,
+                "import_reports-INITIAL_FORMS": 0,
+            },
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(STICKY_COOKIE, response.cookies)
+
     def test_entity_create_form(self):
         ent = Entity.objects.exclude(block=None).last()
         form = EntityCreateForm(
@@ -877,8 +1827,60 @@ class GeoCADModelTest(TestCase):
         layer2.save()
         self.assertNotEqual(layer2.name, "Layer")
 
+    def test_layer_constraints_long_name(self):
+        draw = Drawing.objects.get(title="Referenced")
+        name = "L" * 50
+        layer = Layer.objects.create(drawing=draw, name=name)
+        layer2 = Layer.objects.create(drawing=draw, name=name)
+        self.assertNotEqual(layer2.name, name)
+        self.assertTrue(layer2.name.startswith("L" * 42 + "_"))
+        # same name for layer and block is fine
+        block = Layer.objects.create(drawing=draw, name=name, is_block=True)
+        self.assertEqual(block.name, name)
+        # saving again keeps the name, without checking siblings or popups
+        with self.assertNumQueries(3):
+            layer.save()
+        self.assertEqual(layer.name, name)
+        # names taken after the check are renamed on IntegrityError
+        layer3 = Layer.objects.create(drawing=draw, name="Other")
+        layer3.name = name
+        with mock.patch.object(Layer, "changed", return_value=False):
+            layer3.save()
+        self.assertTrue(layer3.name.startswith("L" * 42 + "_"))
+
+    def test_materialize_layers(self):
+        draw = Drawing.objects.get(title="Referenced")
+        existing = Layer.objects.get(drawing=draw, name="Layer")
+        long_name = "M" * 60
+        # update of the existing layer clears popups of its entities
+        with self.assertNumQueries(5):
+            layers = draw.materialize_layers(
+                {
+                    "Layer": {"color_field": "#000000"},
+                    "New": {"color_field": "#FF0000"},
+                    long_name: {},
+                    long_name + "2": {},
+                }
+            )
+        # existing layers are kept, with new defaults
+        self.assertEqual(layers["Layer"], existing)
+        existing.refresh_from_db()
+        self.assertEqual(existing.color_field, "#000000")
+        self.assertEqual(layers["New"].color_field, "#FF0000")
+        self.assertIsNotNone(layers["New"].id)
+        # truncated names are made unique
+        self.assertEqual(layers[long_name].name, "M" * 50)
+        self.assertNotEqual(layers[long_name + "2"].name, "M" * 50)
+        self.assertEqual(len(layers[long_name + "2"].name), 50)
+        # second call finds everything
+        with self.assertNumQueries(1):
+            again = draw.materialize_layers({"New": {}})
+        self.assertEqual(again["New"], layers["New"])
+
     def test_prepare_dxf_to_download(self):
         draw = Drawing.objects.get(title="Referenced")
+        # uploaded file with geodata is served as it is
+        self.assertEqual(draw.prepare_dxf_to_download(), draw.dxf.path)
         layer = Layer.objects.get(drawing=draw, name="0")
         block = Layer.objects.filter(drawing=draw, is_block=True).last()
         self.assertEqual(block.name, "block")
@@ -886,19 +1888,30 @@ class GeoCADModelTest(TestCase):
             layer=layer,
             block=block,
             insertion={"type": "Point", "coordinates": [12.48, 42.00]},
-            data={
-                "processed": "true",
-                "added": "true",
-            },
+            added=True,
         )
         EntityData.objects.create(
             entity=ent,
             key="Foo",
             value="Bar",
         )
-        draw.prepare_dxf_to_download()
+        with open(draw.dxf.path, "rb") as f:
+            content = f.read()
+        path = draw.prepare_dxf_to_download()
+        with open(draw.dxf.path, "rb") as f:
+            self.assertEqual(f.read(), content)
+        ent = Entity.objects.get(id=ent.id)
+        self.assertTrue(ent.added)
+        doc = ezdxf.readfile(path)
+        self.assertEqual(doc.entitydb[ent.handle].dxftype(), "INSERT")
+        # written insertion is matched when the file is uploaded again
+        with open(path, "rb") as f:
+            draw.dxf = SimpleUploadedFile("yesgeo.dxf", f.read(), "image/x-dxf")
+        draw.save()
         ent = Entity.objects.get(id=ent.id)
-        self.assertEqual(ent.data["added"], "false")
+        self.assertFalse(ent.added)
+        self.assertEqual(ent.related_data.get(key="Foo").value, "Bar")
+        self.assertEqual(Entity.objects.filter(handle=ent.handle).count(), 1)
 
     def test_prepare_dxf_to_download_new_layer(self):
         draw = Drawing.objects.get(title="Referenced")
@@ -909,11 +1922,265 @@ class GeoCADModelTest(TestCase):
             layer=layer,
             block=block,
             insertion={"type": "Point", "coordinates": [12.48, 42.00]},
-            data={
-                "processed": "true",
-                "added": "true",
-            },
+            added=True,
         )
-        draw.prepare_dxf_to_download()
+        path = draw.prepare_dxf_to_download()
         ent = Entity.objects.get(id=ent.id)
-        self.assertEqual(ent.data["added"], "false")
+        block_ref = ezdxf.readfile(path).entitydb[ent.handle]
+        self.assertEqual(block_ref.dxf.layer, "New layer")
+
+    def test_streaming_handles(self):
+        doc = ezdxf.new()
+        msp = doc.modelspace()
+        for i in range(20):
+            msp.add_line((i, 0), (i, 1))
+        path = Path(settings.MEDIA_ROOT).joinpath("handles.dxf")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        doc.saveas(path)
+        # stale handle seed, lower than entity handles
+        text = path.read_text()
+        seed = doc.header["$HANDSEED"]
+        path.write_text(
+            text.replace(f"$HANDSEED\n  5\n{seed}\n", "$HANDSEED\n  5\n1\n")
+        )
+        skeleton = read_skeleton(path)
+        skeleton.modelspace().add_line((0, 2), (1, 2))
+        save_with_entities(skeleton, path)
+        handles = [e.dxf.handle for e in ezdxf.readfile(path).modelspace()]
+        path.unlink()
+        self.assertEqual(len(handles), 21)
+        self.assertEqual(len(set(handles)), 21)
+
+    @override_settings(GEOCAD_STREAMING_IMPORT=True)
+    def test_streaming_differential_import(self):
+        draw = Drawing.objects.get(title="Referenced")
+        entities = Entity.objects.filter(layer__drawing=draw)
+        kept = entities.get(handle="366")
+        removed = entities.get(handle="3B9")
+        doc = ezdxf.readfile(draw.dxf.path)
+        polyline = doc.entitydb["3A7"]
+        polyline.set_points([(x + 1, y, *rest) for x, y, *rest in polyline])
+        doc.modelspace().delete_entity(doc.entitydb["3B9"])
+        stream = StringIO()
+        doc.write(stream)
+        draw.dxf = SimpleUploadedFile(
+            "yesgeo.dxf", stream.getvalue().encode(), "image/x-dxf"
+        )
+        # entities are written in batches while the file is read
+        flush = mock.patch.object(
+            ImportDiff, "flush", autospec=True, side_effect=ImportDiff.flush
+        )
+        with mock.patch.object(ImportDiff, "batch_size", 1), flush as flush:
+            draw.save()
+        self.assertGreater(flush.call_count, 1)
+        self.assertEqual(entities.get(handle="366").id, kept.id)
+        self.assertFalse(entities.filter(id=removed.id).exists())
+        self.assertEqual(entities.filter(handle="3A7").count(), 1)
+
+    @override_settings(GEOCAD_STREAMING_IMPORT=True)
+    def test_streaming_import(self):
+        dxf_path = Path(settings.BASE_DIR).joinpath("tests/static/tests/yesgeo.dxf")
+        with open(dxf_path, "rb") as f:
+            content = f.read()
+        draw = Drawing()
+        draw.title = "Streamed"
+        draw.dxf = SimpleUploadedFile("yesgeo.dxf", content, "image/x-dxf")
+        draw.save()
+        ref = Drawing.objects.get(title="Referenced")
+        self.assertEqual(draw.epsg, ref.epsg)
+
+        def summary(drawing):
+            entities = Entity.objects.filter(layer__drawing=drawing).exclude(
+                layer__name="Layer"
+            )
+            return (
+                sorted(
+                    entities.values_list("layer__name", "block__name"),
+                    key=str,
+                ),
+                sorted(
+                    EntityData.objects.filter(entity__in=entities).values_list(
+                        "key", "value"
+                    )
+                ),
+            )
+
+        self.assertEqual(summary(draw), summary(ref))
+        names = [s["name"] for s in draw.import_reports.get().stages]
+        self.assertIn("texts", names)
+        self.assertIn("entities", names)
+        # file is not rewritten when geodata changes
+        self.assertTrue(draw.dxf_georeferenced)
+        draw.designx = 10
+        draw.save()
+        self.assertFalse(draw.dxf_georeferenced)
+        msp = ezdxf.readfile(draw.dxf.path).modelspace()
+        self.assertEqual(msp.get_geodata().dxf.design_point[0], 0)
+        self.assertEqual(summary(draw), summary(ref))
+        # new insertions are added to streamed entities, with geodata
+        Entity.objects.create(
+            layer=Layer.objects.get(drawing=draw, name="0"),
+            block=Layer.objects.get(drawing=draw, is_block=True, name="block"),
+            insertion={"type": "Point", "coordinates": [12.48, 42.00]},
+            added=True,
+        )
+        path = draw.prepare_dxf_to_download()
+        msp = ezdxf.readfile(path).modelspace()
+        self.assertEqual(len(msp.query("INSERT")), 3)
+        self.assertEqual(len(msp.query("LWPOLYLINE")), 2)
+        self.assertEqual(msp.get_geodata().dxf.design_point[0], 10)
+        msp = ezdxf.readfile(draw.dxf.path).modelspace()
+        self.assertEqual(msp.get_geodata().dxf.design_point[0], 0)
+
+    @override_settings(GEOCAD_DEDUPLICATE_INSERTIONS=True)
+    def test_deduplicated_insertions(self):
+        dxf_path = Path(settings.BASE_DIR).joinpath("tests/static/tests/yesgeo.dxf")
+        with open(dxf_path, "rb") as f:
+            content = f.read()
+        draw = Drawing()
+        draw.title = "Deduplicated"
+        draw.dxf = SimpleUploadedFile("yesgeo.dxf", content, "image/x-dxf")
+        draw.save()
+        ref = Drawing.objects.get(title="Referenced")
+        insertions = Entity.objects.filter(
+            layer__drawing=draw, block__isnull=False
+        ).order_by("id")
+        self.assertEqual(insertions.count(), 2)
+        self.assertFalse(insertions.exclude(geom=None).exists())
+        # new insertions are stored without geometry too
+        Entity.objects.create(
+            layer=Layer.objects.get(drawing=draw, name="0"),
+            block=Layer.objects.get(drawing=draw, is_block=True, name="block"),
+            insertion={"type": "Point", "coordinates": [12.48, 42.00]},
+            added=True,
+        )
+        self.assertEqual(insertions.count(), 3)
+        self.assertFalse(insertions.exclude(geom=None).exists())
+        # expanded geometry matches the one stored in full
+        expanded = draw.expand_insertions(insertions.select_related("block"))
+        stored = Entity.objects.filter(
+            layer__drawing=ref, block__isnull=False
+        ).order_by("id")
+        for ent, ref_ent in zip(expanded, stored):
+            self.assertTrue(
+                shape(ent.geom).equals_exact(shape(ref_ent.geom), tolerance=1e-6)
+            )
+        self.assertIsNotNone(expanded[2].geom)
+        # views serialize expanded geometry
+        self.client.login(username="boss", password="p4s5w0r6")
+        layer = insertions.first().layer
+        response = self.client.get(
+            reverse("django_geocad:layer_entities", kwargs={"pk": layer.id})
+        )
+        for feature in response.json()["features"]["features"]:
+            self.assertIsNotNone(feature["geometry"])
+        # layer extents come from insertion points
+        summary = {s["id"]: s for s in draw.get_layer_summary()}
+        self.assertIsNotNone(summary[layer.id]["bounds"])
+
+    @override_settings(GEOCAD_CLIENT_INSTANCING=True)
+    def test_block_instances(self):
+        draw = Drawing.objects.get(title="Referenced")
+        entities = Entity.objects.filter(layer__drawing=draw, layer__is_block=False)
+        lines, instances = draw.get_block_instances(
+            entities.select_related("layer", "block")
+        )
+        self.assertFalse([e for e in lines if e.block_id])
+        self.assertEqual(len(instances["insertions"]), 2)
+        self.assertIn("block", [b["name"] for b in instances["blocks"]])
+        # placing templates as the map does gives stored geometry
+        matrix = np.array(instances["matrix"])
+        for row in instances["insertions"]:
+            long, lat, rotation, xscale, yscale, layer, block, pk = row
+            k = cos(radians(instances["latitude"])) / cos(radians(lat))
+            a = radians(rotation)
+            wcs = np.array(
+                [
+                    [cos(a) * xscale, -sin(a) * yscale],
+                    [sin(a) * xscale, cos(a) * yscale],
+                ]
+            )
+            geo = np.diag([k, 1]) @ matrix @ wcs
+            template = shapely.from_geojson(
+                [json.dumps(g) for g in instances["blocks"][block]["geometries"]]
+            )
+            placed = shapely.transform(template, lambda c: c @ geo.T + [long, lat])
+            stored = shape(Entity.objects.get(id=pk).geom)
+            self.assertTrue(
+                GeometryCollection(list(placed)).equals_exact(stored, tolerance=1e-7)
+            )
+        self.client.login(username="boss", password="p4s5w0r6")
+        response = self.client.get(
+            reverse("django_geocad:drawing_detail", kwargs={"pk": draw.id})
+        )
+        self.assertContains(response, "instance_layer.js")
+        ent = Entity.objects.get(id=instances["insertions"][0][7])
+        response = self.client.get(
+            reverse("django_geocad:layer_entities", kwargs={"pk": ent.layer_id})
+        )
+        data = response.json()
+        self.assertIn(ent.id, [row[7] for row in data["instances"]["insertions"]])
+        self.assertNotIn(ent.id, [f["id"] for f in data["features"]["features"]])
+
+
+@override_settings(
+    MEDIA_ROOT=Path(settings.MEDIA_ROOT).joinpath("tests"),
+    GEOCAD_IMPORT_ON_COMMIT=True,
+)
+class GeoCADImportOnCommitTest(TransactionTestCase):
+    serialized_rollback = True
+
+    def setUp(self):
+        dxf_path = Path(settings.BASE_DIR).joinpath("tests/static/tests/yesgeo.dxf")
+        with open(dxf_path, "rb") as f:
+            content = f.read()
+        self.draw = Drawing(title="Referenced")
+        self.draw.dxf = SimpleUploadedFile("yesgeo.dxf", content, "image/x-dxf")
+        # no transaction, imported at once
+        self.draw.save()
+
+    def tearDown(self):
+        Path(self.draw.dxf.path).unlink(missing_ok=True)
+
+    def test_import_on_commit(self):
+        self.assertTrue(Layer.objects.filter(drawing=self.draw).exists())
+        self.draw.designx = 10
+        with mock.patch.object(Drawing, "extract_dxf") as extract:
+            with transaction.atomic():
+                self.draw.save()
+                # the lock is taken once the save is committed
+                extract.assert_not_called()
+                self.assertFalse(
+                    ImportLock.objects.filter(
+                        drawing=self.draw, started__isnull=False
+                    ).exists()
+                )
+        extract.assert_called_once_with(None, refresh=True, diff=False)
+        self.assertIsNone(ImportLock.objects.get(drawing=self.draw).started)
+
+    def test_save_queued_while_importing(self):
+        def concurrent_save(*args, **kwargs):
+            if extract.call_count > 1:
+                return
+            # another admin saves while the import runs
+            with transaction.atomic():
+                other = Drawing.objects.get(id=self.draw.id)
+                other.designy = 20
+                other.save()
+            # it sees the lock and queues its import
+            lock = ImportLock.objects.get(drawing=self.draw)
+            self.assertEqual(lock.queued, "fields")
+
+        extract = mock.patch.object(Drawing, "extract_dxf", side_effect=concurrent_save)
+        with extract as extract:
+            with transaction.atomic():
+                self.draw.designx = 10
+                self.draw.save()
+        # the running import extracts the queued one
+        self.assertEqual(extract.call_count, 2)
+        extract.assert_called_with(refresh=True, diff=False)
+        self.draw.refresh_from_db()
+        self.assertEqual((self.draw.designx, self.draw.designy), (10, 20))
+        lock = ImportLock.objects.get(drawing=self.draw)
+        self.assertIsNone(lock.started)
+        self.assertEqual(lock.queued, "")
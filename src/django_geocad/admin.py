@@ -1,13 +1,15 @@
 from django.contrib import admin, messages
+from django.utils.html import format_html, format_html_join
 from django.utils.translation import gettext_lazy as _
 from leaflet.admin import LeafletGeoAdmin
 
-from .models import Drawing, Layer
+from .models import Drawing, ImportReport, Layer
+from .routers import stick_to_primary
 
 
 class LayerInline(admin.TabularInline):
     model = Layer
-    fields = ("name", "color_field", "linetype")
+    fields = ("name", "color_field", "linetype", "visible")
     extra = 0
 
     def get_queryset(self, request):
@@ -15,6 +17,58 @@ class LayerInline(admin.TabularInline):
         return qs.exclude(is_block=True)
 
 
+class ImportReportInline(admin.TabularInline):
+    model = ImportReport
+    fields = (
+        "created",
+        "total_time",
+        "queries",
+        "entities",
+        "vertices",
+        "peak_memory",
+        "stages_table",
+    )
+    readonly_fields = fields
+    extra = 0
+    can_delete = True
+    classes = ("collapse",)
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    @admin.display(description=_("Stages"))
+    def stages_table(self, obj):
+        rows = format_html_join(
+            "",
+            "<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td>"
+            "<td>{}</td><td>{}</td><td>{}</td></tr>",
+            (
+                (
+                    s["name"],
+                    round(s["time"], 3),
+                    s["queries"],
+                    round(s["db_time"], 3),
+                    s["entities"],
+                    "-" if s["vertices"] is None else s["vertices"],
+                    s["peak_memory"] or "-",
+                )
+                for s in obj.stages
+            ),
+        )
+        return format_html(
+            "<table><tr><th>{}</th><th>{}</th><th>{}</th><th>{}</th><th>{}</th>"
+            "<th>{}</th><th>{}</th></tr>{}</table>",
+            _("Stage"),
+            _("Time (s)"),
+            _("Queries"),
+            _("DB time (s)"),
+            _("Entities"),
+            _("Vertices"),
+            _("Peak memory"),
+            rows,
+        )
+
+
 @admin.register(Drawing)
 class DrawingAdmin(LeafletGeoAdmin):
     list_display = (
@@ -23,6 +77,7 @@ class DrawingAdmin(LeafletGeoAdmin):
     )
     inlines = [
         LayerInline,
+        ImportReportInline,
     ]
 
     def save_model(self, request, obj, form, change):
@@ -36,3 +91,15 @@ class DrawingAdmin(LeafletGeoAdmin):
                     a Parent Drawing or select a Reference Point on the map"""
                 ),
             )
+
+    # saved drawings are read from the primary, see routers
+    def response_add(self, request, obj, post_url_continue=None):
+        response = super().response_add(request, obj, post_url_continue)
+        return stick_to_primary(request, response)
+
+    def response_change(self, request, obj):
+        return stick_to_primary(request, super().response_change(request, obj))
+
+    def response_delete(self, request, obj_display, obj_id):
+        response = super().response_delete(request, obj_display, obj_id)
+        return stick_to_primary(request, response)
@@ -0,0 +1,110 @@
+import json
+
+from django.db import models
+
+
+class SanitizedField(models.TextField):
+    """
+    Copy of the `source` field of the same model, cleaned with `nh3` when
+    the instance is saved (also by `bulk_create`), so that HTML is rendered
+    without sanitizing it again. Saving with `update_fields` must list both
+    fields, queryset updates and `bulk_update` do not refresh the copy.
+    """
+
+    def __init__(self, *args, source=None, **kwargs):
+        self.source = source
+        kwargs.setdefault("editable", False)
+        kwargs.setdefault("default", "")
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs["source"] = self.source
+        # defaults of this field are not repeated
+        if kwargs.get("editable") is False:
+            del kwargs["editable"]
+        if kwargs.get("default") == "":
+            del kwargs["default"]
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        import nh3
+
+        source = getattr(model_instance, self.source)
+        value = nh3.clean("" if source is None else str(source))
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+def geometry_bounds(geometry):
+    """Returns (west, south, east, north) of a GeoJSON geometry, or None"""
+    xs = []
+    ys = []
+
+    def collect(coords):
+        if coords and isinstance(coords[0], (int, float)):
+            xs.append(coords[0])
+            ys.append(coords[1])
+        else:
+            for item in coords:
+                collect(item)
+
+    geometries = [geometry]
+    while geometries:
+        item = geometries.pop()
+        geometries.extend(item.get("geometries", []))
+        collect(item.get("coordinates", []))
+    if not xs:
+        return None
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+class BoundsField(models.FloatField):
+    """
+    One `side` (west, south, east or north) of the bounding box of the
+    `source` GeoJSON field of the same model, or of the `fallback` field if
+    source is empty, computed when the instance is saved (also by
+    `bulk_create`). Same caveats of `SanitizedField` for updates.
+    """
+
+    sides = ("west", "south", "east", "north")
+
+    def __init__(self, *args, source=None, fallback=None, side=None, **kwargs):
+        self.source = source
+        self.fallback = fallback
+        self.side = side
+        kwargs.setdefault("editable", False)
+        kwargs.setdefault("null", True)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs["source"] = self.source
+        kwargs["fallback"] = self.fallback
+        kwargs["side"] = self.side
+        # defaults of this field are not repeated
+        if kwargs.get("editable") is False:
+            del kwargs["editable"]
+        if kwargs.get("null") is True:
+            del kwargs["null"]
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        geometry = getattr(model_instance, self.source)
+        if not geometry and self.fallback:
+            geometry = getattr(model_instance, self.fallback)
+        # sides are saved in a row: bounds are computed once by the first
+        # side (west) and dropped by the last one (north)
+        key = (self.source, self.fallback)
+        computed = model_instance.__dict__.setdefault("_geocad_bounds", {})
+        cached = computed.get(key)
+        if self.side == self.sides[0] or cached is None or cached[0] is not geometry:
+            parsed = json.loads(geometry) if isinstance(geometry, str) else geometry
+            cached = (geometry, geometry_bounds(parsed) if parsed else None)
+            computed[key] = cached
+        if self.side == self.sides[-1]:
+            del computed[key]
+        bounds = cached[1]
+        value = bounds[self.sides.index(self.side)] if bounds else None
+        setattr(model_instance, self.attname, value)
+        return value
@@ -0,0 +1,116 @@
+import csv
+import json
+from io import StringIO
+
+from django.utils.translation import gettext_lazy as _
+
+# CSV columns / GeoJSON properties that are not block attributes
+INSERTION_FIELDS = [
+    "lat",
+    "long",
+    "block",
+    "layer",
+    "rotation",
+    "scale",
+    "xscale",
+    "yscale",
+    "attributes",
+]
+
+
+def read_insertions(content, filename):
+    """
+    Reads block insertions from CSV or GeoJSON content (bytes or str),
+    format is guessed from filename extension. Returns a list of
+    dictionaries suitable for `Drawing.bulk_create_insertions`, raises
+    `ValueError` listing all invalid rows.
+    """
+
+    if isinstance(content, bytes):
+        content = content.decode("utf-8-sig")
+    extension = filename.rsplit(".", 1)[-1].lower()
+    if extension == "csv":
+        records = list(csv.DictReader(StringIO(content)))
+    elif extension in ["geojson", "json"]:
+        records = read_geojson(content)
+    else:
+        raise ValueError(_("Unsupported file format: %s") % extension)
+    rows = []
+    errors = []
+    for i, record in enumerate(records, start=1):
+        try:
+            rows.append(prepare_row(record))
+        except (KeyError, TypeError, ValueError) as e:
+            errors.append(_("Row %(row)s: %(error)s") % {"row": i, "error": e})
+    if errors:
+        raise ValueError("; ".join(errors))
+    return rows
+
+
+def read_geojson(content):
+    collection = json.loads(content)
+    if not isinstance(collection, dict):
+        raise ValueError(_("GeoJSON must be a Feature or a FeatureCollection"))
+    if collection.get("type") == "Feature":
+        collection = {"features": [collection]}
+    features = collection.get("features", [])
+    if not isinstance(features, list):
+        raise ValueError(_("GeoJSON features must be a list"))
+    records = []
+    for i, feature in enumerate(features, start=1):
+        try:
+            records.append(read_feature(feature))
+        except ValueError as e:
+            raise ValueError(
+                _("Feature %(feature)s: %(error)s") % {"feature": i, "error": e}
+            )
+    return records
+
+
+def read_feature(feature):
+    if not isinstance(feature, dict):
+        raise ValueError(_("Features must be objects"))
+    geometry = feature.get("geometry")
+    if not isinstance(geometry, dict) or geometry.get("type") != "Point":
+        raise ValueError(_("Only Point features can be imported"))
+    coordinates = geometry.get("coordinates")
+    if not isinstance(coordinates, list) or len(coordinates) < 2:
+        raise ValueError(_("Invalid coordinates"))
+    properties = feature.get("properties") or {}
+    if not isinstance(properties, dict):
+        raise ValueError(_("Properties must be an object"))
+    record = dict(properties)
+    record["long"], record["lat"] = coordinates[:2]
+    return record
+
+
+def prepare_row(record):
+    lat = float(record["lat"])
+    long = float(record["long"])
+    if lat > 90 or lat < -90 or long > 180 or long < -180:
+        raise ValueError(_("Invalid coordinates"))
+    if not record.get("block") or not record.get("layer"):
+        raise ValueError(_("Block and layer are required"))
+    scale = float(record.get("scale") or 1)
+    row = {
+        "lat": lat,
+        "long": long,
+        "block": str(record["block"]),
+        "layer": str(record["layer"]),
+        "rotation": float(record.get("rotation") or 0),
+        "xscale": float(record.get("xscale") or scale),
+        "yscale": float(record.get("yscale") or scale),
+        "attributes": {},
+    }
+    # GeoJSON may nest attributes, CSV uses extra columns
+    attributes = record.get("attributes") or {}
+    if isinstance(attributes, str):
+        attributes = json.loads(attributes)
+    if not isinstance(attributes, dict):
+        raise ValueError(_("Attributes must be an object"))
+    for key, value in record.items():
+        if key not in INSERTION_FIELDS and key and value not in (None, ""):
+            row["attributes"][key] = str(value)
+    for key, value in attributes.items():
+        row["attributes"][key] = str(value)
+    return row
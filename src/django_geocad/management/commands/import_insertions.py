@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from django_geocad.importers import read_insertions
+from django_geocad.models import Drawing
+
+
+class Command(BaseCommand):
+    help = """
+        Imports block insertions into a drawing from a CSV or GeoJSON file.
+        CSV files need a header with 'lat', 'long', 'block' and 'layer'
+        columns, optional 'rotation', 'scale', 'xscale' and 'yscale' columns,
+        any other column is stored as a block attribute. GeoJSON files need
+        Point features with the same keys as properties.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument("drawing", type=int, help="ID of the drawing")
+        parser.add_argument("file", help="Path of the CSV / GeoJSON file")
+
+    def handle(self, *args, **options):
+        try:
+            drawing = Drawing.objects.get(id=options["drawing"])
+        except Drawing.DoesNotExist:
+            raise CommandError("Drawing does not exist.")
+        if not drawing.epsg:
+            raise CommandError("Drawing has no GeoData.")
+        try:
+            with open(options["file"], "rb") as f:
+                rows = read_insertions(f.read(), options["file"])
+            entities = drawing.bulk_create_insertions(rows)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"Created {len(entities)} insertions.")
@@ -1,8 +1,13 @@
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
 
-from django_geocad.models import Entity, EntityData, Layer
+from django_geocad.models import Drawing, Entity, EntityData, Layer
 
 
 class Command(BaseCommand):
@@ -12,56 +17,197 @@ class Command(BaseCommand):
         - 'block' field from the data['block'] key
         - 'xscale' field from the data['xscale'] key
         ...
-        It also generates EntityData entries with attribute key/values
+        It also generates EntityData entries with attribute key/values.
+        Entities are processed drawing by drawing in keyset paginated
+        batches, progress can be stored in a checkpoint file to resume
+        interrupted runs, and drawings can be spread over worker processes
+        (each worker stores progress of its drawing in a file next to the
+        checkpoint file, so that runs resume from the last batch).
     """
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=1000,
+            help="Number of entities processed (and committed) per batch",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="JSON file where progress is stored, existing file is resumed",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Number of worker processes (POSIX only), drawings are split",
+        )
+
     def handle(self, *args, **options):
         if settings.DEBUG is False:
             raise CommandError("This command cannot be run when DEBUG is False.")
+        if options["chunk_size"] < 1 or options["workers"] < 1:
+            raise CommandError("Chunk size and workers must be positive integers.")
+        if (
+            options["workers"] > 1
+            and "fork" not in multiprocessing.get_all_start_methods()
+        ):
+            raise CommandError("Worker processes are not supported on this OS.")
         self.stdout.write(
             "Moving Data from Entity JSONField to corresponding fields / models"
         )
-        populate_fields()
-
+        checkpoint = Checkpoint(options["checkpoint"])
+        if checkpoint.done:
+            self.stdout.write(f"Resuming, {len(checkpoint.done)} drawings done.")
+        drawings = [
+            d
+            for d in Drawing.objects.order_by("id").values_list("id", flat=True)
+            if d not in checkpoint.done
+        ]
+        count = 0
+        if options["workers"] == 1:
+            for drawing_id in drawings:
+                count += populate_fields(
+                    drawing_id, options["chunk_size"], checkpoint=checkpoint
+                )
+                checkpoint.complete(drawing_id)
+        else:
+            # forked workers must not share the parent connections
+            connections.close_all()
+            # workers inherit the configured Django setup
+            with ProcessPoolExecutor(
+                max_workers=options["workers"],
+                mp_context=multiprocessing.get_context("fork"),
+            ) as executor:
+                jobs = executor.map(
+                    _populate_drawing,
+                    drawings,
+                    [options["chunk_size"]] * len(drawings),
+                    [checkpoint.last_pk(d) for d in drawings],
+                    [checkpoint.part(d) for d in drawings],
+                )
+                for drawing_id, processed in zip(drawings, jobs):
+                    count += processed
+                    checkpoint.complete(drawing_id)
+        checkpoint.clear()
+        self.stdout.write(f"Processed {count} entities.")
         self.stdout.write("Done.")
 
 
-def populate_fields():
-    for ent in Entity.objects.all():
+class Checkpoint:
+    """
+    Progress of the command, stored as JSON if a path is given: drawings
+    that are done and last processed entity id for the running ones.
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        self.done = set()
+        self.running = {}
+        if self.path and self.path.exists():
+            with open(self.path) as f:
+                data = json.load(f)
+            self.done = set(data.get("done", []))
+            self.running = data.get("running", {})
+
+    def last_pk(self, drawing_id):
+        return self.running.get(str(drawing_id), 0)
+
+    def update(self, drawing_id, pk):
+        self.running[str(drawing_id)] = pk
+        self.write()
+
+    def complete(self, drawing_id):
+        self.running.pop(str(drawing_id), None)
+        self.done.add(drawing_id)
+        self.write()
+        part = self.part(drawing_id)
+        if part and part.exists():
+            part.unlink()
+
+    def part(self, drawing_id):
+        """Checkpoint file of a drawing processed by a worker"""
+        if not self.path:
+            return None
+        return self.path.with_suffix(f"{self.path.suffix}.{drawing_id}")
+
+    def write(self):
+        if not self.path:
+            return
+        # write aside and rename, so a crash never leaves a broken file
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"done": sorted(self.done), "running": self.running}, f)
+        tmp.replace(self.path)
+
+    def clear(self):
+        if self.path and self.path.exists():
+            self.path.unlink()
+
+
+def _populate_drawing(drawing_id, chunk_size, last_pk, path):
+    # runs in worker processes, resumes from the checkpoint of the drawing
+    checkpoint = Checkpoint(path)
+    if not checkpoint.last_pk(drawing_id):
+        checkpoint.running[str(drawing_id)] = last_pk
+    processed = populate_fields(drawing_id, chunk_size, checkpoint=checkpoint)
+    connections.close_all()
+    return processed
+
+
+def get_block_map(drawing_id):
+    """Maps layer names to layers of the drawing, blocks take precedence"""
+    block_map = {}
+    layers = Layer.objects.filter(drawing_id=drawing_id).order_by("is_block", "id")
+    for layer in layers:
+        block_map[layer.name] = layer
+    return block_map
+
+
+def populate_fields(drawing_id, chunk_size=1000, checkpoint=None):
+    if not checkpoint:
+        checkpoint = Checkpoint()
+    block_map = get_block_map(drawing_id)
+    entities = Entity.objects.filter(
+        layer__drawing_id=drawing_id, processed=False
+    ).order_by("id")
+    last_pk = checkpoint.last_pk(drawing_id)
+    processed = 0
+    while True:
+        batch = list(entities.filter(id__gt=last_pk)[:chunk_size])
+        if not batch:
+            return processed
+        with transaction.atomic():
+            processed += populate_batch(batch, block_map)
+        last_pk = batch[-1].id
+        checkpoint.update(drawing_id, last_pk)
+
+
+def populate_batch(batch, block_map):
+    to_update = []
+    entity_data = []
+    for ent in batch:
         if ent.data:
-            if "processed" in ent.data:
-                continue
-            elif "Block" in ent.data:
-                try:
-                    block = Layer.objects.get(
-                        name=ent.data["Block"], drawing=ent.layer.drawing
-                    )
-                    ent.block = block
-                    if "X scale" in ent.data:
-                        ent.xscale = ent.data["X scale"]
-                    if "Y scale" in ent.data:
-                        ent.yscale = ent.data["Y scale"]
-                    if "Rotation" in ent.data:
-                        ent.rotation = ent.data["Rotation"]
-                    ent.data["processed"] = "true"
-                    ent.save()
-                    if "attributes" in ent.data:
-                        for key, value in ent.data["attributes"].items():
-                            EntityData.objects.create(
-                                entity=ent,
-                                key=key,
-                                value=value,
-                            )
+            if "Block" in ent.data:
+                if ent.data["Block"] not in block_map:
                     continue
-                except ObjectDoesNotExist:
-                    continue
-            for key, value in ent.data.items():
-                EntityData.objects.create(
-                    entity=ent,
-                    key=key,
-                    value=value,
-                )
-        else:
-            ent.data = {}
-        ent.data["processed"] = "true"
-        ent.save()
+                ent.block = block_map[ent.data["Block"]]
+                if "X scale" in ent.data:
+                    ent.xscale = ent.data["X scale"]
+                if "Y scale" in ent.data:
+                    ent.yscale = ent.data["Y scale"]
+                if "Rotation" in ent.data:
+                    ent.rotation = ent.data["Rotation"]
+                if "attributes" in ent.data:
+                    for key, value in ent.data["attributes"].items():
+                        entity_data.append(EntityData(entity=ent, key=key, value=value))
+            else:
+                for key, value in ent.data.items():
+                    entity_data.append(EntityData(entity=ent, key=key, value=value))
+        ent.processed = True
+        to_update.append(ent)
+    Entity.objects.bulk_update(
+        to_update, ["block", "xscale", "yscale", "rotation", "processed"]
+    )
+    EntityData.objects.bulk_create(entity_data)
+    return len(to_update)
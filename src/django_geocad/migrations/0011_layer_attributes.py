@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:08
+
+from django.db import migrations, models
+
+
+def populate_attributes(apps, schema_editor):
+    # default attributes come from first insertion of each block
+    Layer = apps.get_model("django_geocad", "Layer")
+    Entity = apps.get_model("django_geocad", "Entity")
+    EntityData = apps.get_model("django_geocad", "EntityData")
+    first_ids = (
+        Entity.objects.exclude(block=None)
+        .values("block_id")
+        .annotate(first_id=models.Min("id"))
+        .values_list("first_id", flat=True)
+    )
+    attributes = {}
+    for ed in EntityData.objects.filter(entity_id__in=list(first_ids)).values(
+        "entity__block_id", "key", "value"
+    ):
+        attributes.setdefault(ed["entity__block_id"], {})[ed["key"]] = ed["value"]
+    blocks = Layer.objects.filter(id__in=attributes.keys())
+    for block in blocks:
+        block.attributes = attributes[block.id]
+    Layer.objects.bulk_update(blocks, ["attributes"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_geocad", "0010_layer_unique_layer_name"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="layer",
+            name="attributes",
+            field=models.JSONField(
+                default=dict, editable=False, verbose_name="Default block attributes"
+            ),
+        ),
+        migrations.RunPython(populate_attributes, migrations.RunPython.noop),
+    ]
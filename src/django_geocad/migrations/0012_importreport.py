@@ -0,0 +1,60 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_geocad", "0011_layer_attributes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportReport",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "created",
+                    models.DateTimeField(auto_now_add=True, verbose_name="Created"),
+                ),
+                ("total_time", models.FloatField(verbose_name="Wall time (s)")),
+                ("queries", models.PositiveIntegerField(verbose_name="Queries")),
+                ("entities", models.PositiveIntegerField(verbose_name="Entities")),
+                (
+                    "vertices",
+                    models.PositiveIntegerField(null=True, verbose_name="Vertices"),
+                ),
+                (
+                    "peak_memory",
+                    models.PositiveBigIntegerField(
+                        null=True, verbose_name="Peak memory (bytes)"
+                    ),
+                ),
+                ("stages", models.JSONField(default=list, verbose_name="Stages")),
+                (
+                    "drawing",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="import_reports",
+                        to="django_geocad.drawing",
+                        verbose_name="Drawing",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Import report",
+                "verbose_name_plural": "Import reports",
+                "ordering": ("-created",),
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 03:45
+
+from django.db import migrations, models
+
+
+def set_georeferenced(apps, schema_editor):
+    # DXF files of extracted drawings were rewritten with geodata
+    Drawing = apps.get_model("django_geocad", "Drawing")
+    Drawing.objects.exclude(epsg=None).update(dxf_georeferenced=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_geocad", "0012_importreport"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="drawing",
+            name="dxf_georeferenced",
+            field=models.BooleanField(
+                default=False, editable=False, verbose_name="DXF file has geodata"
+            ),
+        ),
+        migrations.RunPython(set_georeferenced, migrations.RunPython.noop),
+    ]
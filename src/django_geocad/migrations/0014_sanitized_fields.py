@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:05
+
+import nh3
+from django.db import migrations
+
+import django_geocad.fields
+
+
+def populate_clean(apps, schema_editor):
+    # sanitize existing strings once, in batches
+    Layer = apps.get_model("django_geocad", "Layer")
+    EntityData = apps.get_model("django_geocad", "EntityData")
+    for model, fields in ((Layer, ["name"]), (EntityData, ["key", "value"])):
+        batch = []
+        for obj in model.objects.only("id", *fields).iterator(chunk_size=1000):
+            for field in fields:
+                setattr(obj, f"{field}_clean", nh3.clean(getattr(obj, field)))
+            batch.append(obj)
+            if len(batch) == 1000:
+                model.objects.bulk_update(batch, [f"{f}_clean" for f in fields])
+                batch = []
+        model.objects.bulk_update(batch, [f"{f}_clean" for f in fields])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_geocad", "0013_drawing_dxf_georeferenced"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="entitydata",
+            name="key_clean",
+            field=django_geocad.fields.SanitizedField(source="key"),
+        ),
+        migrations.AddField(
+            model_name="entitydata",
+            name="value_clean",
+            field=django_geocad.fields.SanitizedField(source="value"),
+        ),
+        migrations.AddField(
+            model_name="layer",
+            name="name_clean",
+            field=django_geocad.fields.SanitizedField(source="name"),
+        ),
+        migrations.RunPython(populate_clean, migrations.RunPython.noop),
+    ]
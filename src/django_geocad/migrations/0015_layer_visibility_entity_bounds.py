@@ -0,0 +1,72 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:10
+
+from django.db import migrations, models
+
+import django_geocad.fields
+from django_geocad.fields import geometry_bounds
+
+
+def populate_bounds(apps, schema_editor):
+    # bounds of existing entities, in batches
+    Entity = apps.get_model("django_geocad", "Entity")
+    sides = ["west", "south", "east", "north"]
+    batch = []
+    entities = Entity.objects.only("id", "geom", "insertion")
+    for ent in entities.iterator(chunk_size=1000):
+        geometry = ent.geom or ent.insertion
+        bounds = geometry_bounds(geometry) if geometry else None
+        for i, side in enumerate(sides):
+            setattr(ent, side, bounds[i] if bounds else None)
+        batch.append(ent)
+        if len(batch) == 1000:
+            Entity.objects.bulk_update(batch, sides)
+            batch = []
+    Entity.objects.bulk_update(batch, sides)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_geocad", "0014_sanitized_fields"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="entity",
+            name="east",
+            field=django_geocad.fields.BoundsField(
+                fallback="insertion", side="east", source="geom"
+            ),
+        ),
+        migrations.AddField(
+            model_name="entity",
+            name="north",
+            field=django_geocad.fields.BoundsField(
+                fallback="insertion", side="north", source="geom"
+            ),
+        ),
+        migrations.AddField(
+            model_name="entity",
+            name="south",
+            field=django_geocad.fields.BoundsField(
+                fallback="insertion", side="south", source="geom"
+            ),
+        ),
+        migrations.AddField(
+            model_name="entity",
+            name="west",
+            field=django_geocad.fields.BoundsField(
+                fallback="insertion", side="west", source="geom"
+            ),
+        ),
+        migrations.AddField(
+            model_name="layer",
+            name="visible",
+            field=models.BooleanField(
+                default=True,
+                help_text="Entities of hidden layers are loaded when shown in the map",
+                verbose_name="Visible by default",
+            ),
+        ),
+        migrations.RunPython(populate_bounds, migrations.RunPython.noop),
+    ]
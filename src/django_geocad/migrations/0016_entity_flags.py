@@ -0,0 +1,86 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:14
+
+from django.db import migrations, models
+
+
+def flags_to_columns(apps, schema_editor):
+    # JSON flags become columns, in batches
+    Entity = apps.get_model("django_geocad", "Entity")
+    batch = []
+    for ent in Entity.objects.only("id", "data").iterator(chunk_size=1000):
+        if isinstance(ent.data, dict):
+            ent.processed = "processed" in ent.data
+            ent.added = ent.data.pop("added", None) == "true"
+            ent.data.pop("processed", None)
+        else:
+            # left to populate_block_field
+            ent.processed = False
+        batch.append(ent)
+        if len(batch) == 1000:
+            Entity.objects.bulk_update(batch, ["data", "processed", "added"])
+            batch = []
+    Entity.objects.bulk_update(batch, ["data", "processed", "added"])
+
+
+def columns_to_flags(apps, schema_editor):
+    Entity = apps.get_model("django_geocad", "Entity")
+    batch = []
+    entities = Entity.objects.only(
+        "id", "data", "processed", "added", "block_id", "insertion"
+    )
+    for ent in entities.iterator(chunk_size=1000):
+        if not isinstance(ent.data, dict):
+            continue
+        if ent.processed:
+            ent.data["processed"] = "true"
+        if ent.added:
+            ent.data["added"] = "true"
+        elif ent.block_id and ent.insertion:
+            ent.data["added"] = "false"
+        batch.append(ent)
+        if len(batch) == 1000:
+            Entity.objects.bulk_update(batch, ["data"])
+            batch = []
+    Entity.objects.bulk_update(batch, ["data"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_geocad", "0015_layer_visibility_entity_bounds"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="entity",
+            name="added",
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name="entity",
+            name="processed",
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.RunPython(flags_to_columns, columns_to_flags),
+        migrations.AlterField(
+            model_name="entity",
+            name="data",
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AddIndex(
+            model_name="entity",
+            index=models.Index(
+                condition=models.Q(("added", True)),
+                fields=["block"],
+                name="pending_insertions",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="entity",
+            index=models.Index(
+                condition=models.Q(("processed", False)),
+                fields=["layer", "id"],
+                name="unprocessed_entities",
+            ),
+        ),
+    ]
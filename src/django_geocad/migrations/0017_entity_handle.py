@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_geocad", "0016_entity_flags"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="entity",
+            name="geom_hash",
+            field=models.CharField(
+                blank=True, default="", editable=False, max_length=32
+            ),
+        ),
+        migrations.AddField(
+            model_name="entity",
+            name="handle",
+            field=models.CharField(
+                blank=True,
+                default="",
+                editable=False,
+                max_length=16,
+                verbose_name="DXF handle",
+            ),
+        ),
+    ]
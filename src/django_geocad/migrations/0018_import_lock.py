@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_geocad", "0017_entity_handle"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportLock",
+            fields=[
+                (
+                    "drawing",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="import_lock",
+                        serialize=False,
+                        to="django_geocad.drawing",
+                    ),
+                ),
+                ("started", models.DateTimeField(null=True)),
+                (
+                    "kind",
+                    models.CharField(
+                        blank=True,
+                        choices=[("import", "import"), ("download", "download")],
+                        default="",
+                        max_length=8,
+                    ),
+                ),
+                (
+                    "queued",
+                    models.CharField(
+                        blank=True,
+                        choices=[("file", "file"), ("fields", "fields")],
+                        default="",
+                        max_length=6,
+                    ),
+                ),
+            ],
+        ),
+    ]
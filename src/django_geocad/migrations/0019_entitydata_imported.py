@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_geocad", "0018_import_lock"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="entitydata",
+            name="imported",
+            field=models.BooleanField(default=False, editable=False),
+        ),
+    ]
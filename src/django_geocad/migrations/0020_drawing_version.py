@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("django_geocad", "0019_entitydata_imported"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DrawingVersion",
+            fields=[
+                (
+                    "drawing",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="entities_version",
+                        serialize=False,
+                        to="django_geocad.drawing",
+                    ),
+                ),
+                ("version", models.CharField(max_length=12)),
+            ],
+        ),
+    ]
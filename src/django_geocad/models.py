@@ -1,25 +1,34 @@
+import hashlib
+import json
+import os
+import time
+from collections import Counter
+from datetime import timedelta
 from math import atan2, cos, degrees, radians, sin
+from pathlib import Path
 
-import ezdxf
-import nh3
 from colorfield.fields import ColorField
+from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
 from django.core.validators import FileExtensionValidator
 from django.db import IntegrityError, models, transaction
+from django.dispatch import Signal
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.utils.translation import gettext_lazy as _
 from djgeojson.fields import GeometryCollectionField, PointField
-from easy_thumbnails.files import get_thumbnailer
-from ezdxf.addons import geo
-from ezdxf.lldxf.const import InvalidGeoDataException
-from PIL import ImageColor
-from pyproj import Transformer
-from pyproj.aoi import AreaOfInterest
-from pyproj.database import query_utm_crs_info
-from shapely import LineString
-from shapely.geometry import Point, shape
-from shapely.geometry.polygon import Polygon
+
+from .fields import BoundsField, SanitizedField, geometry_bounds
+from .profiling import (
+    ImportProfiler,
+    count_vertices,
+    current_profiler,
+    profile_stage,
+    record,
+)
+from .streaming import iter_modelspace, read_skeleton, save_with_entities, use_streaming
 
 
 class Drawing(models.Model):
@@ -94,11 +103,35 @@ class Drawing(models.Model):
     and an optional thumbnail image.
 
     - **save(self, \*args, \*\*kwargs)**:
+    Calls `save_and_extract` recording timings in an `ImportReport`.
+
+    - **save_and_extract(self, \*args, \*\*kwargs)**:
     Saves the `Drawing` instance and processes the associated DXF file
     to extract geospatial data.
 
+    - **import_dxf(self, doc=None, refresh=False, diff=False)**:
+    Calls `run_import` once the current transaction is committed.
+
+    - **run_import(self, doc=None, refresh=False, diff=False)**:
+    Deletes layers and extracts the DXF file, or queues the import if
+    another one is running on the drawing.
+
+    - **acquire_import_lock(self, wait=0, kind="import")**:
+    Takes the import lock of the drawing for an import or a download.
+
+    - **queue_import(self, geodata)**:
+    Queues an import for the running one.
+
+    - **release_import_lock(self, run_queued=True)**:
+    Releases the import lock, extracting queued imports first.
+
+    - **delete(self, \*args, \*\*kwargs)**:
+    Deletes the drawing, its layers and entities are deleted with
+    `bulk_delete`.
+
     - **delete_all_layers(self)**:
-    Deletes all layers associated with the drawing.
+    Deletes all layers associated with the drawing, with their entities
+    and data (see `bulk_delete`).
 
     - **get_geodata_from_parent(self, \*args, \*\*kwargs)**:
     Copies geospatial data from the parent drawing.
@@ -110,12 +143,28 @@ class Drawing(models.Model):
     - **get_geodata_from_dxf(self, \*args, \*\*kwargs)**:
     Extracts geospatial data from the associated DXF file.
 
-    - **extract_dxf(self, doc=None, refresh=False)**:
-    Processes the DXF file to extract entities, layers, and blocks.
+    - **get_geodata_from_doc(self, doc, \*args, \*\*kwargs)**:
+    Extracts geospatial data from an already loaded DXF document.
+
+    - **read_dxf(self)**:
+    Reads the DXF file, without modelspace entities if streaming.
+
+    - **save_dxf(self, doc, target=None)**:
+    Replaces the DXF file (or writes `target`) with the document.
+
+    - **extract_dxf(self, doc=None, refresh=False, diff=False)**:
+    Processes the DXF file to extract entities, layers, and blocks. If
+    `diff`, stored entities are updated instead (see `ImportDiff`).
+
+    - **extract_georeferenced(self, doc=None, refresh=False)**:
+    Gets the transformation matrix and extracts layers and modelspace.
 
     - **prepare_transformers(self)**:
     Prepares coordinate transformers for geospatial data processing.
 
+    - **set_dxf_georeferenced(self, value)**:
+    Records if the stored DXF file carries the drawing geodata.
+
     - **fake_geodata(self, geodata, utm_wcs, rot)**:
     Generates fake geospatial data for the drawing.
 
@@ -125,23 +174,61 @@ class Drawing(models.Model):
     - **prepare_layer_table(self, doc)**:
     Prepares a table of layers from the DXF file.
 
-    - **extract_entities(self, msp, e_type, m, utm2world, layer_table)**:
-    Extracts entities of a specific type from the DXF file.
+    - **extract_loaded(self, doc, m, utm2world, layer_table)**:
+    Extracts modelspace entities of a loaded document, texts first.
+
+    - **extract_streamed(self, doc, m, utm2world, layer_table)**:
+    Extracts streamed modelspace entities, texts first.
+
+    - **collect_texts(self, entities)**:
+    Groups TEXT and MTEXT entities by layer.
+
+    - **extract_entities(self, entities, m, utm2world, layer_table, texts)**:
+    Extracts entities from the DXF file.
 
     - **create_layer_entities(self, layer_table)**:
-    Creates entities for each layer in the layer table.
+    Creates entities for each layer in the layer table, geometries of a
+    layer are grouped by location (see `chunk_geometries`).
+
+    - **store_entity(self, ent, data=())**:
+    Saves an extracted entity with its data, or adds it to the import diff.
 
     - **save_blocks(self, doc, m, utm2world)**:
     Saves block definitions from the DXF file.
 
-    - **extract_insertions(self, ins, msp, m, utm2world, layer_table, block_table)**:
+    - **extract_insertions(self, ins, m, utm2world, layer_table, block_table)**:
     Extracts block insertions from the DXF file.
 
+    - **prepare_crs_matrix(self)**:
+    Returns the WCS to CRS transformation matrix built from drawing fields.
+
+    - **bulk_create_insertions(self, rows)**:
+    Creates many block insertions at once.
+
+    - **expand_insertions(self, entities)**:
+    Sets block geometry of insertions stored without it.
+
+    - **get_block_instances(self, entities)**:
+    Splits insertions from entities, as block templates and compact rows.
+
+    - **get_layer_summary(self)**:
+    Returns layers with visibility, entity count and bounds.
+
     - **write_csv(self, writer)**:
     Writes drawing data to a CSV file.
 
+    - **iter_csv_rows(self)**:
+    Yields header and rows of the CSV file, fetching entities in chunks.
+
     - **prepare_dxf_to_download(self)**:
-    Prepares a DXF file for download by adding new entities.
+    Returns the path of the DXF file to download, with geodata and new
+    entities, holding the import lock. None if the lock is not free.
+
+    - **download_path(self)**:
+    Path of the DXF file derived from the uploaded one for download.
+
+    - **write_dxf_insertions(self, entities, target)**:
+    Writes the DXF file with geodata and insertions added in the app.
 
     - **write_csv_from_file(self, writer)**:
     Writes data extracted from the DXF file to a CSV file.
@@ -193,6 +280,11 @@ class Drawing(models.Model):
         null=True,
         editable=False,
     )
+    dxf_georeferenced = models.BooleanField(
+        _("DXF file has geodata"),
+        default=False,
+        editable=False,
+    )
 
     class Meta:
         verbose_name = _("Drawing")
@@ -203,6 +295,8 @@ class Drawing(models.Model):
     __original_designx = None
     __original_designy = None
     __original_rotation = None
+    # set while extracting, see store_entity
+    import_diff = None
     # blacklists in settings
     layer_blacklist = settings.CAD_LAYER_BLACKLIST
     name_blacklist = settings.CAD_BLOCK_BLACKLIST
@@ -264,6 +358,8 @@ class Drawing(models.Model):
         :rtype: dict
         """
 
+        from easy_thumbnails.files import get_thumbnailer
+
         url = self.get_absolute_url()
         title_str = f'<a href="{url}"><strong>{self.title}</strong></a>'
         image = self.image
@@ -275,6 +371,12 @@ class Drawing(models.Model):
         return {"content": image_str + "<br>" + title_str}
 
     def save(self, *args, **kwargs):
+        # import stages are recorded in an ImportReport
+        with ImportProfiler(self):
+            self.save_and_extract(*args, **kwargs)
+        touch_drawing(self.id)
+
+    def save_and_extract(self, *args, **kwargs):
         # save and eventually upload DXF
         super().save(*args, **kwargs)
         # check if we have coordinate system
@@ -282,43 +384,44 @@ class Drawing(models.Model):
             # check if user has inserted parent
             if self.parent:
                 self.get_geodata_from_parent(*args, **kwargs)
-                self.extract_dxf(doc=None, refresh=True)
+                self.import_dxf(doc=None, refresh=True)
                 return
             # check if user has inserted origin on map
             elif self.geom:
                 self.get_geodata_from_geom(*args, **kwargs)
-                self.extract_dxf(doc=None, refresh=True)
+                self.import_dxf(doc=None, refresh=True)
                 return
             # no user input, search for geodata in dxf
             else:
                 doc = self.get_geodata_from_dxf(*args, **kwargs)
                 # if successful use geodata
                 if doc:
-                    self.extract_dxf(doc)
+                    self.import_dxf(doc)
                 return
         # ok, we have coordinate system
         # check if user has inserted new parent
         if self.parent:
-            self.delete_all_layers()
             self.get_geodata_from_parent(*args, **kwargs)
-            self.extract_dxf(doc=None, refresh=True)
+            self.import_dxf(doc=None, refresh=True)
             return
         # check if user has modified origin on map
         if self.geom and self.__original_geom != self.geom:
-            self.delete_all_layers()
             self.get_geodata_from_geom(*args, **kwargs)
-            self.extract_dxf(doc=None, refresh=True)
+            self.import_dxf(doc=None, refresh=True)
             return
         # check if user changed dxf
         if self.__original_dxf != self.dxf:
-            self.delete_all_layers()
+            # entities are compared to the new file, if differential
+            diff = differential_import()
             doc = self.get_geodata_from_dxf(*args, **kwargs)
             # if successful use new geodata
             if doc:
-                self.extract_dxf(doc)
+                self.import_dxf(doc, diff=diff)
             # else use old geodata
             elif self.geom:
-                self.extract_dxf(doc=None, refresh=True)
+                self.import_dxf(doc=None, refresh=True, diff=diff)
+            else:
+                self.delete_all_layers()
             return
         # check if something else changed
         if (
@@ -326,13 +429,140 @@ class Drawing(models.Model):
             or self.__original_designy != self.designy
             or self.__original_rotation != self.rotation
         ):
-            self.delete_all_layers()
-            self.extract_dxf(doc=None, refresh=True)
+            self.import_dxf(doc=None, refresh=True)
+
+    def import_dxf(self, doc=None, refresh=False, diff=False):
+        """
+        Imports the DXF file once the current transaction is committed (at
+        once outside of transactions), so that other processes see the
+        import lock and the fields it extracts. Admin saves run in a
+        transaction: without deferring, a second save would wait for the
+        first one to commit, then extract the drawing again.
+        GEOCAD_IMPORT_ON_COMMIT = False imports inside the transaction.
+        """
+
+        if not import_on_commit() or not transaction.get_connection().in_atomic_block:
+            self.run_import(doc, refresh=refresh, diff=diff)
+            return
+
+        def committed():
+            # save has stored its report already, the import gets its own
+            with ImportProfiler(self):
+                self.run_import(doc, refresh=refresh, diff=diff)
+            touch_drawing(self.id)
+
+        transaction.on_commit(committed)
+
+    def run_import(self, doc=None, refresh=False, diff=False):
+        """
+        Deletes all layers (unless `diff`) and extracts the DXF file holding
+        the import lock. If another import holds it, this one is queued and
+        extracted by the running import when it is done: queued imports are
+        merged in one, from fields stored by the latest save. If a download
+        holds it, this one waits for it up to GEOCAD_IMPORT_LOCK_WAIT
+        seconds, then raises `TimeoutError`.
+        """
+
+        wait = None
+        while not self.acquire_import_lock(wait=wait or 0):
+            if self.queue_import("fields" if refresh else "file"):
+                return
+            if wait is not None:
+                raise TimeoutError(
+                    f"Import lock of drawing {self.id} held by a download"
+                )
+            # held by a download, or released meanwhile
+            wait = getattr(settings, "GEOCAD_IMPORT_LOCK_WAIT", 30)
+        try:
+            if not diff:
+                self.delete_all_layers()
+            self.extract_dxf(doc, refresh=refresh, diff=diff)
+        except BaseException:
+            self.release_import_lock(run_queued=False)
+            raise
+        self.release_import_lock()
+
+    def acquire_import_lock(self, wait=0, kind="import"):
+        """
+        Takes the import lock of the drawing for an "import" or a
+        "download", waiting up to `wait` seconds. Locks older than
+        GEOCAD_IMPORT_LOCK_TIMEOUT seconds (default 3600) are taken over, as
+        their import crashed. Each update is committed at once only outside
+        of transactions, see `import_dxf`.
+        """
+
+        timeout = getattr(settings, "GEOCAD_IMPORT_LOCK_TIMEOUT", 3600)
+        deadline = time.monotonic() + wait
+        delay = 0.05
+        ImportLock.objects.bulk_create(
+            [ImportLock(drawing_id=self.id)], ignore_conflicts=True
+        )
+        while True:
+            now = timezone.now()
+            free = models.Q(started__isnull=True) | models.Q(
+                started__lt=now - timedelta(seconds=timeout)
+            )
+            locks = ImportLock.objects.filter(free, drawing_id=self.id)
+            if locks.update(started=now, kind=kind):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            # polls less often as the wait grows
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1)
+
+    def queue_import(self, geodata):
+        """
+        Queues an import (geodata from "file" or "fields") for the running
+        one, returns False if no import is running anymore (or the lock is
+        held by a download).
+        """
+
+        running = ImportLock.objects.filter(
+            drawing_id=self.id, started__isnull=False, kind="import"
+        )
+        return bool(running.update(queued=geodata))
+
+    def release_import_lock(self, run_queued=True):
+        """Releases the import lock, extracting queued imports first"""
+        locks = ImportLock.objects.filter(drawing_id=self.id)
+        if not run_queued:
+            locks.update(started=None)
+            return
+        while not locks.filter(queued="").update(started=None):
+            queued = locks.values_list("queued", flat=True).first()
+            if queued is None:
+                # drawing was deleted
+                return
+            if not locks.filter(queued=queued).update(
+                queued="", started=timezone.now()
+            ):
+                # queued again meanwhile
+                continue
+            self.refresh_from_db()
+            # new geodata from fields extracts everything again
+            diff = differential_import() and queued == "file"
+            try:
+                if not diff:
+                    self.delete_all_layers()
+                self.extract_dxf(refresh=queued == "fields", diff=diff)
+            except BaseException:
+                locks.update(started=None)
+                raise
+
+    def delete(self, *args, **kwargs):
+        # layers and entities first, without loading them, the version of
+        # the drawing is deleted with it
+        with transaction.atomic():
+            deleted, counts = self.delete_all_layers()
+            total, drawing_counts = super().delete(*args, **kwargs)
+        counts.update(drawing_counts)
+        return deleted + total, counts
 
     def delete_all_layers(self):
-        all_layers = self.related_layers.all()
-        if all_layers.exists():
-            all_layers.delete()
+        with profile_stage("delete layers"):
+            return bulk_delete(self.related_layers.all())
 
     def get_geodata_from_parent(self, *args, **kwargs):
         self.geom = self.parent.geom
@@ -341,23 +571,36 @@ class Drawing(models.Model):
         self.designy = self.parent.designy
         self.rotation = self.parent.rotation
         self.parent = None
-        super().save(*args, **kwargs)
+        with profile_stage("geodata"):
+            super().save(*args, **kwargs)
 
     def get_geodata_from_geom(self, *args, **kwargs):
-        utm_crs_list = query_utm_crs_info(
-            datum_name="WGS 84",
-            area_of_interest=AreaOfInterest(
-                west_lon_degree=self.geom["coordinates"][0],
-                south_lat_degree=self.geom["coordinates"][1],
-                east_lon_degree=self.geom["coordinates"][0],
-                north_lat_degree=self.geom["coordinates"][1],
-            ),
-        )
-        self.epsg = utm_crs_list[0].code
-        super().save(*args, **kwargs)
+        from pyproj.aoi import AreaOfInterest
+        from pyproj.database import query_utm_crs_info
+
+        with profile_stage("geodata"):
+            utm_crs_list = query_utm_crs_info(
+                datum_name="WGS 84",
+                area_of_interest=AreaOfInterest(
+                    west_lon_degree=self.geom["coordinates"][0],
+                    south_lat_degree=self.geom["coordinates"][1],
+                    east_lon_degree=self.geom["coordinates"][0],
+                    north_lat_degree=self.geom["coordinates"][1],
+                ),
+            )
+            self.epsg = utm_crs_list[0].code
+            super().save(*args, **kwargs)
 
     def get_geodata_from_dxf(self, *args, **kwargs):
-        doc = ezdxf.readfile(self.dxf.path)
+        with profile_stage("read file"):
+            doc = self.read_dxf()
+        with profile_stage("geodata"):
+            return self.get_geodata_from_doc(doc, *args, **kwargs)
+
+    def get_geodata_from_doc(self, doc, *args, **kwargs):
+        from ezdxf.lldxf.const import InvalidGeoDataException
+        from pyproj import Transformer
+
         msp = doc.modelspace()
         geodata = msp.get_geodata()
         if geodata:
@@ -385,32 +628,105 @@ class Drawing(models.Model):
             return doc
         return False
 
-    def extract_dxf(self, doc=None, refresh=False):
+    def read_dxf(self):
+        import ezdxf
+
+        # skeleton without modelspace entities if streaming
+        if use_streaming(self.dxf.path):
+            return read_skeleton(self.dxf.path)
+        return ezdxf.readfile(self.dxf.path)
+
+    def save_dxf(self, doc, target=None):
+        target = target or self.dxf.path
+        if use_streaming(self.dxf.path):
+            save_with_entities(doc, self.dxf.path, target)
+            return
+        # written aside and renamed, files being served are left whole
+        tmp = f"{target}.tmp"
+        doc.saveas(filename=tmp, encoding="utf-8", fmt="asc")
+        os.replace(tmp, target)
+
+    def extract_dxf(self, doc=None, refresh=False, diff=False):
+        # existing entities are updated instead of created, if diff
+        from .reimport import ImportDiff
+
+        self.import_diff = ImportDiff(self) if diff else None
+        try:
+            layer_table, block_table = self.extract_georeferenced(doc, refresh)
+            if diff:
+                # layers and blocks of the new file are kept
+                kept = [data["layer_obj"] for data in layer_table.values()]
+                kept += [data["block_obj"] for data in block_table.values()]
+                with profile_stage("apply diff"):
+                    self.import_diff.apply(kept)
+        finally:
+            self.import_diff = None
+
+    def extract_georeferenced(self, doc=None, refresh=False):
         # prepare transformers
         world2utm, utm2world, utm_wcs, rot = self.prepare_transformers()
         # get DXF if none
         if not doc:
-            doc = ezdxf.readfile(self.dxf.path)
+            with profile_stage("read file"):
+                doc = self.read_dxf()
         msp = doc.modelspace()
         geodata = msp.get_geodata()
-        if not geodata or refresh:
-            # faking geodata
-            geodata = msp.new_geodata()
-            geodata = self.fake_geodata(geodata, utm_wcs, rot)
-            # replace stored DXF
-            doc.saveas(filename=self.dxf.path, encoding="utf-8", fmt="asc")
-        # get transform matrix from true or fake geodata
-        m, epsg = geodata.get_crs_transformation(no_checks=True)
-        layer_table = self.prepare_layer_table(doc)
+        if geodata and not refresh:
+            # get transform matrix from true geodata
+            m, epsg = geodata.get_crs_transformation(no_checks=True)
+        else:
+            # georeference is stored in fields only, DXF file gets
+            # geodata when downloaded
+            m = self.prepare_crs_matrix()
+        self.set_dxf_georeferenced(bool(geodata) and not refresh)
+        with profile_stage("layer table"):
+            layer_table = self.prepare_layer_table(doc)
+        if use_streaming(self.dxf.path):
+            block_table = self.extract_streamed(doc, m, utm2world, layer_table)
+        else:
+            block_table = self.extract_loaded(doc, m, utm2world, layer_table)
+        return layer_table, block_table
+
+    def extract_loaded(self, doc, m, utm2world, layer_table):
+        msp = doc.modelspace()
+        with profile_stage("texts"):
+            texts = self.collect_texts(msp.query(" ".join(self.text_types)))
         for e_type in self.entity_types:
-            self.extract_entities(msp, e_type, m, utm2world, layer_table)
-        self.create_layer_entities(layer_table)
-        block_table = self.save_blocks(doc, m, utm2world)
+            with profile_stage(f"entities {e_type}"):
+                self.extract_entities(
+                    msp.query(e_type), m, utm2world, layer_table, texts
+                )
+        with profile_stage("layer entities"):
+            self.create_layer_entities(layer_table)
+        with profile_stage("blocks"):
+            block_table = self.save_blocks(doc, m, utm2world)
         # extract insertions
-        for ins in msp.query("INSERT"):
-            self.extract_insertions(ins, msp, m, utm2world, layer_table, block_table)
+        with profile_stage("insertions"):
+            for ins in msp.query("INSERT"):
+                self.extract_insertions(ins, m, utm2world, layer_table, block_table)
+        return block_table
+
+    def extract_streamed(self, doc, m, utm2world, layer_table):
+        # a first pass collects texts, a second one extracts everything else
+        path = self.dxf.path
+        with profile_stage("texts"):
+            texts = self.collect_texts(iter_modelspace(path, self.text_types))
+        # blocks come from skeleton, before their insertions
+        with profile_stage("blocks"):
+            block_table = self.save_blocks(doc, m, utm2world)
+        with profile_stage("entities"):
+            for e in iter_modelspace(path, self.entity_types + ["INSERT"], doc):
+                if e.dxftype() == "INSERT":
+                    self.extract_insertions(e, m, utm2world, layer_table, block_table)
+                else:
+                    self.extract_entities([e], m, utm2world, layer_table, texts)
+        with profile_stage("layer entities"):
+            self.create_layer_entities(layer_table)
+        return block_table
 
     def prepare_transformers(self):
+        from pyproj import Transformer
+
         world2utm = Transformer.from_crs(4326, self.epsg, always_xy=True)
         utm2world = Transformer.from_crs(self.epsg, 4326, always_xy=True)
         utm_wcs = world2utm.transform(
@@ -419,6 +735,12 @@ class Drawing(models.Model):
         rot = radians(self.rotation)
         return world2utm, utm2world, utm_wcs, rot
 
+    def set_dxf_georeferenced(self, value):
+        if self.dxf_georeferenced != value:
+            self.dxf_georeferenced = value
+            # no need to go through save()
+            Drawing.objects.filter(id=self.id).update(dxf_georeferenced=value)
+
     def fake_geodata(self, geodata, utm_wcs, rot):
         geodata.coordinate_system_definition = self.get_epsg_xml()
         geodata.dxf.design_point = (self.designx, self.designy, 0)
@@ -426,6 +748,17 @@ class Drawing(models.Model):
         geodata.dxf.north_direction = (sin(rot), cos(rot))
         return geodata
 
+    def prepare_crs_matrix(self):
+        from ezdxf.math import Matrix44
+
+        # same as GeoData.get_crs_transformation() of fake geodata
+        world2utm, utm2world, utm_wcs, rot = self.prepare_transformers()
+        return (
+            Matrix44.translate(-self.designx, -self.designy, 0)
+            @ Matrix44.z_rotate(rot)
+            @ Matrix44.translate(utm_wcs[0], utm_wcs[1], 0)
+        )
+
     def get_epsg_xml(self):
         xml = """<?xml version="1.0"
 encoding="UTF-16" standalone="no" ?>
@@ -454,7 +787,7 @@ encoding="UTF-16" standalone="no" ?>
         return xml
 
     def prepare_layer_table(self, doc):
-        layer_table = {}
+        layers = {}
         for layer in doc.layers:
             if layer.dxf.name in self.layer_blacklist:
                 continue
@@ -462,39 +795,104 @@ encoding="UTF-16" standalone="no" ?>
                 color = cad2hex(layer.rgb)
             else:
                 color = cad2hex(layer.color)
-            # get or create used to pass the tests
-            layer_obj, created = Layer.objects.get_or_create(
-                drawing_id=self.id,
-                name=layer.dxf.name,
-                defaults={"color_field": color},
-            )
-            layer_table[layer.dxf.name] = {
+            layers[layer.dxf.name] = {"color_field": color}
+        layer_table = {}
+        for name, layer_obj in self.materialize_layers(layers).items():
+            layer_table[name] = {
                 "layer_obj": layer_obj,
                 "geometries": [],
             }
         return layer_table
 
-    def extract_entities(self, msp, e_type, m, utm2world, layer_table):
-        for e in msp.query(e_type):
+    def materialize_layers(self, layers, is_block=False):
+        """
+        Gets or creates many layers (or blocks) at once. Takes a dictionary
+        of DXF names and field defaults, returns a dictionary of DXF names
+        and Layer objects. Existing layers (kept by a differential import)
+        get changed defaults with a single `bulk_update`, names are made
+        unique and fit to field length in memory, new layers are inserted
+        with a single `bulk_create`.
+        """
+
+        if not layers:
+            return {}
+        siblings = Layer.objects.filter(drawing_id=self.id, is_block=is_block)
+        existing = {layer.name: layer for layer in siblings}
+        max_length = Layer._meta.get_field("name").max_length
+        taken = set(existing)
+        names = {}
+        new_layers = []
+        changed = []
+        fields = set()
+        for dxf_name, defaults in layers.items():
+            name = dxf_name[:max_length]
+            if name in existing:
+                names[dxf_name] = name
+                layer = existing[name]
+                for field, value in defaults.items():
+                    # geometries compared as stored
+                    if json.dumps(getattr(layer, field)) != json.dumps(value):
+                        setattr(layer, field, value)
+                        fields.add(field)
+                        changed.append(layer)
+                continue
+            if name in taken:
+                # truncated names may collide
+                name = get_unique_name(name, taken, max_length)
+            taken.add(name)
+            names[dxf_name] = name
+            new_layers.append(
+                Layer(drawing_id=self.id, name=name, is_block=is_block, **defaults)
+            )
+        if changed:
+            changed = list(set(changed))
+            Layer.objects.bulk_update(changed, fields)
+            if fields & set(Layer.popup_fields):
+                entities = Entity.objects.filter(
+                    models.Q(layer__in=changed) | models.Q(block__in=changed)
+                )
+                clear_popup_cache(entities.values_list("id", flat=True))
+        if new_layers:
+            # concurrent imports may have inserted the same names
+            Layer.objects.bulk_create(new_layers, ignore_conflicts=True)
+            existing = {layer.name: layer for layer in siblings.all()}
+        return {dxf_name: existing[name] for dxf_name, name in names.items()}
+
+    def collect_texts(self, entities):
+        """Maps layer names to text types, insertion points and contents"""
+        from shapely.geometry import Point
+
+        texts = {}
+        for t in entities:
+            t_type = t.dxftype()
+            # handle different type of texts
+            if t_type == "TEXT":
+                content = t.dxf.text
+            else:
+                content = t.text
+            layer_texts = texts.setdefault(t.dxf.layer, {})
+            layer_texts.setdefault(t_type, []).append((Point(t.dxf.insert), content))
+        return texts
+
+    def extract_entities(self, entities, m, utm2world, layer_table, texts):
+        from shapely.geometry.polygon import Polygon
+
+        for e in entities:
             geo_proxy = get_geo_proxy(e, m, utm2world)
             if geo_proxy:
-                if e_type in ["LWPOLYLINE", "POLYLINE"]:
+                record(1, geo_proxy)
+                if e.dxftype() in ["LWPOLYLINE", "POLYLINE"]:
                     entity_data = {}
                     # check if it's a true polygon
                     try:
                         poly = Polygon(e.vertices_in_wcs())
                         # look for texts in same layer
+                        layer_texts = texts.get(e.dxf.layer, {})
                         for t_type in self.text_types:
-                            txts = msp.query(f"{t_type}[layer=='{e.dxf.layer}']")
-                            for t in txts:
-                                point = Point(t.dxf.insert)
+                            for point, content in layer_texts.get(t_type, []):
                                 # check if text is contained by polygon
                                 if poly.contains(point):
-                                    # handle different type of texts
-                                    if t_type == "TEXT":
-                                        entity_data["Name"] = t.dxf.text
-                                    else:
-                                        entity_data["Name"] = t.text
+                                    entity_data["Name"] = content
                                     break
                         if e.is_closed:
                             entity_data["Surface"] = round(poly.area, 2)
@@ -503,20 +901,15 @@ encoding="UTF-16" standalone="no" ?>
                         entity_data["Perimeter"] = round(poly.length, 2)
                         if e.dxf.const_width:
                             entity_data["Width"] = round(e.dxf.const_width, 2)
-                        ent = Entity.objects.create(
+                        ent = Entity(
                             layer=layer_table[e.dxf.layer]["layer_obj"],
                             geom={
                                 "geometries": [geo_proxy.__geo_interface__],
                                 "type": "GeometryCollection",
                             },
-                            # data=entity_data,
+                            handle=e.dxf.handle or "",
                         )
-                        for key, value in entity_data.items():
-                            EntityData.objects.create(
-                                entity=ent,
-                                key=key,
-                                value=value,
-                            )
+                        self.store_entity(ent, list(entity_data.items()))
                     except (AttributeError, ValueError):
                         # not true polygon, add to layer entity
                         layer_table[e.dxf.layer]["geometries"].append(
@@ -533,16 +926,35 @@ encoding="UTF-16" standalone="no" ?>
             # next conditional is true TDD!
             if len(layer_data["geometries"]) == 0:
                 continue
-            Entity.objects.create(
-                layer=layer_data["layer_obj"],
-                geom={
-                    "geometries": layer_data["geometries"],
-                    "type": "GeometryCollection",
-                },
-            )
+            # one entity for each cluster, so that each has its own extent
+            for geometries in chunk_geometries(
+                layer_data["geometries"], chunk_vertices()
+            ):
+                ent = Entity(
+                    layer=layer_data["layer_obj"],
+                    geom={
+                        "geometries": geometries,
+                        "type": "GeometryCollection",
+                    },
+                )
+                self.store_entity(ent)
+
+    def store_entity(self, ent, data=()):
+        """
+        Saves an extracted entity with its data (key / value pairs), or adds
+        it to the diff of a differential import (see `ImportDiff`).
+        """
+
+        ent.geom_hash = get_entity_hash(ent, data)
+        if self.import_diff is not None:
+            self.import_diff.add(ent, data)
+            return
+        ent.save()
+        for key, value in data:
+            EntityData.objects.create(entity=ent, key=key, value=value, imported=True)
 
     def save_blocks(self, doc, m, utm2world):
-        block_table = {}
+        blocks = {}
         for block in doc.blocks:
             if block.name in self.name_blacklist:
                 continue
@@ -552,40 +964,56 @@ encoding="UTF-16" standalone="no" ?>
                 for e in block.query(e_type):
                     geo_proxy = get_geo_proxy(e, m, utm2world)
                     if geo_proxy:
-                        geometries.append(geo_proxy.__geo_interface__)
+                        geometry = geo_proxy.__geo_interface__
+                        record(1, geometry)
+                        geometries.append(geometry)
+            # default attributes of new insertions
+            attributes = {}
+            for attdef in block.query("ATTDEF"):
+                attributes[attdef.dxf.tag] = attdef.dxf.text
             # create block as Layer
             if not geometries == []:
-                # use get or create to pass tests
-                block_obj, created = Layer.objects.get_or_create(
-                    drawing_id=self.id,
-                    name=block.name,
-                    is_block=True,
-                    defaults={
-                        "geom": {
-                            "geometries": geometries,
-                            "type": "GeometryCollection",
-                        }
+                blocks[block.name] = {
+                    "geom": {
+                        "geometries": geometries,
+                        "type": "GeometryCollection",
                     },
-                )
-                block_table[block.name] = block_obj
+                    "attributes": attributes,
+                }
+        block_table = {}
+        for name, block_obj in self.materialize_layers(blocks, is_block=True).items():
+            block_table[name] = {
+                "block_obj": block_obj,
+                "first_insertion": True,
+            }
         return block_table
 
-    def extract_insertions(self, ins, msp, m, utm2world, layer_table, block_table):
+    def extract_insertions(self, ins, m, utm2world, layer_table, block_table):
+        from ezdxf.entities import Point as DXFPoint
+
         # filter blacklisted blocks
         if ins.dxf.name in self.name_blacklist:
             return
-        point = msp.add_point(ins.dxf.insert)
+        point = DXFPoint.new(dxfattribs={"location": ins.dxf.insert})
         geo_proxy = get_geo_proxy(point, m, utm2world)
         if geo_proxy:
             insertion_point = geo_proxy.__geo_interface__
-        geometries = []
-        # 'generator' object has no attribute 'query'
-        for e in ins.virtual_entities():
-            if e.dxftype() in self.entity_types:
-                # extract entity
-                geo_proxy = get_geo_proxy(e, m, utm2world)
-                if geo_proxy:
-                    geometries.append(geo_proxy.__geo_interface__)
+        geom = None
+        # deduplicated insertions are expanded from the block when serialized
+        if not deduplicate_insertions():
+            geometries = []
+            # 'generator' object has no attribute 'query'
+            for e in ins.virtual_entities():
+                if e.dxftype() in self.entity_types:
+                    # extract entity
+                    geo_proxy = get_geo_proxy(e, m, utm2world)
+                    if geo_proxy:
+                        geometries.append(geo_proxy.__geo_interface__)
+            geom = {
+                "geometries": geometries,
+                "type": "GeometryCollection",
+            }
+        record(1, geom)
         # prepare block data
         if ins.dxf.rotation:
             rotation = round(ins.dxf.rotation, 2)
@@ -600,75 +1028,275 @@ encoding="UTF-16" standalone="no" ?>
         else:
             yscale = 1
         # create Insertion
-        ins_obj = Entity.objects.create(
+        ins_obj = Entity(
             layer=layer_table[ins.dxf.layer]["layer_obj"],
-            block=block_table[ins.dxf.name],
+            block=block_table[ins.dxf.name]["block_obj"],
             insertion=insertion_point,
-            geom={
-                "geometries": geometries,
-                "type": "GeometryCollection",
-            },
+            geom=geom,
             rotation=rotation,
             xscale=xscale,
             yscale=yscale,
-            data={
-                "processed": "true",
-                "added": "false",
-            },
+            handle=ins.dxf.handle or "",
         )
         # add attributes
+        self.store_entity(
+            ins_obj, [(attr.dxf.tag, attr.dxf.text) for attr in ins.attribs]
+        )
         if ins.attribs:
-            for attr in ins.attribs:
-                EntityData.objects.create(
-                    entity=ins_obj,
-                    key=attr.dxf.tag,
-                    value=attr.dxf.text,
+            # first insertion sets default attributes of the block
+            if block_table[ins.dxf.name]["first_insertion"]:
+                block_obj = block_table[ins.dxf.name]["block_obj"]
+                block_obj.attributes = {a.dxf.tag: a.dxf.text for a in ins.attribs}
+                block_obj.save(update_fields=["attributes"])
+        block_table[ins.dxf.name]["first_insertion"] = False
+
+    def bulk_create_insertions(self, rows):
+        """
+        Creates block insertions from a list of dictionaries with `lat`,
+        `long`, `block`, `layer` (names), `rotation`, `xscale`, `yscale`
+        and `attributes` keys. Geometries are computed in one vectorized
+        pass per block, entities and data are stored with `bulk_create`.
+        Attributes are merged with block defaults. Missing layers are
+        created, unknown blocks raise `ValueError`.
+        """
+
+        blocks = {
+            block.name: block for block in self.related_layers.filter(is_block=True)
+        }
+        unknown = {row["block"] for row in rows} - set(blocks)
+        if unknown:
+            raise ValueError(_("Unknown blocks: %s") % ", ".join(sorted(unknown)))
+        layers = self.materialize_layers({row["layer"]: {} for row in rows})
+        world2utm, utm2world, utm_wcs, rot = self.prepare_transformers()
+        m = self.prepare_crs_matrix()
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(row["block"], []).append(row)
+        entities = []
+        attributes = []
+        for name, block_rows in grouped.items():
+            block = blocks[name]
+            if deduplicate_insertions():
+                geometries = [None] * len(block_rows)
+            else:
+                template = get_block_template(block, world2utm, m)
+                geometries = expand_block_template(
+                    template,
+                    [(row["long"], row["lat"]) for row in block_rows],
+                    [row["rotation"] for row in block_rows],
+                    [row["xscale"] for row in block_rows],
+                    [row["yscale"] for row in block_rows],
+                    world2utm,
+                    utm2world,
+                    m,
+                )
+            for row, geom in zip(block_rows, geometries):
+                entities.append(
+                    Entity(
+                        layer=layers[row["layer"]],
+                        block=block,
+                        insertion={
+                            "type": "Point",
+                            "coordinates": [row["long"], row["lat"]],
+                        },
+                        geom=geom,
+                        rotation=row["rotation"],
+                        xscale=row["xscale"],
+                        yscale=row["yscale"],
+                        added=True,
+                    )
                 )
+                attributes.append(row.get("attributes", {}))
+        with transaction.atomic():
+            Entity.objects.bulk_create(entities)
+            entities_created.send(sender=Entity, entities=entities)
+            touch_drawing(self.id)
+            entity_data = []
+            for ent, attrs in zip(entities, attributes):
+                values = dict(ent.block.attributes)
+                values.update(attrs)
+                for key, value in values.items():
+                    entity_data.append(EntityData(entity=ent, key=key, value=value))
+            EntityData.objects.bulk_create(entity_data)
+        return entities
+
+    def expand_insertions(self, entities):
+        """
+        Returns entities as a list, insertions stored without geometry (see
+        `GEOCAD_DEDUPLICATE_INSERTIONS`) get it from their block template in
+        one vectorized pass per block. Geometry is set in memory only, blocks
+        should be fetched with `select_related`.
+        """
 
-    def write_csv(self, writer):
-        writer_data = []
-        layers = self.related_layers.all()
+        entities = list(entities)
+        grouped = {}
+        for ent in entities:
+            if ent.geom is None and ent.block_id:
+                grouped.setdefault(ent.block_id, []).append(ent)
+        if not grouped:
+            return entities
+        world2utm, utm2world, utm_wcs, rot = self.prepare_transformers()
+        m = self.prepare_crs_matrix()
+        for block_entities in grouped.values():
+            template = get_block_template(block_entities[0].block, world2utm, m)
+            geometries = expand_block_template(
+                template,
+                [ent.insertion["coordinates"] for ent in block_entities],
+                [ent.rotation for ent in block_entities],
+                [ent.xscale for ent in block_entities],
+                [ent.yscale for ent in block_entities],
+                world2utm,
+                utm2world,
+                m,
+            )
+            for ent, geom in zip(block_entities, geometries):
+                ent.geom = geom
+        return entities
+
+    def get_block_instances(self, entities):
+        """
+        Splits insertions from entities, so that the map draws each block
+        once and places it on canvas for every insertion. Returns other
+        entities as a list and a dictionary with block templates (block
+        coordinates), layer styles, a matrix turning block coordinates into
+        longitude / latitude offsets at the drawing location and one row per
+        insertion: longitude, latitude, rotation, xscale, yscale, layer
+        index, block index and id. Entities should be fetched with
+        `select_related("layer", "block")`.
+        """
+
+        import numpy as np
+        import shapely
+        from shapely.geometry import mapping
+
+        lines = []
+        insertions = []
+        for ent in entities:
+            if ent.block_id and ent.insertion:
+                insertions.append(ent)
+            else:
+                lines.append(ent)
+        if not insertions:
+            return lines, None
+        world2utm, utm2world, utm_wcs, rot = self.prepare_transformers()
+        m = self.prepare_crs_matrix()
+        # derivatives of longitude / latitude along WCS axes, in the drawing
+        # location: blocks are small enough for the map to place them with
+        # this local linear transformation
+        origin = np.array([self.geom["coordinates"]], dtype=float)
+        wcs = world_to_wcs(origin, world2utm, m)
+        axes = wcs_to_world(wcs + np.array([[1, 0], [0, 1]]), utm2world, m) - origin
+        # position of layers and blocks in the lists below
+        layer_index = {}
+        block_index = {}
+        instances = {
+            "latitude": self.geom["coordinates"][1],
+            "matrix": axes.T.tolist(),
+            "layers": [],
+            "blocks": [],
+            "insertions": [],
+            # popups are fetched when opened
+            "popup_url": reverse("django_geocad:entity_popup", kwargs={"pk": "ID"}),
+        }
+        for ent in insertions:
+            if ent.layer_id not in layer_index:
+                layer_index[ent.layer_id] = len(layer_index)
+                instances["layers"].append(
+                    {
+                        # layer group of the map
+                        "group": _("Layer - ") + ent.layer.name,
+                        "color": ent.layer.color_field,
+                        "linetype": ent.layer.linetype,
+                    }
+                )
+            if ent.block_id not in block_index:
+                block_index[ent.block_id] = len(block_index)
+                template = get_block_template(ent.block, world2utm, m)
+                # tenths of millimeter are enough for drawings in meters
+                template = shapely.transform(template, lambda c: np.round(c, 4))
+                instances["blocks"].append(
+                    {
+                        "name": ent.block.name,
+                        "geometries": [mapping(g) for g in template],
+                    }
+                )
+            instances["insertions"].append(
+                [
+                    round(ent.insertion["coordinates"][0], 7),
+                    round(ent.insertion["coordinates"][1], 7),
+                    ent.rotation,
+                    ent.xscale,
+                    ent.yscale,
+                    layer_index[ent.layer_id],
+                    block_index[ent.block_id],
+                    ent.id,
+                ]
+            )
+        return lines, instances
+
+    def get_layer_summary(self):
+        """
+        Returns layers (not blocks) with default visibility, number of
+        entities and bounds of their geometry as [[south, west], [north,
+        east]] (None if layer is empty), with a single query, so that the
+        map loads entities of a layer only when it is shown.
+        """
+
+        layers = (
+            self.related_layers.filter(is_block=False)
+            .annotate(
+                entity_count=models.Count("related_entities"),
+                west=models.Min("related_entities__west"),
+                south=models.Min("related_entities__south"),
+                east=models.Max("related_entities__east"),
+                north=models.Max("related_entities__north"),
+            )
+            .order_by("name")
+        )
+        summary = []
         for layer in layers:
-            entities = layer.related_entities.all()
-            for e in entities:
-                if not e.related_data:
-                    continue
-                entity_data = {
-                    "id": e.id,
-                    "layer": layer.name,
+            bounds = None
+            if layer.west is not None:
+                bounds = [[layer.south, layer.west], [layer.north, layer.east]]
+            summary.append(
+                {
+                    "id": layer.id,
+                    "name": layer.name,
+                    "color": layer.color_field,
+                    "linetype": layer.linetype,
+                    "visible": layer.visible,
+                    "count": layer.entity_count,
+                    "bounds": bounds,
                 }
-                if e.insertion:
-                    entity_data["Latitude"] = e.insertion["coordinates"][0]
-                    entity_data["Longitude"] = e.insertion["coordinates"][1]
-                    entity_data["Block"] = e.block.name
-                    entity_data["X scale"] = e.xscale
-                    entity_data["Y scale"] = e.yscale
-                    entity_data["Rotation"] = e.rotation
-                    for ed in e.related_data.all():
-                        entity_data["attributes"] = {}
-                        entity_data["attributes"][ed.key] = ed.value
-                else:
-                    for ed in e.related_data.all():
-                        entity_data[ed.key] = ed.value
-                writer_data.append(entity_data)
-        writer.writerow(
-            [
-                _("ID"),
-                _("Layer"),
-                _("Block"),
-                _("Name"),
-                _("Surface"),
-                _("Perimeter"),
-                _("Height"),
-                _("Width"),
-                _("Rotation"),
-                _("X scale"),
-                _("Y scale"),
-                _("Latitude"),
-                _("Longitude"),
-                _("Attributes"),
-            ]
-        )
+            )
+        return summary
+
+    def write_csv(self, writer):
+        writer.writerows(self.iter_csv_rows())
+        return writer
+
+    def iter_csv_rows(self):
+        """
+        Header and rows of `write_csv`, entities are fetched in chunks as
+        rows are consumed, so that they can be streamed.
+        """
+
+        yield [
+            _("ID"),
+            _("Layer"),
+            _("Block"),
+            _("Name"),
+            _("Surface"),
+            _("Perimeter"),
+            _("Height"),
+            _("Width"),
+            _("Rotation"),
+            _("X scale"),
+            _("Y scale"),
+            _("Latitude"),
+            _("Longitude"),
+            _("Attributes"),
+        ]
         keys = [
             "Name",
             "Surface",
@@ -676,7 +1304,33 @@ encoding="UTF-16" standalone="no" ?>
             "Height",
             "Width",
         ]
-        for wd in writer_data:
+        # layer by layer, in a fixed number of queries for each chunk, from
+        # the database of the drawing (rows are streamed after the view)
+        entities = (
+            Entity.objects.using(self._state.db)
+            .filter(layer__drawing=self)
+            .select_related("layer", "block")
+            .prefetch_related("related_data")
+            .order_by("layer__name", "layer_id", "id")
+        )
+        for e in entities.iterator(chunk_size=2000):
+            wd = {
+                "id": e.id,
+                "layer": e.layer.name,
+            }
+            if e.insertion:
+                wd["Latitude"] = e.insertion["coordinates"][0]
+                wd["Longitude"] = e.insertion["coordinates"][1]
+                wd["Block"] = e.block.name
+                wd["X scale"] = e.xscale
+                wd["Y scale"] = e.yscale
+                wd["Rotation"] = e.rotation
+                for ed in e.related_data.all():
+                    wd["attributes"] = {}
+                    wd["attributes"][ed.key] = ed.value
+            else:
+                for ed in e.related_data.all():
+                    wd[ed.key] = ed.value
             row = []
             row.append(wd["id"])
             row.append(wd["layer"])
@@ -713,26 +1367,56 @@ encoding="UTF-16" standalone="no" ?>
                 for key, value in wd["attributes"].items():
                     row.append(key)
                     row.append(value)
-            writer.writerow(row)
-        return writer
+            yield row
 
     def prepare_dxf_to_download(self):
-        blocks = self.related_layers.filter(is_block=True)
-        if not blocks.exists():
-            return
-        block_list = blocks.values_list("id", flat=True)
+        """
+        Returns the path of the DXF file to download: the uploaded file if
+        it has geodata and no insertions were added in the app, else a file
+        derived from it (see `download_path`), the uploaded file is never
+        rewritten. Returns None if an import holds the lock for more than
+        GEOCAD_IMPORT_LOCK_WAIT seconds (default 30).
+        """
+
         # extract entities to be processed
-        entities = Entity.objects.filter(
-            block_id__in=block_list, data__added="true"
-        ).prefetch_related()
-        if not entities.exists():
-            return
+        entities = (
+            Entity.objects.filter(
+                block__drawing_id=self.id, block__is_block=True, added=True
+            )
+            .select_related("layer", "block")
+            .prefetch_related("related_data")
+            .order_by("id")
+        )
+        if self.dxf_georeferenced and not entities.exists():
+            return self.dxf.path
+        wait = getattr(settings, "GEOCAD_IMPORT_LOCK_WAIT", 30)
+        if not self.acquire_import_lock(wait=wait, kind="download"):
+            return None
+        try:
+            self.write_dxf_insertions(entities, self.download_path())
+        finally:
+            # imports wait for downloads instead of queueing behind them
+            self.release_import_lock(run_queued=False)
+        return self.download_path()
+
+    def download_path(self):
+        path = Path(self.dxf.path)
+        return path.with_name(f"{path.stem}.download{path.suffix}")
+
+    def write_dxf_insertions(self, entities, target):
+        import ezdxf
+        from ezdxf.addons import geo
+        from PIL import ImageColor
+
         # prepare transformers
         world2utm, utm2world, utm_wcs, rot = self.prepare_transformers()
         # start DXF
-        doc = ezdxf.readfile(self.dxf.path)
+        doc = self.read_dxf()
         msp = doc.modelspace()
         geodata = msp.get_geodata()
+        if not self.dxf_georeferenced:
+            # geodata from fields
+            geodata = self.fake_geodata(msp.new_geodata(), utm_wcs, rot)
         # get transform matrix from geodata
         m, epsg = geodata.get_crs_transformation(no_checks=True)
         # add insertions
@@ -762,14 +1446,15 @@ encoding="UTF-16" standalone="no" ?>
             for ed in ent.related_data.all():
                 values[ed.key] = ed.value
             block_ref.add_auto_attribs(values)
-            # change JSON so entity is not selected again
-            ent.data["added"] = "false"
-        # update all entities
-        Entity.objects.bulk_update(entities, ["data"])
-        # replace dxf
-        doc.saveas(filename=self.dxf.path, encoding="utf-8", fmt="asc")
+            # matched when the downloaded file is uploaded again
+            ent.handle = block_ref.dxf.handle
+        Entity.objects.bulk_update(entities, ["handle"])
+        self.save_dxf(doc, target)
 
     def write_csv_from_file(self, writer):
+        import ezdxf
+        from shapely import LineString
+
         writer.writerow(
             [
                 _("Layer"),
@@ -780,10 +1465,14 @@ encoding="UTF-16" standalone="no" ?>
                 _("Diameter"),
             ]
         )
-        doc = ezdxf.readfile(self.dxf.path)
-        msp = doc.modelspace()
-        for type in ["LWPOLYLINE", "POLYLINE"]:
-            for ent in msp.query(type):
+        types = ["LWPOLYLINE", "POLYLINE"]
+        if use_streaming(self.dxf.path):
+            queries = [iter_modelspace(self.dxf.path, [type]) for type in types]
+        else:
+            msp = ezdxf.readfile(self.dxf.path).modelspace()
+            queries = [msp.query(type) for type in types]
+        for query in queries:
+            for ent in query:
                 if ent.is_closed:
                     continue
                 if ent.dxf.const_width == 0:
@@ -822,11 +1511,17 @@ class Layer(models.Model):
         _("Layer name"),
         max_length=50,
     )
+    name_clean = SanitizedField(source="name")
     color_field = ColorField(default="#FFFFFF")
     linetype = models.BooleanField(
         _("Continuous linetype"),
         default=True,
     )
+    visible = models.BooleanField(
+        _("Visible by default"),
+        default=True,
+        help_text=_("Entities of hidden layers are loaded when shown in the map"),
+    )
     is_block = models.BooleanField(
         default=False,
         editable=False,
@@ -834,6 +1529,11 @@ class Layer(models.Model):
     geom = GeometryCollectionField(
         null=True,
     )
+    attributes = models.JSONField(
+        _("Default block attributes"),
+        default=dict,
+        editable=False,
+    )
 
     class Meta:
         verbose_name = _("Layer")
@@ -845,33 +1545,184 @@ class Layer(models.Model):
             ),
         ]
 
+    # fields shown in entity popups
+    popup_fields = ["name", "color_field"]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # deferred fields are not loaded
+        self.__original = {f: self.__dict__.get(f) for f in self.popup_fields}
+
     def __str__(self):
         return self.name
 
+    def changed(self, field, update_fields):
+        """True if field is saved and differs from the loaded value"""
+        if update_fields is not None and field not in update_fields:
+            return False
+        return getattr(self, field) != self.__original[field]
+
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        adding = self._state.adding
+        max_length = self._meta.get_field("name").max_length
         # check for layer unique name
+        if adding or self.changed("name", update_fields):
+            siblings = Layer.objects.filter(
+                drawing_id=self.drawing_id,
+                is_block=self.is_block,
+                name__startswith=self.name[: max_length - 8],
+            ).exclude(id=self.id)
+            taken = set(siblings.values_list("name", flat=True))
+            if self.name in taken:
+                self.name = get_unique_name(self.name, taken, max_length)
+        clear = not adding and any(
+            self.changed(field, update_fields) for field in self.popup_fields
+        )
         try:
-            # avoid TransactionManagementError
+            # concurrent saves may take the name after the check
             with transaction.atomic():
                 super().save(*args, **kwargs)
         except IntegrityError:
-            self.name = f"{self.name}_{get_random_string(7)}"
+            self.name = get_unique_name(self.name, {self.name}, max_length)
             super().save(*args, **kwargs)
+        self.__original = {f: getattr(self, f) for f in self.popup_fields}
+        if clear:
+            entities = Entity.objects.filter(
+                models.Q(layer_id=self.id) | models.Q(block_id=self.id)
+            )
+            clear_popup_cache(entities.values_list("id", flat=True))
+
+    def delete(self, *args, **kwargs):
+        touch_drawing(self.drawing_id)
+        return super().delete(*args, **kwargs)
 
 
 def get_default_entity_data():
+    # referenced by old migrations, flags are now columns of Entity
     return {"processed": "true"}
 
 
+# sent with the list of entities stored by bulk_create, which skips post_save
+entities_created = Signal()
+
+
+class EntityQuerySet(models.QuerySet):
+    """
+    Spatial filters run by the database: on spatial columns if the
+    `django_geocad.spatial` app is installed, else on stored bounds of
+    entities, with exact tests in Python on the candidates. Entities without
+    spatial columns (not mirrored yet) are filtered as without the app.
+    Coordinates are longitude / latitude, distances in meters, insertions
+    stored without geometry are tested on their insertion point.
+    """
+
+    def unmirrored(self):
+        """Entities without spatial columns, see `django_geocad.spatial`"""
+        return self.filter(spatial=None)
+
+    def in_bbox(self, west, south, east, north):
+        """Entities whose bounding box overlaps the given one"""
+        by_bounds = self.filter(
+            west__lte=east, east__gte=west, south__lte=north, north__gte=south
+        )
+        if not spatial_backend():
+            return by_bounds
+        ring = [[west, south], [east, south], [east, north], [west, north]]
+        box = {"type": "Polygon", "coordinates": [ring + ring[:1]]}
+        return self.filter(mirror_filter("bboverlaps", box)) | by_bounds.unmirrored()
+
+    def intersects(self, geometry):
+        """Entities intersecting a GeoJSON geometry"""
+        if not spatial_backend():
+            return self._intersecting_shapes(geometry)
+        return self.filter(
+            mirror_filter("intersects", geometry)
+        ) | self.unmirrored()._intersecting_shapes(geometry)
+
+    def _intersecting_shapes(self, geometry):
+        from shapely.geometry import shape
+
+        other = shape(geometry)
+        candidates = self.in_bbox(*other.bounds).only("id", "geom", "insertion")
+        id_list = []
+        for ent in candidates:
+            ent_shape = get_entity_shape(ent)
+            if ent_shape and ent_shape.intersects(other):
+                id_list.append(ent.id)
+        return self.filter(id__in=id_list)
+
+    def dwithin(self, geometry, distance):
+        """Entities within distance (meters) of a GeoJSON geometry"""
+        import shapely
+        from shapely.geometry import shape
+
+        other = shape(geometry)
+        # degrees of latitude and longitude around the geometry
+        lat = other.centroid.y
+        dlat = distance / 111320
+        dlong = dlat / max(cos(radians(lat)), 1e-6)
+        west, south, east, north = other.bounds
+        candidates = self.in_bbox(
+            west - dlong, south - dlat, east + dlong, north + dlat
+        )
+        mirrored = self.none()
+        if spatial_backend():
+            mirrored = candidates.filter(
+                mirror_filter("distance_lte", geometry, distance)
+            )
+            candidates = candidates.unmirrored()
+
+        def to_meters(coords):
+            # equirectangular approximation, good for short distances
+            return coords * [111320 * cos(radians(lat)), 111320]
+
+        other = shapely.transform(other, to_meters)
+        id_list = []
+        for ent in candidates.only("id", "geom", "insertion"):
+            ent_shape = get_entity_shape(ent)
+            if ent_shape and (
+                shapely.transform(ent_shape, to_meters).distance(other) <= distance
+            ):
+                id_list.append(ent.id)
+        return mirrored | self.filter(id__in=id_list)
+
+
 class Entity(models.Model):
 
+    objects = EntityQuerySet.as_manager()
+
     layer = models.ForeignKey(
         Layer,
         on_delete=models.CASCADE,
         related_name="related_entities",
     )
     data = models.JSONField(
-        default=get_default_entity_data,
+        default=dict,
+    )
+    # False for entities of old versions, see populate_block_field
+    processed = models.BooleanField(
+        default=True,
+        editable=False,
+    )
+    # insertions added in the app, not yet written to the DXF file
+    added = models.BooleanField(
+        default=False,
+        editable=False,
+    )
+    # source of imported entities, compared when the DXF file is replaced
+    handle = models.CharField(
+        _("DXF handle"),
+        max_length=16,
+        blank=True,
+        default="",
+        editable=False,
+    )
+    geom_hash = models.CharField(
+        max_length=32,
+        blank=True,
+        default="",
+        editable=False,
     )
     geom = GeometryCollectionField(
         null=True,
@@ -898,107 +1749,110 @@ class Entity(models.Model):
         _("Rotation"),
         default=0,
     )
+    # bounds of geometry (or insertion point) for layer extents
+    west = BoundsField(source="geom", fallback="insertion", side="west")
+    south = BoundsField(source="geom", fallback="insertion", side="south")
+    east = BoundsField(source="geom", fallback="insertion", side="east")
+    north = BoundsField(source="geom", fallback="insertion", side="north")
 
     class Meta:
         verbose_name = _("Entity")
         verbose_name_plural = _("Entities")
+        indexes = [
+            # few rows match, partial indexes stay small
+            models.Index(
+                fields=["block"],
+                condition=models.Q(added=True),
+                name="pending_insertions",
+            ),
+            models.Index(
+                fields=["layer", "id"],
+                condition=models.Q(processed=False),
+                name="unprocessed_entities",
+            ),
+        ]
 
     @property
     def popupContent(self):
-        if "added" in self.data and self.data["added"] == "true":
+        if self.added:
             url = reverse("django_geocad:insertion_change", kwargs={"pk": self.id})
             title_str = f'<p><a href="{url}">ID = {self.id}</a></p>'
         else:
             title_str = f"<p>ID = {self.id}</p>"
         ltype = _("Layer")
-        title_str += f"<ul><li>{ltype}: {nh3.clean(self.layer.name)}</li>"
+        title_str += f"<ul><li>{ltype}: {self.layer.name_clean}</li>"
         if self.block:
             ltype = _("Block")
-            title_str += f"<li>{ltype}: {nh3.clean(self.block.name)}</li>"
+            title_str += f"<li>{ltype}: {self.block.name_clean}</li>"
         data = ""
+        # evaluated, so that prefetched data is used
         ent_data = self.related_data.all()
-        if ent_data.exists():
+        if ent_data:
             if self.block:
                 data += "</ul><p>Attributes</p><ul>"
                 for ed in ent_data:
-                    data += f"<li>{nh3.clean(ed.key)} = {nh3.clean(ed.value)}</li>"
+                    data += f"<li>{ed.key_clean} = {ed.value_clean}</li>"
             else:
                 for ed in ent_data:
-                    data += f"<li>{nh3.clean(ed.key)} = {nh3.clean(ed.value)}</li>"
+                    data += f"<li>{ed.key_clean} = {ed.value_clean}</li>"
         data += "</ul>"
         return {
             "content": title_str + data,
             "color": self.layer.color_field,
             "linetype": self.layer.linetype,
-            "layer": _("Layer - ") + nh3.clean(self.layer.name),
+            "layer": _("Layer - ") + self.layer.name_clean,
         }
 
     def save(self, *args, **kwargs):
-        if "added" in self.data and self.block:
-            # we will use a fake DXF to help us
-            # prepare transformers
+        if self.block and self.insertion and deduplicate_insertions():
+            # expanded from block when serialized, see Drawing.expand_insertions
+            self.geom = None
+        elif self.block and self.insertion:
+            # place block geometries on insertion point
             world2utm, utm2world, utm_wcs, rot = (
                 self.block.drawing.prepare_transformers()
             )
-            # start fake DXF
-            doc = ezdxf.new()
-            msp = doc.modelspace()
-            # we fake geodata
-            geodata = msp.new_geodata()
-            geodata = self.block.drawing.fake_geodata(geodata, utm_wcs, rot)
-            # get transform matrix from fake geodata
-            m, epsg = geodata.get_crs_transformation(no_checks=True)
-            # add block to fake DXF
-            block = doc.blocks.new(name=self.block.name)
-            geometries = self.block.geom["geometries"]
-            for geom in geometries:
-                geo_proxy = geo.GeoProxy.parse(geom)
-                geo_proxy.apply(
-                    lambda v: ezdxf.math.Vec3(world2utm.transform(v.x, v.y))
-                )
-                geo_proxy.crs_to_wcs(m)
-                for entity in geo_proxy.to_dxf_entities(dxfattribs={"layer": "0"}):
-                    block.add_entity(entity)
-            geo_proxy = geo.GeoProxy.parse(self.insertion)
-            geo_proxy.apply(lambda v: ezdxf.math.Vec3(world2utm.transform(v.x, v.y)))
-            geo_proxy.crs_to_wcs(m)
-            for entity in geo_proxy.to_dxf_entities():
-                point = entity.dxf.location
-            instance = msp.add_blockref(
-                self.block.name,
-                point,
-                dxfattribs={
-                    "xscale": self.xscale,
-                    "yscale": self.yscale,
-                    "rotation": self.rotation,
-                    "layer": self.layer.name,
-                },
-            )
-            # use fake instance to generate new geometries
-            geometries = []
-            # 'generator' object has no attribute 'query'
-            for e in instance.virtual_entities():
-                if e.dxftype() in self.block.drawing.entity_types:
-                    # extract entity
-                    geo_proxy = get_geo_proxy(e, m, utm2world)
-                    if geo_proxy:
-                        geometries.append(geo_proxy.__geo_interface__)
-            # update Insertion
-            self.geom = {
-                "geometries": geometries,
-                "type": "GeometryCollection",
-            }
+            m = self.block.drawing.prepare_crs_matrix()
+            template = get_block_template(self.block, world2utm, m)
+            self.geom = expand_block_template(
+                template,
+                [self.insertion["coordinates"]],
+                [self.rotation],
+                [self.xscale],
+                [self.yscale],
+                world2utm,
+                utm2world,
+                m,
+            )[0]
+        adding = self._state.adding
         super().save(*args, **kwargs)
-        if self.block and not self.related_data.exists():
-            first = Entity.objects.filter(block=self.block).first()
-            data = first.related_data.all()
-            if data.exists():
-                for d in data:
-                    EntityData.objects.create(
-                        entity=self,
-                        key=d.key,
-                        value=d.value,
-                    )
+        self.touch_drawing()
+        if not adding:
+            clear_popup_cache([self.id])
+        # new insertions get default attributes of the block
+        if adding and self.block and self.added:
+            EntityData.objects.bulk_create(
+                [
+                    EntityData(entity=self, key=key, value=value)
+                    for key, value in self.block.attributes.items()
+                ]
+            )
+
+    def delete(self, *args, **kwargs):
+        clear_popup_cache([self.id])
+        self.touch_drawing()
+        return super().delete(*args, **kwargs)
+
+    def touch_drawing(self):
+        # imports touch the drawing once, when they are done
+        if current_profiler.get():
+            return
+        if Entity.layer.is_cached(self):
+            drawing_id = self.layer.drawing_id
+        else:
+            layers = Layer.objects.filter(id=self.layer_id)
+            drawing_id = layers.values_list("drawing_id", flat=True).first()
+        touch_drawing(drawing_id)
 
 
 class EntityData(models.Model):
@@ -1016,11 +1870,117 @@ class EntityData(models.Model):
         _("Data value"),
         max_length=100,
     )
+    # rendered in popups
+    key_clean = SanitizedField(source="key")
+    value_clean = SanitizedField(source="value")
+    # read from the DXF file, replaced by differential imports
+    imported = models.BooleanField(default=False, editable=False)
 
     class Meta:
         verbose_name = _("Entity Data")
         verbose_name_plural = _("Entity Data")
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        clear_popup_cache([self.entity_id])
+
+    def delete(self, *args, **kwargs):
+        clear_popup_cache([self.entity_id])
+        return super().delete(*args, **kwargs)
+
+
+class ImportLock(models.Model):
+    """
+    Import lock of a drawing, see `Drawing.acquire_import_lock`. Kept out
+    of the drawing row, so that saving a drawing does not overwrite it.
+    """
+
+    drawing = models.OneToOneField(
+        Drawing,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="import_lock",
+    )
+    # start of the running import, None if no import is running
+    started = models.DateTimeField(
+        null=True,
+    )
+    # operation holding the lock
+    kind = models.CharField(
+        max_length=8,
+        blank=True,
+        default="",
+        choices=[("import", "import"), ("download", "download")],
+    )
+    # import waiting for the running one, with geodata from file or fields
+    queued = models.CharField(
+        max_length=6,
+        blank=True,
+        default="",
+        choices=[("file", "file"), ("fields", "fields")],
+    )
+
+
+class DrawingVersion(models.Model):
+    """
+    Version of the entities of a drawing, see `touch_drawing`. Kept out of
+    the drawing row, so that saving a drawing does not overwrite it.
+    """
+
+    drawing = models.OneToOneField(
+        Drawing,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="entities_version",
+    )
+    # random token, changed with entities of the drawing
+    version = models.CharField(
+        max_length=12,
+    )
+
+
+class ImportReport(models.Model):
+
+    drawing = models.ForeignKey(
+        Drawing,
+        on_delete=models.CASCADE,
+        related_name="import_reports",
+        verbose_name=_("Drawing"),
+    )
+    created = models.DateTimeField(
+        _("Created"),
+        auto_now_add=True,
+    )
+    total_time = models.FloatField(
+        _("Wall time (s)"),
+    )
+    queries = models.PositiveIntegerField(
+        _("Queries"),
+    )
+    entities = models.PositiveIntegerField(
+        _("Entities"),
+    )
+    vertices = models.PositiveIntegerField(
+        _("Vertices"),
+        null=True,
+    )
+    peak_memory = models.PositiveBigIntegerField(
+        _("Peak memory (bytes)"),
+        null=True,
+    )
+    stages = models.JSONField(
+        _("Stages"),
+        default=list,
+    )
+
+    class Meta:
+        verbose_name = _("Import report")
+        verbose_name_plural = _("Import reports")
+        ordering = ("-created",)
+
+    def __str__(self):
+        return f"{self.drawing} - {self.created}"
+
 
 """
     Collection of utilities
@@ -1028,13 +1988,217 @@ class EntityData(models.Model):
 
 
 def cad2hex(color):
+    import ezdxf
+
     if isinstance(color, tuple):
         return "#{:02x}{:02x}{:02x}".format(color[0], color[1], color[2])
     rgb24 = ezdxf.colors.DXF_DEFAULT_COLORS[color]
     return "#{:06X}".format(rgb24)
 
 
+def get_unique_name(name, taken, max_length):
+    # append random suffix until name is not taken
+    while True:
+        unique = f"{name[:max_length - 8]}_{get_random_string(7)}"
+        if unique not in taken:
+            return unique
+
+
+def popup_cache_key(entity_id):
+    return f"django_geocad:popup:{entity_id}"
+
+
+def clear_popup_cache(entity_ids):
+    # popups are cached by the entity_popup view
+    cache.delete_many([popup_cache_key(pk) for pk in entity_ids])
+
+
+def drawing_version(drawing_id):
+    # token changed with entities of the drawing, see spatial_index
+    versions = DrawingVersion.objects.filter(drawing_id=drawing_id)
+    return versions.values_list("version", flat=True).first() or ""
+
+
+def touch_drawing(drawing_id):
+    """
+    Changes the version of the drawing entities. It is stored in the
+    database, so that spatial indexes of all processes see it, and it is
+    committed with the changes: indexes built before the commit keep the
+    old version.
+    """
+
+    DrawingVersion.objects.bulk_create(
+        [DrawingVersion(drawing_id=drawing_id, version=get_random_string(12))],
+        update_conflicts=True,
+        unique_fields=["drawing"],
+        update_fields=["version"],
+    )
+
+
+def deduplicate_insertions():
+    # insertions store point, rotation and scales, not block geometry
+    return getattr(settings, "GEOCAD_DEDUPLICATE_INSERTIONS", False)
+
+
+def delete_signals():
+    # bulk_delete goes through Django's collector, sending delete signals
+    return getattr(settings, "GEOCAD_DELETE_SIGNALS", False)
+
+
+def bulk_delete(queryset):
+    """
+    Deletes rows of queryset and rows depending on them (cascading foreign
+    keys) with one DELETE query for each table, dependents first, in one
+    transaction and without loading them. Delete signals are not sent and
+    `delete` methods of models are not called, unless GEOCAD_DELETE_SIGNALS
+    is set. Returns (total, counts by model) like `QuerySet.delete`.
+    """
+
+    if delete_signals():
+        return queryset.delete()
+    counts = Counter()
+    with transaction.atomic(using=queryset.db):
+        cascade_delete(queryset, counts)
+    return sum(counts.values()), dict(counts)
+
+
+def cascade_delete(queryset, counts):
+    relations = queryset.model._meta.related_objects
+    if any(
+        relation.many_to_many
+        or relation.on_delete not in (models.CASCADE, models.DO_NOTHING)
+        for relation in relations
+    ):
+        # other behaviours (SET_NULL, PROTECT...) are left to the collector
+        counts.update(queryset.delete()[1])
+        return
+    # one query for each table, also if it has many keys to this one
+    conditions = {}
+    for relation in relations:
+        if relation.on_delete is models.CASCADE:
+            condition = models.Q(**{f"{relation.field.name}__in": queryset})
+            model = relation.related_model
+            conditions[model] = conditions.get(model, models.Q()) | condition
+    for model, condition in conditions.items():
+        related = model._base_manager.using(queryset.db).filter(condition)
+        cascade_delete(related, counts)
+    # same query of the collector when it can fast delete
+    deleted = queryset._raw_delete(queryset.db)
+    if deleted:
+        counts[queryset.model._meta.label] += deleted
+
+
+def differential_import():
+    # replaced DXF files update existing entities, see reimport
+    return getattr(settings, "GEOCAD_DIFFERENTIAL_IMPORT", True)
+
+
+def import_on_commit():
+    # imports wait for the transaction of the save, see Drawing.import_dxf
+    return getattr(settings, "GEOCAD_IMPORT_ON_COMMIT", True)
+
+
+def get_entity_hash(entity, data=()):
+    """
+    Hash of what an imported entity gets from the DXF file (layer, block,
+    geometry, insertion, scales, rotation and data), to find changes.
+    """
+
+    source = [
+        entity.layer.name,
+        entity.block.name if entity.block else None,
+        entity.geom,
+        entity.insertion,
+        entity.rotation,
+        entity.xscale,
+        entity.yscale,
+        list(data),
+    ]
+    content = json.dumps(source, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def chunk_vertices():
+    # vertex budget of merged layer entities, 0 keeps one entity per layer
+    return getattr(settings, "GEOCAD_CHUNK_VERTICES", 5000)
+
+
+def chunk_geometries(geometries, max_vertices, max_depth=16):
+    """
+    Splits GeoJSON geometries in groups of nearby geometries with at most
+    max_vertices vertices (a single geometry may exceed them): cells of a
+    quadtree over the centers of geometry extents are divided until they
+    are within budget. Returns lists of geometries.
+    """
+
+    if not max_vertices:
+        return [geometries]
+    items = []
+    for geometry in geometries:
+        bounds = geometry_bounds(geometry) or (0, 0, 0, 0)
+        center = ((bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2)
+        items.append((center, count_vertices(geometry), geometry))
+    chunks = []
+    cells = [(items, 0)]
+    while cells:
+        cell, depth = cells.pop()
+        vertices = sum(item[1] for item in cell)
+        if vertices <= max_vertices or len(cell) == 1 or depth == max_depth:
+            chunks.append([item[2] for item in cell])
+            continue
+        xs = [item[0][0] for item in cell]
+        ys = [item[0][1] for item in cell]
+        x = (min(xs) + max(xs)) / 2
+        y = (min(ys) + max(ys)) / 2
+        quadrants = [[], [], [], []]
+        for item in cell:
+            quadrants[(item[0][0] > x) + 2 * (item[0][1] > y)].append(item)
+        if max(len(q) for q in quadrants) == len(cell):
+            # same center for all geometries, cannot be split
+            chunks.append([item[2] for item in cell])
+            continue
+        cells.extend((q, depth + 1) for q in reversed(quadrants) if q)
+    return chunks
+
+
+def spatial_backend():
+    # geometries mirrored in spatial columns, see django_geocad.spatial
+    return apps.is_installed("django_geocad.spatial")
+
+
+def mirror_filter(lookup, geometry, distance=None):
+    """
+    Spatial lookup on mirrored geometries of entities, or on their insertion
+    point if stored without geometry. Takes a GeoJSON geometry and an
+    optional distance in meters.
+    """
+
+    from django.contrib.gis.geos import GEOSGeometry
+    from django.contrib.gis.measure import D
+
+    value = GEOSGeometry(json.dumps(geometry), srid=4326)
+    if distance is not None:
+        value = (value, D(m=distance))
+    return models.Q(**{f"spatial__geom__{lookup}": value}) | models.Q(
+        spatial__geom=None, **{f"spatial__insertion__{lookup}": value}
+    )
+
+
+def get_entity_shape(entity):
+    """Shapely geometry of entity (or of its insertion point), None if invalid"""
+    from shapely.geometry import shape
+
+    try:
+        return shape(entity.geom or entity.insertion)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
 def get_geo_proxy(entity, matrix, transformer):
+    import ezdxf
+    from ezdxf.addons import geo
+    from shapely.geometry import shape
+
     geo_proxy = geo.proxy(entity)
     if geo_proxy.geotype == "Polygon":
         if not shape(geo_proxy).is_valid:
@@ -1042,3 +2206,85 @@ def get_geo_proxy(entity, matrix, transformer):
     geo_proxy.wcs_to_crs(matrix)
     geo_proxy.apply(lambda v: ezdxf.math.Vec3(transformer.transform(v.x, v.y)))
     return geo_proxy
+
+
+def world_to_wcs(coords, world2utm, matrix):
+    import numpy as np
+
+    # vectorized GeoProxy.crs_to_wcs, coords is a (n, 2) array
+    rows = np.array(list(matrix.rows()))
+    x, y = world2utm.transform(coords[:, 0], coords[:, 1])
+    crs = np.column_stack((x, y)) - rows[3, :2]
+    return crs @ rows[:2, :2].T
+
+
+def wcs_to_world(coords, utm2world, matrix):
+    import numpy as np
+
+    # vectorized GeoProxy.wcs_to_crs, coords is a (n, 2) array
+    rows = np.array(list(matrix.rows()))
+    crs = coords @ rows[:2, :2] + rows[3, :2]
+    x, y = utm2world.transform(crs[:, 0], crs[:, 1])
+    return np.column_stack((x, y))
+
+
+def get_block_template(block, world2utm, matrix):
+    """Returns block geometries as shapely objects in block coordinates"""
+    import shapely
+
+    geometries = shapely.from_geojson(
+        [json.dumps(geom) for geom in block.geom["geometries"]]
+    )
+    return shapely.transform(
+        geometries, lambda coords: world_to_wcs(coords, world2utm, matrix)
+    )
+
+
+def expand_block_template(
+    template, points, rotations, xscales, yscales, world2utm, utm2world, matrix
+):
+    """
+    Places block template for each insertion point (longitude, latitude)
+    with given rotations (degrees) and scales, all coordinates are
+    transformed at once. Returns a GeometryCollection for each insertion.
+    """
+
+    import numpy as np
+    import shapely
+    from shapely.geometry import mapping
+
+    if len(points) == 0:
+        return []
+    size = len(template)
+    vertices = shapely.get_num_coordinates(template)
+    # one template copy for each insertion
+    geometries = np.tile(template, len(points))
+    origins = world_to_wcs(np.array(points, dtype=float), world2utm, matrix)
+    angles = np.radians(np.array(rotations, dtype=float))
+    scales = np.column_stack(
+        (np.array(xscales, dtype=float), np.array(yscales, dtype=float))
+    )
+    # repeat insertion parameters for every vertex
+    repeats = np.full(len(points), vertices.sum())
+
+    def transformation(coords):
+        scaled = coords * np.repeat(scales, repeats, axis=0)
+        cos_a = np.repeat(np.cos(angles), repeats)
+        sin_a = np.repeat(np.sin(angles), repeats)
+        rotated = np.column_stack(
+            (
+                scaled[:, 0] * cos_a - scaled[:, 1] * sin_a,
+                scaled[:, 0] * sin_a + scaled[:, 1] * cos_a,
+            )
+        )
+        wcs = rotated + np.repeat(origins, repeats, axis=0)
+        return wcs_to_world(wcs, utm2world, matrix)
+
+    geometries = shapely.transform(geometries, transformation)
+    return [
+        {
+            "geometries": [mapping(g) for g in geometries[i * size : (i + 1) * size]],
+            "type": "GeometryCollection",
+        }
+        for i in range(len(points))
+    ]
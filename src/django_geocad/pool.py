@@ -0,0 +1,78 @@
+"""
+Helpers of async views. File reads and ezdxf work run in a bounded thread
+pool (GEOCAD_ASYNC_WORKERS threads, default 4), so that one ASGI process
+serves many clients without a thread for each download, while database
+work stays in the thread of the request (see `sync_to_async`). Code run in
+the pool must not touch the database.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, "GEOCAD_ASYNC_WORKERS", 4),
+                thread_name_prefix="django_geocad",
+            )
+        return _executor
+
+
+async def run_in_pool(func, *args, **kwargs):
+    """Runs func in the bounded pool, without blocking the event loop"""
+    return await sync_to_async(func, thread_sensitive=False, executor=get_executor())(
+        *args, **kwargs
+    )
+
+
+async def iterate_in_thread(iterator, pool=False):
+    """
+    Async iterator over a sync one, each step runs in the thread of the
+    request (it may query the database) or in the bounded pool.
+    """
+
+    if pool:
+        step = sync_to_async(next, thread_sensitive=False, executor=get_executor())
+    else:
+        step = sync_to_async(next)
+    done = object()
+    while True:
+        chunk = await step(iterator, done)
+        if chunk is done:
+            return
+        yield chunk
+
+
+def stream(request, iterator, pool=False):
+    """
+    Content of a StreamingHttpResponse: an async iterator under ASGI, the
+    sync iterator itself under WSGI (which would consume an async one at
+    once).
+    """
+
+    if isinstance(request, ASGIRequest):
+        return iterate_in_thread(iterator, pool=pool)
+    return iterator
+
+
+def file_chunks(path, chunk_size=64 * 1024):
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+class Echo:
+    """File-like object returning what is written, for `csv.writer`"""
+
+    def write(self, value):
+        return value
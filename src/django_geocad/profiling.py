@@ -0,0 +1,171 @@
+import logging
+import time
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger("django_geocad.import")
+
+# profiler of the import running in current context
+current_profiler = ContextVar("geocad_import_profiler", default=None)
+
+
+class ImportProfiler:
+    """
+    Records wall time, database queries, entities, vertices and peak memory
+    of each stage of a drawing import, then stores them in an `ImportReport`
+    and hands them to logging and to the optional metrics callback. Stages
+    are declared in models with `profile_stage`, counts with `record`, both
+    do nothing if no import is being profiled.
+
+    Settings:
+
+    - **GEOCAD_IMPORT_REPORTS** (default `True`): store reports.
+    - **GEOCAD_PROFILE_MEMORY** (default `False`): trace peak memory
+      with `tracemalloc`, which slows down imports.
+    - **GEOCAD_PROFILE_VERTICES** (default `False`): count vertices of
+      extracted geometries, which walks every geometry.
+    - **GEOCAD_METRICS_CALLBACK** (default `None`): callable or dotted path,
+      called with drawing and report data.
+    """
+
+    def __init__(self, drawing):
+        self.drawing = drawing
+        self.stages = []
+        self.stage = None
+        self.trace_memory = getattr(settings, "GEOCAD_PROFILE_MEMORY", False)
+        self.trace_vertices = getattr(settings, "GEOCAD_PROFILE_VERTICES", False)
+
+    def __enter__(self):
+        self.token = current_profiler.set(self)
+        self.start = time.perf_counter()
+        self.tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        current_profiler.reset(self.token)
+        total_time = time.perf_counter() - self.start
+        if self.tracing:
+            tracemalloc.stop()
+        if exc_type or not self.stages:
+            return False
+        self.report(total_time)
+        return False
+
+    @contextmanager
+    def profile(self, name):
+        if self.stage:
+            # nested stages are accounted to the outer one
+            yield
+            return
+        self.stage = {
+            "name": name,
+            "time": 0,
+            "queries": 0,
+            "db_time": 0,
+            "entities": 0,
+            "vertices": 0 if self.trace_vertices else None,
+            "peak_memory": None,
+        }
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(self.count_query):
+                yield
+        finally:
+            self.stage["time"] = time.perf_counter() - start
+            if self.trace_memory and tracemalloc.is_tracing():
+                self.stage["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            self.stages.append(self.stage)
+            logger.debug("Drawing %s, stage: %s", self.drawing.id, self.stage)
+            self.stage = None
+
+    def count_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.stage["queries"] += 1
+            self.stage["db_time"] += time.perf_counter() - start
+
+    def record(self, entities=0, geometry=None):
+        if not self.stage:
+            return
+        self.stage["entities"] += entities
+        if geometry and self.trace_vertices:
+            # GeoJSON dict or object with __geo_interface__, built if needed
+            geometry = getattr(geometry, "__geo_interface__", geometry)
+            self.stage["vertices"] += count_vertices(geometry)
+
+    def report(self, total_time):
+        from .models import ImportReport
+
+        peaks = [s["peak_memory"] for s in self.stages if s["peak_memory"]]
+        vertices = None
+        if self.trace_vertices:
+            vertices = sum(s["vertices"] for s in self.stages)
+        data = {
+            "total_time": total_time,
+            "queries": sum(s["queries"] for s in self.stages),
+            "entities": sum(s["entities"] for s in self.stages),
+            "vertices": vertices,
+            "peak_memory": max(peaks) if peaks else None,
+            "stages": self.stages,
+        }
+        logger.info(
+            "Drawing %s imported in %.3fs: %s queries, %s entities, %s vertices",
+            self.drawing.id,
+            data["total_time"],
+            data["queries"],
+            data["entities"],
+            data["vertices"],
+        )
+        callback = getattr(settings, "GEOCAD_METRICS_CALLBACK", None)
+        if callback:
+            if isinstance(callback, str):
+                callback = import_string(callback)
+            callback(self.drawing, data)
+        if getattr(settings, "GEOCAD_IMPORT_REPORTS", True):
+            ImportReport.objects.create(drawing=self.drawing, **data)
+
+
+@contextmanager
+def profile_stage(name):
+    """Declares an import stage, if an import is being profiled"""
+    profiler = current_profiler.get()
+    if not profiler:
+        yield
+        return
+    with profiler.profile(name):
+        yield
+
+
+def record(entities=0, geometry=None):
+    """
+    Counts entities, and vertices of a geometry if GEOCAD_PROFILE_VERTICES
+    is set, in current import stage.
+    """
+    profiler = current_profiler.get()
+    if profiler:
+        profiler.record(entities, geometry)
+
+
+def count_vertices(geometry):
+    if "geometries" in geometry:
+        return sum(count_vertices(g) for g in geometry["geometries"])
+    return count_coordinates(geometry["coordinates"])
+
+
+def count_coordinates(coordinates):
+    if not coordinates:
+        return 0
+    if isinstance(coordinates[0], (int, float)):
+        return 1
+    return sum(count_coordinates(c) for c in coordinates)
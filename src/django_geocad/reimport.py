@@ -0,0 +1,218 @@
+"""
+Differential import of a replaced DXF file. Extracted entities are
+compared to the stored ones instead of saved: entities with a DXF handle
+are matched by handle, merged layer entities (which have no handle) by
+hash. Only added, changed and removed entities are written, with bulk
+queries, so that unchanged entities keep their ids and data, and
+insertions added in the app (not yet in the file) are left alone. Layers
+and blocks missing from the new file are deleted, unless they hold such
+insertions.
+"""
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from .fields import BoundsField, SanitizedField
+from .models import (
+    Entity,
+    EntityData,
+    Layer,
+    bulk_delete,
+    clear_popup_cache,
+    entities_created,
+    touch_drawing,
+)
+from .profiling import logger, record
+
+# fields written when an entity changes
+CHANGED_FIELDS = [
+    "layer",
+    "block",
+    "geom",
+    "insertion",
+    "rotation",
+    "xscale",
+    "yscale",
+    "geom_hash",
+    "added",
+]
+
+
+class ImportDiff:
+    """
+    Entities extracted from the new file (see `Drawing.store_entity`),
+    compared to the stored entities of the drawing as they come. Added and
+    changed entities are written in batches of `batch_size`, so that
+    streamed imports keep only a batch in memory; `apply` writes the last
+    batch and deletes stored entities missing from the new file.
+    """
+
+    batch_size = 1000
+
+    def __init__(self, drawing):
+        self.drawing = drawing
+        self.added = []
+        self.changed = []
+        self.counts = {"added": 0, "changed": 0, "removed": 0, "unchanged": 0}
+        self.by_handle, self.by_hash, self.downloaded = self.load()
+
+    def load(self):
+        """
+        Maps handles to ids and hashes of stored entities, hashes to ids,
+        and handles to ids of insertions added in the app that were written
+        to a downloaded file.
+        """
+
+        stored = Entity.objects.filter(layer__drawing_id=self.drawing.id)
+        by_handle = {}
+        by_hash = {}
+        downloaded = {}
+        for pk, handle, geom_hash, added in stored.values_list(
+            "id", "handle", "geom_hash", "added"
+        ).iterator():
+            if added:
+                if handle:
+                    downloaded[handle] = pk
+            elif handle:
+                by_handle[handle] = (pk, geom_hash)
+            else:
+                by_hash.setdefault(geom_hash, []).append(pk)
+        return by_handle, by_hash, downloaded
+
+    def add(self, ent, data=()):
+        if ent.handle and ent.handle in self.by_handle:
+            pk, geom_hash = self.by_handle.pop(ent.handle)
+            if geom_hash == ent.geom_hash:
+                self.counts["unchanged"] += 1
+                return
+            ent.id = pk
+            self.changed.append((ent, list(data)))
+        elif ent.handle and ent.handle in self.downloaded:
+            # back from a downloaded file, no longer added in the app
+            ent.id = self.downloaded.pop(ent.handle)
+            self.changed.append((ent, list(data)))
+        elif not ent.handle and self.by_hash.get(ent.geom_hash):
+            self.by_hash[ent.geom_hash].pop()
+            self.counts["unchanged"] += 1
+            return
+        else:
+            self.added.append((ent, list(data)))
+        if len(self.added) + len(self.changed) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes added and changed entities collected so far"""
+        with transaction.atomic():
+            self.create(self.added)
+            self.update(self.changed)
+        self.counts["added"] += len(self.added)
+        self.counts["changed"] += len(self.changed)
+        self.added = []
+        self.changed = []
+
+    def removed(self):
+        """Ids of stored entities not matched by entities of the new file"""
+        removed = [pk for pk, geom_hash in self.by_handle.values()]
+        removed += [pk for ids in self.by_hash.values() for pk in ids]
+        return removed
+
+    def apply(self, kept=()):
+        """
+        Writes the last batch, deletes removed entities, then layers and
+        blocks of the drawing not in `kept` (those of the new file), unless
+        they hold insertions added in the app.
+        """
+
+        self.flush()
+        removed = self.removed()
+        with transaction.atomic():
+            for start in range(0, len(removed), self.batch_size):
+                batch = removed[start : start + self.batch_size]
+                bulk_delete(Entity.objects.filter(id__in=batch))
+            self.delete_layers(kept)
+            touch_drawing(self.drawing.id)
+        self.counts["removed"] = len(removed)
+        record(self.counts["added"] + self.counts["changed"])
+        logger.info("Drawing %s differential import: %s", self.drawing.id, self.counts)
+        return self.counts
+
+    def delete_layers(self, kept):
+        added = Entity.objects.filter(added=True)
+        stale = (
+            Layer.objects.filter(drawing_id=self.drawing.id)
+            .exclude(id__in=[layer.id for layer in kept])
+            .exclude(Exists(added.filter(layer_id=OuterRef("pk"))))
+            .exclude(Exists(added.filter(block_id=OuterRef("pk"))))
+        )
+        bulk_delete(stale)
+
+    def create(self, added):
+        entities = [ent for ent, data in added]
+        Entity.objects.bulk_create(entities, batch_size=self.batch_size)
+        entities_created.send(sender=Entity, entities=entities)
+        EntityData.objects.bulk_create(
+            [
+                EntityData(entity=ent, key=key, value=value, imported=True)
+                for ent, data in added
+                for key, value in data
+            ],
+            batch_size=self.batch_size,
+        )
+
+    def update(self, changed):
+        """
+        Writes changed entities and values of their data keys. Keys read
+        from the previous file and gone from the new one are deleted, data
+        with other keys (for example added in the app) is kept.
+        """
+
+        entities = [ent for ent, data in changed]
+        # computed fields are not refreshed by bulk_update
+        bounds = [f for f in Entity._meta.fields if isinstance(f, BoundsField)]
+        for ent in entities:
+            for field in bounds:
+                field.pre_save(ent, False)
+        Entity.objects.bulk_update(
+            entities,
+            CHANGED_FIELDS + [field.name for field in bounds],
+            batch_size=self.batch_size,
+        )
+        # spatial mirror is refreshed as for new entities
+        entities_created.send(sender=Entity, entities=entities)
+        ids = [ent.id for ent in entities]
+        stored = {}
+        for start in range(0, len(ids), self.batch_size):
+            batch = ids[start : start + self.batch_size]
+            for ed in EntityData.objects.filter(entity_id__in=batch):
+                stored.setdefault((ed.entity_id, ed.key), ed)
+        updated = []
+        new = []
+        for ent, data in changed:
+            for key, value in data:
+                ed = stored.pop((ent.id, key), None)
+                if ed is None:
+                    new.append(
+                        EntityData(entity=ent, key=key, value=value, imported=True)
+                    )
+                elif ed.value != str(value) or not ed.imported:
+                    ed.value = value
+                    ed.imported = True
+                    updated.append(ed)
+        # left over keys are not in the new file
+        removed = [ed.id for ed in stored.values() if ed.imported]
+        sanitized = [
+            f for f in EntityData._meta.fields if isinstance(f, SanitizedField)
+        ]
+        for ed in updated:
+            for field in sanitized:
+                field.pre_save(ed, False)
+        EntityData.objects.bulk_update(
+            updated,
+            ["value", "imported"] + [field.name for field in sanitized],
+            batch_size=self.batch_size,
+        )
+        EntityData.objects.bulk_create(new, batch_size=self.batch_size)
+        for start in range(0, len(removed), self.batch_size):
+            batch = removed[start : start + self.batch_size]
+            EntityData.objects.filter(id__in=batch).delete()
+        clear_popup_cache(ids)
@@ -0,0 +1,139 @@
+"""
+Routing of map reads to a replica database. Views decorated with
+`read_from_replica` read models of the app from GEOCAD_REPLICA_DATABASE
+(an alias of DATABASES), while writes and all other views use the primary
+(`default`). Add `ReplicaRouter` to DATABASE_ROUTERS to enable it.
+
+Replicas lag behind the primary: after a write in an editor view or in
+the drawing admin (see `sticky_primary`) a cookie sends reads of that
+client to the primary for GEOCAD_REPLICA_STICKY_SECONDS seconds (default
+10), so that the map shows what was just saved.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+STICKY_COOKIE = "geocad_primary"
+
+# alias read by the current view, None for the primary
+_database = ContextVar("django_geocad_read_database", default=None)
+
+
+def get_replica():
+    return getattr(settings, "GEOCAD_REPLICA_DATABASE", None)
+
+
+class ReplicaRouter:
+    """Reads of django_geocad models inside `read_from_replica` views"""
+
+    def db_for_read(self, model, **hints):
+        if is_geocad(model):
+            return _database.get()
+        return None
+
+    def db_for_write(self, model, **hints):
+        # instances read from the replica are saved to the primary
+        replica = get_replica()
+        instance = hints.get("instance")
+        if (
+            replica
+            and is_geocad(model)
+            and instance is not None
+            and instance._state.db == replica
+        ):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replica rows are rows of the primary
+        replica = get_replica()
+        if not replica or not (is_geocad(obj1) or is_geocad(obj2)):
+            return None
+        aliases = {DEFAULT_DB_ALIAS, replica}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+
+def is_geocad(model):
+    # models and instances of the app, the only ones read from the replica
+    return model._meta.app_label == "django_geocad"
+
+
+@contextmanager
+def reading_from(alias):
+    token = _database.set(alias)
+    try:
+        yield
+    finally:
+        _database.reset(token)
+
+
+def read_database(request):
+    """Replica alias for reads of request, None if its client just wrote"""
+    if request.COOKIES.get(STICKY_COOKIE):
+        return None
+    return get_replica()
+
+
+def read_from_replica(view):
+    """
+    Decorator of read-only views, sync or async. Template responses are
+    rendered in the view, as templates evaluate querysets.
+    """
+
+    def render(response):
+        if hasattr(response, "render") and not response.is_rendered:
+            response.render()
+        return response
+
+    if iscoroutinefunction(view):
+
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            with reading_from(read_database(request)):
+                return render(await view(request, *args, **kwargs))
+
+    else:
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            with reading_from(read_database(request)):
+                return render(view(request, *args, **kwargs))
+
+    return wrapper
+
+
+def stick_to_primary(request, response):
+    """Sends reads of the client to the primary, after a successful write"""
+    if (
+        get_replica()
+        and request.method not in ("GET", "HEAD", "OPTIONS")
+        and response.status_code < 400
+    ):
+        response.set_cookie(
+            STICKY_COOKIE,
+            "1",
+            max_age=getattr(settings, "GEOCAD_REPLICA_STICKY_SECONDS", 10),
+            httponly=True,
+            samesite="Lax",
+        )
+    return response
+
+
+def sticky_primary(view):
+    """
+    Decorator of editor views: after a successful write the client reads
+    from the primary for a while (see `read_database`).
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        return stick_to_primary(request, view(request, *args, **kwargs))
+
+    return wrapper
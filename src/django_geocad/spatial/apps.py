@@ -0,0 +1,28 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_save
+
+
+def mirror_saved_entity(sender, instance, **kwargs):
+    from .models import mirror_entities
+
+    mirror_entities([instance])
+
+
+def mirror_created_entities(sender, entities, **kwargs):
+    from .models import mirror_entities
+
+    mirror_entities(entities)
+
+
+class SpatialConfig(AppConfig):
+    default_auto_field = "django.db.models.BigAutoField"
+    name = "django_geocad.spatial"
+    label = "django_geocad_spatial"
+    verbose_name = "GeoCAD spatial index"
+
+    def ready(self):
+        from django_geocad.models import Entity, entities_created
+
+        post_save.connect(mirror_saved_entity, sender=Entity)
+        # bulk_create does not send post_save
+        entities_created.connect(mirror_created_entities, sender=Entity)
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:18
+
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+from django_geocad.spatial.models import to_geos
+
+
+def mirror_existing(apps, schema_editor):
+    # geometries of existing entities, in batches
+    Entity = apps.get_model("django_geocad", "Entity")
+    EntityGeometry = apps.get_model("django_geocad_spatial", "EntityGeometry")
+    batch = []
+    entities = Entity.objects.only("id", "geom", "insertion")
+    for ent in entities.iterator(chunk_size=1000):
+        batch.append(
+            EntityGeometry(
+                entity_id=ent.id,
+                geom=to_geos(ent.geom),
+                insertion=to_geos(ent.insertion),
+            )
+        )
+        if len(batch) == 1000:
+            EntityGeometry.objects.bulk_create(batch)
+            batch = []
+    EntityGeometry.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ("django_geocad", "0016_entity_flags"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EntityGeometry",
+            fields=[
+                (
+                    "entity",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="spatial",
+                        serialize=False,
+                        to="django_geocad.entity",
+                    ),
+                ),
+                (
+                    "geom",
+                    django.contrib.gis.db.models.fields.GeometryField(
+                        null=True, srid=4326
+                    ),
+                ),
+                (
+                    "insertion",
+                    django.contrib.gis.db.models.fields.PointField(
+                        null=True, srid=4326
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Entity geometry",
+                "verbose_name_plural": "Entity geometries",
+            },
+        ),
+        migrations.RunPython(mirror_existing, migrations.RunPython.noop),
+    ]
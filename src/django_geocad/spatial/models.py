@@ -0,0 +1,64 @@
+import json
+
+from django.contrib.gis.db import models
+from django.contrib.gis.gdal import GDALException
+from django.contrib.gis.geos import GEOSException, GEOSGeometry
+from django.utils.translation import gettext_lazy as _
+
+from django_geocad.models import Entity
+
+
+def to_geos(geometry):
+    """GeoJSON dictionary to GEOS geometry, None if empty or invalid"""
+    if not geometry:
+        return None
+    try:
+        return GEOSGeometry(json.dumps(geometry), srid=4326)
+    except (GEOSException, GDALException, ValueError):
+        return None
+
+
+def mirror_entities(entities):
+    """Copies geometry and insertion point of entities, in one query"""
+    mirrors = [
+        EntityGeometry(
+            entity_id=ent.id,
+            geom=to_geos(ent.geom),
+            insertion=to_geos(ent.insertion),
+        )
+        for ent in entities
+    ]
+    EntityGeometry.objects.bulk_create(
+        mirrors,
+        update_conflicts=True,
+        unique_fields=["entity"],
+        update_fields=["geom", "insertion"],
+    )
+
+
+class EntityGeometry(models.Model):
+    """
+    Copy of `Entity.geom` and `Entity.insertion` in spatial columns (with
+    GiST / R*Tree indexes), so that spatial filters of `Entity.objects` run
+    in the database. Kept in sync when entities are saved or created in
+    bulk.
+    """
+
+    entity = models.OneToOneField(
+        Entity,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="spatial",
+    )
+    geom = models.GeometryField(
+        srid=4326,
+        null=True,
+    )
+    insertion = models.PointField(
+        srid=4326,
+        null=True,
+    )
+
+    class Meta:
+        verbose_name = _("Entity geometry")
+        verbose_name_plural = _("Entity geometries")
@@ -0,0 +1,146 @@
+"""
+In-memory spatial index of drawings, for deployments without a spatial
+database. A shapely STRtree over entity geometries of a drawing is built on
+first use and kept in a process-level LRU cache, keyed by the drawing
+version (see `drawing_version`), so that any change of entities builds a
+new one. Geometries are projected on a plane tangent at the drawing
+location, distances are in meters.
+"""
+
+import threading
+from collections import OrderedDict
+from math import cos, radians
+
+import numpy as np
+import shapely
+from django.conf import settings
+from shapely.geometry import Point, box
+
+from .models import Entity, drawing_version, get_entity_shape
+
+# meters of a degree of latitude
+DEGREE = 111320
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+class DrawingIndex:
+    """
+    STRtree of entity geometries (insertions stored without geometry are
+    expanded) of a drawing, with query helpers taking longitude / latitude
+    and returning entity ids, nearest first where it makes sense.
+    """
+
+    def __init__(self, drawing):
+        self.drawing_id = drawing.id
+        self.latitude = drawing.geom["coordinates"][1]
+        self.scale = np.array([DEGREE * cos(radians(self.latitude)), DEGREE])
+        entities = Entity.objects.filter(
+            layer__drawing=drawing, layer__is_block=False
+        ).select_related("block")
+        ids = []
+        geometries = []
+        for ent in drawing.expand_insertions(entities):
+            geometry = get_entity_shape(ent)
+            if geometry is not None and not geometry.is_empty:
+                ids.append(ent.id)
+                geometries.append(geometry)
+        self.ids = np.array(ids, dtype=np.int64)
+        self.geometries = shapely.transform(
+            np.array(geometries, dtype=object), self.to_plane
+        )
+        self.tree = shapely.STRtree(self.geometries)
+        # rough estimate: coordinates plus geometry and tree overhead
+        coordinates = int(shapely.get_num_coordinates(self.geometries).sum())
+        self.size = coordinates * 16 + len(ids) * 200
+
+    def to_plane(self, coords):
+        return coords * self.scale
+
+    def to_world(self, coords):
+        return coords / self.scale
+
+    def point(self, long, lat):
+        return Point(self.to_plane(np.array([long, lat])))
+
+    def bbox(self, west, south, east, north):
+        """Ids of entities intersecting the box"""
+        (west, south), (east, north) = self.to_plane(
+            np.array([[west, south], [east, north]])
+        )
+        found = self.tree.query(box(west, south, east, north), predicate="intersects")
+        return self.ids[np.sort(found)].tolist()
+
+    def point_in(self, long, lat):
+        """Ids of entities containing (or touching) the point"""
+        found = self.tree.query(self.point(long, lat), predicate="intersects")
+        return self.ids[np.sort(found)].tolist()
+
+    def within_distance(self, long, lat, distance):
+        """Ids of entities within distance of the point, nearest first"""
+        point = self.point(long, lat)
+        found = self.tree.query(point, predicate="dwithin", distance=distance)
+        distances = shapely.distance(self.geometries[found], point)
+        return self.ids[found[np.argsort(distances, kind="stable")]].tolist()
+
+    def nearest(self, long, lat, max_distance=None):
+        """Id and distance of the nearest entity, None if none is in range"""
+        found, distances = self.tree.query_nearest(
+            self.point(long, lat),
+            max_distance=max_distance,
+            return_distance=True,
+        )
+        if not len(found):
+            return None
+        return int(self.ids[found[0]]), float(distances[0])
+
+    def snap(self, long, lat, distance):
+        """
+        Longitude / latitude of the nearest vertex of entities within
+        distance of the point, None if there is none.
+        """
+        point = self.point(long, lat)
+        found = self.tree.query(point, predicate="dwithin", distance=distance)
+        if not len(found):
+            return None
+        vertices = shapely.get_coordinates(self.geometries[found])
+        offsets = np.hypot(*(vertices - [point.x, point.y]).T)
+        nearest = offsets.argmin()
+        if offsets[nearest] > distance:
+            return None
+        return self.to_world(vertices[nearest]).tolist()
+
+
+def get_index(drawing):
+    """
+    Spatial index of drawing, from cache if its version did not change.
+    Least recently used indexes are evicted beyond GEOCAD_INDEX_CACHE_SIZE
+    drawings or GEOCAD_INDEX_MEMORY bytes (estimated).
+    """
+
+    key = (drawing.id, drawing_version(drawing.id))
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+    # built outside the lock, concurrent requests may build it twice
+    index = DrawingIndex(drawing)
+    max_size = getattr(settings, "GEOCAD_INDEX_CACHE_SIZE", 16)
+    max_memory = getattr(settings, "GEOCAD_INDEX_MEMORY", 128 * 1024 * 1024)
+    with _lock:
+        # older versions of the drawing are stale
+        for stale in [k for k in _indexes if k[0] == drawing.id]:
+            del _indexes[stale]
+        _indexes[key] = index
+        memory = sum(i.size for i in _indexes.values())
+        while len(_indexes) > 1 and (len(_indexes) > max_size or memory > max_memory):
+            evicted_key, evicted = _indexes.popitem(last=False)
+            memory -= evicted.size
+    return index
+
+
+def clear_indexes():
+    with _lock:
+        _indexes.clear()
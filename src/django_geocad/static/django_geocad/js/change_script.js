@@ -1,10 +1,13 @@
 function map_init(map, options) {
 
+    const lines = JSON.parse(document.getElementById("line_data").textContent);
+
     function setLineStyle(feature) {
-      if (feature.properties.popupContent.linetype) {
-        return {"color": feature.properties.popupContent.color, "weight": 3 };
+      const style = lines.layers[feature.properties.layer];
+      if (style.linetype) {
+        return {"color": style.color, "weight": 3 };
       } else {
-        return {"color": feature.properties.popupContent.color, "weight": 3, dashArray: "10, 10" };
+        return {"color": style.color, "weight": 3, dashArray: "10, 10" };
       }
     }
 
@@ -16,6 +19,8 @@ function map_init(map, options) {
     const layer_control = L.control.layers(null).addTo(map);
     const marker_layer = L.layerGroup().addTo(map);
 
+    const renderer = JSON.parse(document.getElementById("renderer_data").textContent);
+
     function getCollections() {
       // add layer groups
       collection = JSON.parse(document.getElementById("layer_data").textContent);
@@ -33,24 +38,51 @@ function map_init(map, options) {
       }
       // fit bounds
       map.fitBounds(L.geoJson(collection).getBounds(), {padding: [30,30]});
-      collection = JSON.parse(document.getElementById("line_data").textContent);
-      if (collection !== null) {
-        for (line of collection.features) {
-          let name = line.properties.popupContent.layer
-          L.geoJson(line, {style: setLineStyle}).addTo(window[name]);
+      // one GeoJSON layer for each drawing layer
+      const features = lines.layers.map(() => []);
+      for (line of lines.features) {
+        features[line.properties.layer].push(line);
+      }
+      lines.layers.forEach(function (layer, i) {
+        let options = {style: setLineStyle};
+        if (renderer === "canvas") {
+          // paths of the layer on one canvas, instead of a DOM node each
+          options.renderer = L.canvas({padding: 0.5});
         }
+        L.geoJson({type: "FeatureCollection", features: features[i]}, options).addTo(window[layer.group]);
+      });
+      // block insertions drawn on canvas, see instance_layer.js
+      const instances = document.getElementById("instance_data");
+      if (instances !== null) {
+        addInstanceLayers(JSON.parse(instances.textContent), {});
       }
     }
 
     getCollections()
 
-    function onMapClick(e) {
+    function setInsertion(lat, lng) {
       var inputlat = document.getElementById("id_lat");
         var inputlong = document.getElementById("id_long");
-        inputlat.setAttribute('value', e.latlng.lat);
-        inputlong.setAttribute('value', e.latlng.lng);
+        inputlat.setAttribute('value', lat);
+        inputlong.setAttribute('value', lng);
         marker_layer.clearLayers();
-        L.marker([e.latlng.lat, e.latlng.lng]).addTo(marker_layer)
+        L.marker([lat, lng]).addTo(marker_layer)
+    }
+
+    const identify_url = JSON.parse(document.getElementById("identify_url").textContent);
+
+    function onMapClick(e) {
+      setInsertion(e.latlng.lat, e.latlng.lng);
+      // snap to the nearest vertex within 10 pixels
+      const meters = 10 * 40075016.686 * Math.cos(e.latlng.lat * Math.PI / 180) / Math.pow(2, map.getZoom() + 8);
+      const params = new URLSearchParams({lat: e.latlng.lat, long: e.latlng.lng, distance: meters});
+      fetch(identify_url + "?" + params)
+        .then(response => response.json())
+        .then(function (data) {
+          if (data.snap) {
+            setInsertion(data.snap[1], data.snap[0]);
+          }
+        });
     }
 
     map.on('click', onMapClick);
@@ -0,0 +1,191 @@
+// Block insertions drawn on canvas: each block template becomes a Path2D
+// once, then it is placed on every insertion with a transformation matrix.
+// Data come from Drawing.get_block_instances(), insertion rows are
+// [lng, lat, rotation, xscale, yscale, layer, block, id].
+
+function templatePath(geometries) {
+    // polylines are stroked, polygons are stroked and filled, points and
+    // other geometries are not drawn
+    const paths = {lines: new Path2D(), areas: new Path2D(), box: [Infinity, Infinity, -Infinity, -Infinity]};
+
+    function addRing(path, ring, close) {
+      ring.forEach(function (coords, i) {
+        if (i === 0) {
+          path.moveTo(coords[0], coords[1]);
+        } else {
+          path.lineTo(coords[0], coords[1]);
+        }
+        paths.box = [
+          Math.min(paths.box[0], coords[0]),
+          Math.min(paths.box[1], coords[1]),
+          Math.max(paths.box[2], coords[0]),
+          Math.max(paths.box[3], coords[1]),
+        ];
+      });
+      if (close) {
+        path.closePath();
+      }
+    }
+
+    for (const geometry of geometries) {
+      if (geometry.type === "LineString") {
+        addRing(paths.lines, geometry.coordinates, false);
+      } else if (geometry.type === "MultiLineString") {
+        geometry.coordinates.forEach(line => addRing(paths.lines, line, false));
+      } else if (geometry.type === "Polygon") {
+        geometry.coordinates.forEach(ring => addRing(paths.areas, ring, true));
+      } else if (geometry.type === "MultiPolygon") {
+        geometry.coordinates.forEach(polygon => polygon.forEach(ring => addRing(paths.areas, ring, true)));
+      }
+    }
+    return paths;
+}
+
+L.InstanceLayer = L.Layer.extend({
+
+    options: {
+      popups: false,
+    },
+
+    initialize: function (data, layer_index, options) {
+      L.setOptions(this, options);
+      this._data = data;
+      this._style = data.layers[layer_index];
+      this._rows = data.insertions.filter(row => row[5] === layer_index);
+      this._templates = data.blocks.map(block => templatePath(block.geometries));
+      this._boxes = [];
+    },
+
+    onAdd: function (map) {
+      this._canvas = L.DomUtil.create("canvas", "leaflet-zoom-hide");
+      map.getPanes().overlayPane.appendChild(this._canvas);
+      map.on("moveend viewreset", this._redraw, this);
+      if (this.options.popups) {
+        map.on("click", this._onClick, this);
+      }
+      this._redraw();
+    },
+
+    onRemove: function (map) {
+      L.DomUtil.remove(this._canvas);
+      map.off("moveend viewreset", this._redraw, this);
+      map.off("click", this._onClick, this);
+    },
+
+    // block coordinates to layer pixels, for one insertion
+    _matrix: function (row) {
+      const map = this._map;
+      const latlng = L.latLng(row[1], row[0]);
+      // derivatives of pixels along longitude / latitude, numerical so
+      // that any map projection works
+      const step = 1e-4;
+      const origin = map.latLngToLayerPoint(latlng);
+      const east = map.latLngToLayerPoint([row[1], row[0] + step]);
+      const north = map.latLngToLayerPoint([row[1] + step, row[0]]);
+      const pixel = [
+        [(east.x - origin.x) / step, (north.x - origin.x) / step],
+        [(east.y - origin.y) / step, (north.y - origin.y) / step],
+      ];
+      // block coordinates to longitude / latitude offsets, longitude
+      // degrees shrink with latitude
+      const k = Math.cos(this._data.latitude * Math.PI / 180) / Math.cos(row[1] * Math.PI / 180);
+      const m = this._data.matrix;
+      const angle = row[2] * Math.PI / 180;
+      const cos = Math.cos(angle);
+      const sin = Math.sin(angle);
+      const wcs = [
+        [cos * row[3], -sin * row[4]],
+        [sin * row[3], cos * row[4]],
+      ];
+      const geo = [
+        [k * (m[0][0] * wcs[0][0] + m[0][1] * wcs[1][0]), k * (m[0][0] * wcs[0][1] + m[0][1] * wcs[1][1])],
+        [m[1][0] * wcs[0][0] + m[1][1] * wcs[1][0], m[1][0] * wcs[0][1] + m[1][1] * wcs[1][1]],
+      ];
+      return new DOMMatrix([
+        pixel[0][0] * geo[0][0] + pixel[0][1] * geo[1][0],
+        pixel[1][0] * geo[0][0] + pixel[1][1] * geo[1][0],
+        pixel[0][0] * geo[0][1] + pixel[0][1] * geo[1][1],
+        pixel[1][0] * geo[0][1] + pixel[1][1] * geo[1][1],
+        origin.x,
+        origin.y,
+      ]);
+    },
+
+    _redraw: function () {
+      const map = this._map;
+      const size = map.getSize();
+      const topLeft = map.containerPointToLayerPoint([0, 0]);
+      const ratio = window.devicePixelRatio || 1;
+      L.DomUtil.setPosition(this._canvas, topLeft);
+      this._canvas.width = size.x * ratio;
+      this._canvas.height = size.y * ratio;
+      this._canvas.style.width = size.x + "px";
+      this._canvas.style.height = size.y + "px";
+      // insertions outside the view are skipped
+      const bounds = map.getBounds().pad(0.1);
+      const lines = new Path2D();
+      const areas = new Path2D();
+      this._boxes = [];
+      for (const row of this._rows) {
+        if (!bounds.contains([row[1], row[0]])) {
+          continue;
+        }
+        const matrix = this._matrix(row);
+        const template = this._templates[row[6]];
+        lines.addPath(template.lines, matrix);
+        areas.addPath(template.areas, matrix);
+        if (this.options.popups) {
+          const corners = [
+            matrix.transformPoint({x: template.box[0], y: template.box[1]}),
+            matrix.transformPoint({x: template.box[2], y: template.box[1]}),
+            matrix.transformPoint({x: template.box[2], y: template.box[3]}),
+            matrix.transformPoint({x: template.box[0], y: template.box[3]}),
+          ];
+          this._boxes.push({
+            bounds: L.bounds(corners.map(c => [c.x, c.y])),
+            row: row,
+          });
+        }
+      }
+      // same style of the other entities
+      const ctx = this._canvas.getContext("2d");
+      ctx.setTransform(ratio, 0, 0, ratio, -topLeft.x * ratio, -topLeft.y * ratio);
+      ctx.strokeStyle = this._style.color;
+      ctx.fillStyle = this._style.color;
+      ctx.lineWidth = 3;
+      ctx.lineJoin = "round";
+      ctx.lineCap = "round";
+      if (!this._style.linetype) {
+        ctx.setLineDash([10, 10]);
+      }
+      ctx.globalAlpha = 0.2;
+      ctx.fill(areas, "evenodd");
+      ctx.globalAlpha = 1;
+      ctx.stroke(areas);
+      ctx.stroke(lines);
+    },
+
+    _onClick: function (e) {
+      // last drawn insertion on top
+      for (let i = this._boxes.length - 1; i >= 0; i--) {
+        if (this._boxes[i].bounds.contains(e.layerPoint)) {
+          const popup = L.popup({minWidth: 256})
+            .setLatLng(e.latlng)
+            .setContent("...")
+            .openOn(this._map);
+          fetch(this._data.popup_url.replace("ID", this._boxes[i].row[7]))
+            .then(response => response.ok ? response.text() : response.statusText)
+            .then(content => popup.setContent(content));
+          return;
+        }
+      }
+    },
+});
+
+function addInstanceLayers(data, options) {
+    // one canvas for each layer, so that layer control toggles them
+    data.layers.forEach(function (layer, i) {
+      const instances = new L.InstanceLayer(data, i, options);
+      instances.addTo(window[layer.group]);
+    });
+}
@@ -7,13 +7,25 @@ function map_init(map, options) {
     }
 
     function setLineStyle(feature) {
-      if (feature.properties.popupContent.linetype) {
-        return {"color": feature.properties.popupContent.color, "weight": 3 };
+      // each layer group is loaded with its own style
+      const style = this.layer;
+      if (style.linetype) {
+        return {"color": style.color, "weight": 3 };
       } else {
-        return {"color": feature.properties.popupContent.color, "weight": 3, dashArray: "10, 10" };
+        return {"color": style.color, "weight": 3, dashArray: "10, 10" };
       }
     }
 
+    function onEachLine(feature, layer) {
+      // popup content is fetched when first opened
+      layer.bindPopup("...", {minWidth: 256});
+      layer.once("popupopen", function () {
+        fetch(this.popup_url.replace("ID", feature.id))
+          .then(response => response.ok ? response.text() : response.statusText)
+          .then(content => layer.setPopupContent(content));
+      }, this);
+    }
+
     const base_map = L.tileLayer("https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png",
       {
         maxZoom: 19,
@@ -22,30 +34,69 @@ function map_init(map, options) {
     const layer_control = L.control.layers(null).addTo(map);
     const marker_layer = L.layerGroup().addTo(map);
 
+    const renderer = JSON.parse(document.getElementById("renderer_data").textContent);
+    // layer summaries by layer group, see DrawingDetailView
+    const layers = {};
+
+    function loadLayer(layer) {
+      // entities of a layer are fetched the first time it is shown
+      if (layer.loaded) {
+        return;
+      }
+      layer.loaded = true;
+      fetch(layer.url)
+        .then(response => response.json())
+        .then(function (data) {
+          const context = {layer: layer, popup_url: data.features.popup_url};
+          let options = {
+            style: setLineStyle.bind(context),
+            onEachFeature: onEachLine.bind(context),
+          };
+          if (renderer === "canvas") {
+            // paths of the layer on one canvas, instead of a DOM node each
+            options.renderer = L.canvas({padding: 0.5});
+          }
+          L.geoJson(data.features, options).addTo(window[layer.group]);
+          // block insertions drawn on canvas, see instance_layer.js
+          if (data.instances) {
+            addInstanceLayers(data.instances, {popups: true});
+          }
+        });
+    }
+
+    map.on("overlayadd", function (e) {
+      const layer = layers[L.stamp(e.layer)];
+      if (layer) {
+        loadLayer(layer);
+      }
+    });
+
     function getCollections() {
-      // add layer groups
-      collection = JSON.parse(document.getElementById("layer_data").textContent);
-      if (collection !== null) {
-        for (layer_name of collection) {
-          window[layer_name] = L.layerGroup().addTo(map);
-          layer_control.addOverlay(window[layer_name], layer_name);
+      // add layer groups, heavy layers may start hidden
+      const collection = JSON.parse(document.getElementById("layer_data").textContent) || [];
+      for (const layer of collection) {
+        window[layer.group] = L.layerGroup();
+        layers[L.stamp(window[layer.group])] = layer;
+        layer_control.addOverlay(window[layer.group], `${layer.group} (${layer.count})`);
+        if (layer.visible) {
+          window[layer.group].addTo(map);
+          loadLayer(layer);
         }
       }
       // add objects to layers
-      collection = JSON.parse(document.getElementById("marker_data").textContent);
-      for (marker of collection.features) {
+      const markers = JSON.parse(document.getElementById("marker_data").textContent);
+      for (marker of markers.features) {
         // let author = marker.properties.popupContent.layer
         L.geoJson(marker, {onEachFeature: onEachFeature}).addTo(marker_layer);
       }
-      // fit bounds
-      map.fitBounds(L.geoJson(collection).getBounds(), {padding: [30,30]});
-      collection = JSON.parse(document.getElementById("line_data").textContent);
-      if (collection !== null) {
-        for (line of collection.features) {
-          let name = line.properties.popupContent.layer
-          L.geoJson(line, {style: setLineStyle, onEachFeature: onEachFeature}).addTo(window[name]);
+      // fit bounds of markers and visible layers
+      const bounds = L.geoJson(markers).getBounds();
+      for (const layer of collection) {
+        if (layer.visible && layer.bounds) {
+          bounds.extend(layer.bounds);
         }
       }
+      map.fitBounds(bounds, {padding: [30,30]});
     }
 
     getCollections()
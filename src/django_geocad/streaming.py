@@ -0,0 +1,122 @@
+"""
+Streaming access to DXF files, memory does not depend on the number of
+modelspace entities. The file is read as a skeleton document (header,
+tables, blocks and objects, where geodata is stored) while modelspace
+entities are streamed with the ezdxf `iterdxf` add-on. Binary DXF files
+can't be streamed.
+"""
+
+import os
+from io import StringIO
+from pathlib import Path
+
+from django.conf import settings
+
+
+def use_streaming(path):
+    """True if streaming import is enabled and file can be streamed"""
+    if not getattr(settings, "GEOCAD_STREAMING_IMPORT", False):
+        return False
+    from ezdxf.lldxf.validator import is_binary_dxf_file
+
+    return not is_binary_dxf_file(str(path))
+
+
+def read_skeleton(path):
+    """Reads a DXF file without the content of the ENTITIES section"""
+    import ezdxf
+    from ezdxf.filemanagement import dxf_file_info
+
+    info = dxf_file_info(str(path))
+    skeleton = StringIO()
+    # highest handle of skipped entities
+    last_handle = 0
+    for code, value, in_entities in iter_tags(path, info.encoding):
+        if not in_entities:
+            skeleton.write(code)
+            skeleton.write(value)
+        elif code.strip() == "5":
+            try:
+                last_handle = max(last_handle, int(value.strip(), 16))
+            except ValueError:
+                pass
+    skeleton.seek(0)
+    doc = ezdxf.read(skeleton)
+    # $HANDSEED may be stale, new entities must not reuse skipped handles
+    handles = doc.entitydb.handles
+    if int(str(handles), 16) <= last_handle:
+        handles.reset("%X" % (last_handle + 1))
+    return doc
+
+
+def iter_tags(path, encoding):
+    """
+    Yields raw (code, value) lines of a DXF file, flagging lines inside
+    the ENTITIES section (section start and end are not flagged).
+    """
+
+    section_name = False
+    in_entities = False
+    with open(path, "rt", encoding=encoding, errors="surrogateescape") as f:
+        for code in f:
+            value = f.readline()
+            c = code.strip()
+            if section_name:
+                section_name = False
+                yield code, value, False
+                in_entities = c == "2" and value.strip() == "ENTITIES"
+                continue
+            if c == "0":
+                tag = value.strip()
+                if tag == "SECTION":
+                    section_name = True
+                elif tag == "ENDSEC" and in_entities:
+                    in_entities = False
+            yield code, value, in_entities
+
+
+def iter_modelspace(path, types, doc=None):
+    """
+    Streams modelspace entities of given types. Entities are not bound to
+    a document, unless the skeleton `doc` is given (needed by INSERTs to
+    resolve their block).
+    """
+
+    from ezdxf.addons import iterdxf
+
+    for entity in iterdxf.modelspace(str(path), types=types):
+        if doc:
+            entity.doc = doc
+        yield entity
+
+
+def save_with_entities(doc, path, target=None):
+    """
+    Saves skeleton `doc` over the DXF file at `path` (or to `target`),
+    ENTITIES of the original file are copied back line by line, followed by
+    entities added to the skeleton.
+    """
+
+    # also registers the "dxfreplace" error handler
+    from ezdxf.filemanagement import dxf_file_info
+
+    info = dxf_file_info(str(path))
+    exported = StringIO()
+    doc.write(exported)
+    exported.seek(0)
+    path = Path(path)
+    target = Path(target or path)
+    tmp = target.with_suffix(target.suffix + ".tmp")
+    with open(tmp, "wt", encoding="utf-8", errors="dxfreplace") as f:
+        section_name = False
+        for code in exported:
+            value = exported.readline()
+            f.write(code)
+            f.write(value)
+            if section_name and value.strip() == "ENTITIES":
+                for o_code, o_value, in_entities in iter_tags(path, info.encoding):
+                    if in_entities:
+                        f.write(o_code)
+                        f.write(o_value)
+            section_name = code.strip() == "0" and value.strip() == "SECTION"
+    os.replace(tmp, target)
@@ -5,6 +5,7 @@ from .views import (
     DrawingListView,
     EntityDataListView,
     add_block_insertion,
+    bulk_insertion_create,
     change_block_insertion,
     create_entity_data,
     csv_download,
@@ -12,6 +13,9 @@ from .views import (
     delete_block_insertion,
     delete_entity_data,
     drawing_download,
+    drawing_identify,
+    entity_popup,
+    layer_entities,
 )
 
 app_name = "django_geocad"
@@ -19,11 +23,19 @@ urlpatterns = [
     path("", DrawingListView.as_view(), name="drawing_list"),
     path("<pk>", DrawingDetailView.as_view(), name="drawing_detail"),
     path("<pk>/insertion", add_block_insertion, name="insertion_create"),
+    path("<pk>/identify", drawing_identify, name="drawing_identify"),
+    path(
+        "<pk>/insertion/bulk",
+        bulk_insertion_create,
+        name="insertion_bulk_create",
+    ),
     path("insertion/<pk>/change", change_block_insertion, name="insertion_change"),
     path("insertion/<pk>/delete", delete_block_insertion, name="insertion_delete"),
     path("insertion/<pk>/data-list", EntityDataListView.as_view(), name="data_list"),
     path("insertion/<pk>/data-create", create_entity_data, name="data_create"),
     path("entity-data/<pk>/delete", delete_entity_data, name="data_delete"),
+    path("entity/<pk>/popup", entity_popup, name="entity_popup"),
+    path("layer/<pk>/entities", layer_entities, name="layer_entities"),
     path(
         "<pk>/csv",
         csv_download,
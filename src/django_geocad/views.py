@@ -1,19 +1,98 @@
 import csv
+from math import isfinite
 from typing import Any
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.decorators import permission_required
+from django.core.cache import cache
+from django.core.validators import FileExtensionValidator
 from django.db.models.query import QuerySet
-from django.forms import FloatField, ModelForm, NumberInput
-from django.http import Http404, HttpResponse, HttpResponseRedirect
-from django.shortcuts import get_object_or_404
+from django.forms import FileField, FloatField, Form, ModelForm, NumberInput
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.shortcuts import aget_object_or_404, get_object_or_404
 from django.template.response import TemplateResponse
 from django.urls import reverse
+from django.utils.decorators import method_decorator
 from django.utils.translation import gettext_lazy as _
 from django.views.generic import DetailView, ListView
 
-from .models import Drawing, Entity, EntityData
+from .importers import read_insertions
+from .models import Drawing, Entity, EntityData, Layer, popup_cache_key
+from .pool import Echo, file_chunks, run_in_pool, stream
+from .routers import read_from_replica, sticky_primary
 
 
+def get_map_context(drawing, layers, bbox=None):
+    """
+    Entities and layer names drawn by map templates, optionally only those
+    overlapping bbox (west, south, east, north). Insertions are sent as
+    block instances if GEOCAD_CLIENT_INSTANCING is set, GEOCAD_RENDERER
+    ("svg" or "canvas") tells the map how to draw entities.
+    """
+    context = {"renderer": getattr(settings, "GEOCAD_RENDERER", "svg")}
+    id_list = layers.values_list("id", flat=True)
+    lines = Entity.objects.filter(layer_id__in=id_list).select_related("layer", "block")
+    if bbox:
+        lines = lines.in_bbox(*bbox)
+    if getattr(settings, "GEOCAD_CLIENT_INSTANCING", False):
+        context["lines"], context["instances"] = drawing.get_block_instances(lines)
+    else:
+        context["lines"] = drawing.expand_insertions(lines)
+    context["features"] = get_features(context["lines"])
+    # clicks on the map snap to entity vertices
+    context["identify_url"] = reverse(
+        "django_geocad:drawing_identify", kwargs={"pk": drawing.id}
+    )
+    name_list = layers.values_list("name", flat=True)
+    context["layer_list"] = list(dict.fromkeys(name_list))
+    context["layer_list"] = [_("Layer - ") + s for s in context["layer_list"]]
+    return context
+
+
+def get_features(entities):
+    """
+    GeoJSON of entities for the map: features carry id and index of their
+    layer, layer names and styles are listed once. Popups are fetched when
+    opened, see `entity_popup`.
+    """
+    layer_index = {}
+    collection = {
+        "type": "FeatureCollection",
+        "layers": [],
+        "popup_url": reverse("django_geocad:entity_popup", kwargs={"pk": "ID"}),
+        "features": [],
+    }
+    for ent in entities:
+        if ent.layer_id not in layer_index:
+            layer_index[ent.layer_id] = len(layer_index)
+            collection["layers"].append(
+                {
+                    # layer group of the map
+                    "group": _("Layer - ") + ent.layer.name,
+                    "color": ent.layer.color_field,
+                    "linetype": ent.layer.linetype,
+                }
+            )
+        collection["features"].append(
+            {
+                "type": "Feature",
+                "id": ent.id,
+                "properties": {"layer": layer_index[ent.layer_id]},
+                "geometry": ent.geom,
+            }
+        )
+    return collection
+
+
+@method_decorator(read_from_replica, name="dispatch")
 class DrawingListView(ListView):
     model = Drawing
     template_name = "django_geocad/drawing_list.html"
@@ -28,25 +107,91 @@ class DrawingListView(ListView):
         return context
 
 
+@method_decorator(read_from_replica, name="dispatch")
 class DrawingDetailView(DetailView):
     model = Drawing
     template_name = "django_geocad/drawing_detail.html"
 
     def get_context_data(self, **kwargs) -> dict[str, Any]:
         context = super().get_context_data(**kwargs)
-        layers = self.object.related_layers.filter(is_block=False)
         if self.object.related_layers.filter(is_block=True).exists():
             context["blocks"] = True
-        id_list = layers.values_list("id", flat=True)
-        context["lines"] = Entity.objects.filter(
-            layer_id__in=id_list
-        ).prefetch_related()
-        name_list = layers.values_list("name", flat=True)
-        context["layer_list"] = list(dict.fromkeys(name_list))
-        context["layer_list"] = [_("Layer - ") + s for s in context["layer_list"]]
+        # entities are fetched by the map one layer at a time
+        context["layers"] = self.object.get_layer_summary()
+        for layer in context["layers"]:
+            layer["group"] = _("Layer - ") + layer.pop("name")
+            layer["url"] = reverse(
+                "django_geocad:layer_entities", kwargs={"pk": layer["id"]}
+            )
+        context["renderer"] = getattr(settings, "GEOCAD_RENDERER", "svg")
+        context["instancing"] = getattr(settings, "GEOCAD_CLIENT_INSTANCING", False)
         return context
 
 
+@read_from_replica
+async def layer_entities(request, pk):
+    """
+    Entities of a layer as GeoJSON (see `get_features`), with block
+    instances if GEOCAD_CLIENT_INSTANCING is set, fetched by the map of
+    DrawingDetailView when the layer is shown. Optional `bbox` parameter
+    (west,south,east,north) keeps only entities in the viewport.
+    """
+    layer = await aget_object_or_404(
+        Layer.objects.select_related("drawing"), id=pk, is_block=False
+    )
+    bbox = None
+    if "bbox" in request.GET:
+        try:
+            bbox = [float(c) for c in request.GET["bbox"].split(",")]
+        except ValueError:
+            bbox = []
+        if len(bbox) != 4:
+            return HttpResponseBadRequest(_("Invalid bbox"))
+    # entities are loaded and serialized out of the event loop
+    return await sync_to_async(layer_entities_response)(layer, bbox)
+
+
+def layer_entities_response(layer, bbox):
+    context = get_map_context(
+        layer.drawing, Layer.objects.filter(id=layer.id), bbox=bbox
+    )
+    return JsonResponse(
+        {"features": context["features"], "instances": context.get("instances")}
+    )
+
+
+async def drawing_identify(request, pk):
+    """
+    Entities within `distance` meters (default 1, at most
+    GEOCAD_IDENTIFY_MAX_DISTANCE, default 100) of point `lat` / `long`,
+    nearest first, and the nearest vertex to snap to, from the in-memory
+    spatial index of the drawing (see `spatial_index`).
+    """
+    # shapely is imported when the map is first clicked
+    from .spatial_index import get_index
+
+    drawing = await aget_object_or_404(Drawing, id=pk)
+    if not drawing.geom:
+        raise Http404
+    try:
+        lat = float(request.GET["lat"])
+        long = float(request.GET["long"])
+        distance = float(request.GET.get("distance", 1))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest(_("Invalid point"))
+    if not all(isfinite(value) for value in (lat, long, distance)):
+        return HttpResponseBadRequest(_("Invalid point"))
+    max_distance = getattr(settings, "GEOCAD_IDENTIFY_MAX_DISTANCE", 100)
+    distance = min(max(distance, 0), max_distance)
+    index = await sync_to_async(get_index)(drawing)
+    return JsonResponse(
+        {
+            "entities": index.within_distance(long, lat, distance)[:20],
+            "snap": index.snap(long, lat, distance),
+        }
+    )
+
+
 class EntityCreateForm(ModelForm):
     lat = FloatField(
         label=_("Latitude"),
@@ -75,6 +220,7 @@ class EntityCreateForm(ModelForm):
 
 
 @permission_required("django_geocad.change_drawing")
+@sticky_primary
 def add_block_insertion(request, pk):
     drawing = get_object_or_404(Drawing, id=pk)
     blocks = drawing.related_layers.filter(is_block=True)
@@ -98,10 +244,7 @@ def add_block_insertion(request, pk):
                         form.cleaned_data["lat"],
                     ],
                 },
-                data={
-                    "processed": "true",
-                    "added": "true",
-                },
+                added=True,
             )
             ent.save()
             return HttpResponseRedirect(
@@ -120,16 +263,46 @@ def add_block_insertion(request, pk):
     form.fields["layer"].queryset = layers
     form.fields["block"].queryset = blocks
     context["form"] = form
-    id_list = layers.values_list("id", flat=True)
-    context["lines"] = Entity.objects.filter(layer_id__in=id_list).prefetch_related()
-    name_list = layers.values_list("name", flat=True)
-    context["layer_list"] = list(dict.fromkeys(name_list))
-    context["layer_list"] = [_("Layer - ") + s for s in context["layer_list"]]
+    context.update(get_map_context(drawing, layers))
     context["drawing"] = drawing
     return TemplateResponse(request, "django_geocad/entity_create.html", context)
 
 
+class InsertionImportForm(Form):
+    file = FileField(
+        label=_("CSV / GeoJSON file"),
+        validators=[
+            FileExtensionValidator(allowed_extensions=["csv", "geojson", "json"])
+        ],
+    )
+
+
 @permission_required("django_geocad.change_drawing")
+@sticky_primary
+def bulk_insertion_create(request, pk):
+    drawing = get_object_or_404(Drawing, id=pk)
+    if not drawing.related_layers.filter(is_block=True).exists():
+        raise Http404
+    if request.method == "POST":
+        form = InsertionImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            file = form.cleaned_data["file"]
+            try:
+                rows = read_insertions(file.read(), file.name)
+                drawing.bulk_create_insertions(rows)
+                return HttpResponseRedirect(
+                    reverse("django_geocad:drawing_detail", kwargs={"pk": drawing.id})
+                )
+            except ValueError as e:
+                form.add_error("file", str(e))
+    else:
+        form = InsertionImportForm()
+    context = {"form": form, "drawing": drawing}
+    return TemplateResponse(request, "django_geocad/entity_bulk_create.html", context)
+
+
+@permission_required("django_geocad.change_drawing")
+@sticky_primary
 def change_block_insertion(request, pk):
     object = get_object_or_404(Entity, id=pk)
     drawing = object.layer.drawing
@@ -172,11 +345,7 @@ def change_block_insertion(request, pk):
     form.fields["layer"].queryset = layers
     form.fields["block"].queryset = blocks
     context["form"] = form
-    id_list = layers.values_list("id", flat=True)
-    context["lines"] = Entity.objects.filter(layer_id__in=id_list).prefetch_related()
-    name_list = layers.values_list("name", flat=True)
-    context["layer_list"] = list(dict.fromkeys(name_list))
-    context["layer_list"] = [_("Layer - ") + s for s in context["layer_list"]]
+    context.update(get_map_context(drawing, layers))
     context["drawing"] = drawing
     context["object"] = object
     context["related_data"] = object.related_data.all()
@@ -185,6 +354,7 @@ def change_block_insertion(request, pk):
 
 
 @permission_required("django_geocad.change_drawing")
+@sticky_primary
 def delete_block_insertion(request, pk):
     object = get_object_or_404(Entity, id=pk)
     drawing = object.layer.drawing
@@ -220,6 +390,7 @@ class EntityDataForm(ModelForm):
 
 
 @permission_required("django_geocad.change_drawing")
+@sticky_primary
 def create_entity_data(request, pk):
     if (
         "Hx-Request" not in request.headers
@@ -241,6 +412,7 @@ def create_entity_data(request, pk):
 
 
 @permission_required("django_geocad.change_drawing")
+@sticky_primary
 def delete_entity_data(request, pk):
     if (
         "Hx-Request" not in request.headers
@@ -255,32 +427,74 @@ def delete_entity_data(request, pk):
     )
 
 
-def csv_download(request, pk):
-    drawing = get_object_or_404(Drawing, id=pk)
-    # Create the HttpResponse object with the appropriate CSV header.
-    response = HttpResponse(content_type="text/csv")
+async def entity_popup(request, pk):
+    # popups do not change until entity, data or layers are saved
+    key = popup_cache_key(pk)
+    content = await cache.aget(key)
+    if content is None:
+        entity = await aget_object_or_404(
+            Entity.objects.select_related("layer", "block"), id=pk
+        )
+        content = await sync_to_async(lambda: entity.popupContent["content"])()
+        timeout = getattr(settings, "GEOCAD_POPUP_CACHE_TIMEOUT", 3600)
+        await cache.aset(key, content, timeout)
+    return HttpResponse(content)
+
+
+def csv_chunks(rows, size=1000):
+    """CSV text of rows, in chunks of size rows"""
+    writer = csv.writer(Echo())
+    chunk = []
+    for row in rows:
+        chunk.append(writer.writerow(row))
+        if len(chunk) == size:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+@read_from_replica
+async def csv_download(request, pk):
+    drawing = await aget_object_or_404(Drawing, id=pk)
+    # rows are streamed while entities are fetched
+    response = StreamingHttpResponse(
+        stream(request, csv_chunks(drawing.iter_csv_rows())),
+        content_type="text/csv",
+    )
     response["Content-Disposition"] = f'attachment; filename="{drawing.title}.csv"'
-    writer = csv.writer(response)
-    writer = drawing.write_csv(writer)
 
     return response
 
 
-def drawing_download(request, pk):
-    drawing = get_object_or_404(Drawing, id=pk)
-    drawing.prepare_dxf_to_download()
-    response = HttpResponse(drawing.dxf, content_type="text/plain")
+async def drawing_download(request, pk):
+    drawing = await aget_object_or_404(Drawing, id=pk)
+    path = await sync_to_async(drawing.prepare_dxf_to_download)()
+    if path is None:
+        # an import is running, the file would miss geodata or insertions
+        response = HttpResponse(
+            _("Drawing is being imported, try again later."), status=503
+        )
+        response["Retry-After"] = 30
+        return response
+    # file is read in the bounded pool
+    response = StreamingHttpResponse(
+        stream(request, file_chunks(path), pool=True),
+        content_type="text/plain",
+    )
     response["Content-Disposition"] = f"attachment; filename={drawing.title}.dxf"
 
     return response
 
 
-def csv_download_from_file(request, pk):
-    drawing = get_object_or_404(Drawing, id=pk)
+@read_from_replica
+async def csv_download_from_file(request, pk):
+    drawing = await aget_object_or_404(Drawing, id=pk)
     # Create the HttpResponse object with the appropriate CSV header.
     response = HttpResponse(content_type="text/csv")
     response["Content-Disposition"] = f'attachment; filename="{drawing.title}.csv"'
     writer = csv.writer(response)
-    writer = drawing.write_csv_from_file(writer)
+    # ezdxf reads the file in the bounded pool
+    await run_in_pool(drawing.write_csv_from_file, writer)
 
     return response